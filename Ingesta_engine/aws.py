@@ -0,0 +1,10 @@
+import boto3
+from botocore.config import Config
+
+from config import MAX_POOL_CONNECTIONS, REGION
+
+# Clientes de boto3 compartidos por todas las entidades; a diferencia de los
+# recursos, los clientes son thread-safe y reutilizan el pool de conexiones
+boto_config = Config(region_name=REGION, max_pool_connections=MAX_POOL_CONNECTIONS)
+dynamodb = boto3.client('dynamodb', config=boto_config)
+s3 = boto3.client('s3', config=boto_config)
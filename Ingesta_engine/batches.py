@@ -0,0 +1,81 @@
+import csv
+import hashlib
+
+from entities import COLUMN_CASTS
+
+
+# Función para calcular el hash de una fila (se suma al hash de contenido de su shard)
+def row_hash(values):
+    digest = hashlib.blake2b(repr(tuple(values)).encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest, 'big')
+
+
+# Destino de csv.writer que junta cada fila codificada como una línea aparte
+class _LineCollector:
+    __slots__ = ('write',)
+
+    def __init__(self, lines):
+        self.write = lines.append
+
+
+# Lote columnar con las filas de una partición de una salida dentro de una página, al estilo de
+# un record batch de Arrow: una lista de valores por columna, en el orden y con el tipo del
+# esquema de la salida (el de las tablas de Glue), en lugar de un dict por fila. La transformación
+# arma las columnas directamente y los escritores las consumen como columnas: Parquet las copia
+# a sus arrays y csv.writer las recorre en paralelo (zip), sin guardar una lista por fila. En el
+# pool de procesos el lote se codifica a líneas CSV (con los hashes de sus filas) y viaja sin las
+# columnas, que se vuelven a leer solo si alguien las pide
+class RowBatch:
+    __slots__ = ('schema', 'columns', 'length', 'lines', 'hashes')
+
+    def __init__(self, schema, columns, length, lines=None, hashes=None):
+        self.schema = schema
+        self.columns = columns
+        self.length = length
+        self.lines = lines
+        self.hashes = hashes
+
+    # Función para armar el lote a partir de filas ya construidas (valores en el orden del esquema),
+    # para las salidas que no vienen del scan: agregados, student-360 y dead letter
+    @classmethod
+    def from_rows(cls, schema, rows):
+        columns = list(zip(*rows)) if rows else [() for _ in schema]
+        return cls(schema, columns, len(rows))
+
+    def __len__(self):
+        return self.length
+
+    def names(self):
+        return [name for name, _ in self.schema]
+
+    def decoded(self):
+        if self.columns is None:
+            casts = [COLUMN_CASTS[column_type] for _, column_type in self.schema]
+            columns = list(zip(*csv.reader(self.lines))) if self.lines else [() for _ in self.schema]
+            self.columns = [tuple(map(cast, column)) for cast, column in zip(casts, columns)]
+        return self.columns
+
+    def column(self, name):
+        return self.decoded()[self.names().index(name)]
+
+    def rows(self):
+        return zip(*self.decoded())
+
+    def row_hashes(self):
+        if self.hashes is None:
+            self.hashes = [row_hash(values) for values in self.rows()]
+        return self.hashes
+
+    # Función para codificar el lote a líneas CSV; las columnas se descartan
+    def encode(self):
+        self.row_hashes()
+        lines = []
+        csv.writer(_LineCollector(lines)).writerows(self.rows())
+        self.lines = lines
+        self.columns = None
+
+    def slice(self, start, stop):
+        columns = None if self.columns is None else [column[start:stop] for column in self.columns]
+        lines = None if self.lines is None else self.lines[start:stop]
+        hashes = None if self.hashes is None else self.hashes[start:stop]
+        return RowBatch(self.schema, columns, stop - start, lines, hashes)
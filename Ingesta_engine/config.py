@@ -0,0 +1,130 @@
+import os
+from loguru import logger
+
+# Obtener la variable de entorno STAGE
+try:
+    stage = os.getenv('STAGE')
+except Exception as e:
+    logger.error(f"Error getting STAGE environment variable: {e}")
+    exit()
+
+if stage not in ['dev', 'test', 'prod']:
+    logger.error(f"Invalid value for STAGE environment variable: {stage}")
+    exit()
+
+# Formato de salida: 'csv' (por defecto) o 'parquet' con columnas tipadas
+OUTPUT_FORMAT = os.getenv('OUTPUT_FORMAT', 'csv')
+
+if OUTPUT_FORMAT not in ['csv', 'parquet']:
+    logger.error(f"Invalid value for OUTPUT_FORMAT environment variable: {OUTPUT_FORMAT}")
+    exit()
+
+# Compresión de los objetos exportados: 'none', 'gzip' o 'zstd'. En CSV se comprime el archivo
+# (.csv.gz / .csv.zst) mientras se escriben las filas; en Parquet define el códec de las columnas
+COMPRESSION = os.getenv('COMPRESSION', 'none')
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', '0'))  # 0 usa el nivel por defecto del códec
+
+if COMPRESSION not in ['none', 'gzip', 'zstd']:
+    logger.error(f"Invalid value for COMPRESSION environment variable: {COMPRESSION}")
+    exit()
+
+# Configuración de AWS
+REGION = 'us-east-1'
+S3_BUCKET_NAME = f'ciencia-datos-bucket-rockie-{stage}'
+MAX_POOL_CONNECTIONS = int(os.getenv('MAX_POOL_CONNECTIONS', '50'))  # Conexiones compartidas entre todas las entidades
+
+# Directorio común de logs y estado en la máquina virtual
+LOG_DIR = os.getenv('LOG_DIR', "/var/log/ciencia_datos")
+
+# Cantidad de entidades que se ingestan en paralelo
+ENTITY_WORKERS = int(os.getenv('ENTITY_WORKERS', '5'))
+
+# Configuración del scan paralelo (SCAN_SEGMENTS=0 calcula los segmentos con DescribeTable)
+SCAN_SEGMENTS = int(os.getenv('SCAN_SEGMENTS', '0'))
+SCAN_MAX_WORKERS = int(os.getenv('SCAN_MAX_WORKERS', '8'))
+SCAN_MAX_SEGMENTS = int(os.getenv('SCAN_MAX_SEGMENTS', '64'))
+SCAN_QUEUE_SIZE = int(os.getenv('SCAN_QUEUE_SIZE', '16'))
+# Decodificar los items crudos directamente al tipo de cada columna (false usa TypeDeserializer)
+FAST_DESERIALIZER = os.getenv('FAST_DESERIALIZER', 'true').lower() == 'true'
+# Límite de capacidad del scan: fracción de la capacidad provisionada de la tabla (0 desactiva el límite),
+# o un máximo fijo de RCU/s con SCAN_MAX_RCU. Las tablas on-demand no se limitan (solo se frena ante el
+# throttling) salvo que SCAN_ONDEMAND_RCU fije la capacidad de la que se toma la fracción
+SCAN_CAPACITY_SHARE = float(os.getenv('SCAN_CAPACITY_SHARE', '0.5'))
+SCAN_MAX_RCU = float(os.getenv('SCAN_MAX_RCU', '0'))
+SCAN_ONDEMAND_RCU = float(os.getenv('SCAN_ONDEMAND_RCU', '0'))
+SCAN_MAX_RETRIES = int(os.getenv('SCAN_MAX_RETRIES', '8'))  # Reintentos ante throttling antes de fallar
+SEGMENT_TARGET_BYTES = 256 * 1024 * 1024  # Tamaño aproximado de tabla por segmento
+SEGMENT_TARGET_ITEMS = 500000  # Cantidad aproximada de items por segmento
+
+# Pipeline de cada entidad: scan, transformación y escritura corren en etapas separadas unidas por
+# colas acotadas de PIPELINE_QUEUE_PAGES páginas (la memoria queda limitada a unas pocas páginas
+# más las SCAN_QUEUE_SIZE del scan paralelo); cada etapa tiene su propia concurrencia.
+# TRANSFORM_MODE=process transforma en un pool de procesos compartido por todas las entidades
+# (por defecto uno por núcleo), que devuelve las filas CSV ya codificadas
+TRANSFORM_MODE = os.getenv('TRANSFORM_MODE', 'thread')
+
+if TRANSFORM_MODE not in ['thread', 'process']:
+    logger.error(f"Invalid value for TRANSFORM_MODE environment variable: {TRANSFORM_MODE}")
+    exit()
+
+TRANSFORM_WORKERS = max(1, int(os.getenv('TRANSFORM_WORKERS', str(os.cpu_count() or 1) if TRANSFORM_MODE == 'process' else '1')))
+WRITE_WORKERS = max(1, int(os.getenv('WRITE_WORKERS', '1')))  # Cada partición la escribe siempre el mismo worker
+PIPELINE_QUEUE_PAGES = max(1, int(os.getenv('PIPELINE_QUEUE_PAGES', '4')))
+
+# Configuración de la subida en streaming: con STREAM_TO_S3=true cada shard se sube por partes mientras
+# avanza el scan y en /tmp solo queda lo que todavía no completa una parte. Con o sin streaming los
+# objetos se publican (un único PUT o el completado de la subida multipart) recién cuando termina bien
+# la ingesta. S3_MAX_CONCURRENCY es la cantidad de subidas en vuelo de cada entidad, compartidas entre
+# todas sus particiones
+STREAM_TO_S3 = os.getenv('STREAM_TO_S3', 'false').lower() == 'true'
+S3_PART_SIZE = max(int(os.getenv('S3_PART_SIZE', str(8 * 1024 * 1024))), 5 * 1024 * 1024)  # S3 exige partes de al menos 5 MB
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', '4'))
+
+# Rotación de los archivos de salida: cada partición se reparte en shards (part-00000, part-00001, ...)
+# de hasta SHARD_MAX_ROWS filas o SHARD_MAX_BYTES bytes aproximados (0 desactiva cada límite)
+SHARD_MAX_ROWS = int(os.getenv('SHARD_MAX_ROWS', '0'))
+SHARD_MAX_BYTES = int(os.getenv('SHARD_MAX_BYTES', str(128 * 1024 * 1024)))
+# Particiones con el escritor abierto por cada worker de escritura (0 sin límite); las menos usadas se
+# estacionan (CSV) o cierran su shard (Parquet) hasta que les vuelva a llegar un lote
+PARTITION_MAX_OPEN = int(os.getenv('PARTITION_MAX_OPEN', '256'))
+
+# Tamaño del buffer de filas de cada escritor
+CSV_BUFFER_ROWS = int(os.getenv('CSV_BUFFER_ROWS', '1000'))
+PARQUET_ROW_GROUP_ROWS = int(os.getenv('PARQUET_ROW_GROUP_ROWS', '50000'))
+
+# Registro: por defecto el progreso se registra agregado cada PROGRESS_INTERVAL segundos;
+# LOG_ITEMS=true vuelve a registrar una línea por item (lento en tablas grandes)
+LOG_ITEMS = os.getenv('LOG_ITEMS', 'false').lower() == 'true'
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '30'))
+# Resumen de métricas de cada ejecución (JSON y textfile de Prometheus)
+METRICS_DIR = os.getenv('METRICS_DIR', f'{LOG_DIR}/metrics')
+
+# Ingesta incremental: solo se leen los items desde la marca de agua (los que tienen su mismo valor
+# y ya se exportaron se descartan por id)
+INCREMENTAL = os.getenv('INCREMENTAL', 'false').lower() == 'true'
+WATERMARK_DIR = os.getenv('WATERMARK_DIR', f'{LOG_DIR}/watermarks')
+
+# Omitir la subida de los shards cuyo contenido no cambió desde la ejecución anterior. Siempre se
+# consulta el objeto con head_object: se omite si existe y tiene el mismo hash en sus metadatos o,
+# para las subidas multipart en streaming (sin metadatos), el hash y el ETag guardados en HASH_DIR y en S3
+SKIP_UNCHANGED = os.getenv('SKIP_UNCHANGED', 'true').lower() == 'true'
+HASH_DIR = os.getenv('HASH_DIR', f'{LOG_DIR}/hashes')
+
+# Tabla student-360 (t_student_360): se arma con las filas de students, rockies, rewards y activities
+# mientras se exportan, si las cuatro se ingestan completas en la misma ejecución. Con más de
+# STUDENT_360_MAX_KEYS estudiantes en memoria el estado se vuelca a STUDENT_360_PARTITIONS archivos
+# en STUDENT_360_SPILL_DIR, que luego se unen de a uno
+STUDENT_360 = os.getenv('STUDENT_360', 'false').lower() == 'true'
+STUDENT_360_MAX_KEYS = int(os.getenv('STUDENT_360_MAX_KEYS', '100000'))
+STUDENT_360_PARTITIONS = max(1, int(os.getenv('STUDENT_360_PARTITIONS', '16')))
+STUDENT_360_SPILL_DIR = os.getenv('STUDENT_360_SPILL_DIR', '/tmp/student_360')
+
+# Tablas de agregados diarios (t_activities_daily, t_rewards_daily) que se calculan durante la
+# ingesta; en las ejecuciones incrementales se suman a los agregados guardados en ROLLUP_DIR y en S3
+ROLLUPS = os.getenv('ROLLUPS', 'false').lower() == 'true'
+ROLLUP_DIR = os.getenv('ROLLUP_DIR', f'{LOG_DIR}/rollups')
+
+# Checkpoint para reanudar un scan interrumpido (ingesta_async.py no lo soporta y exige CHECKPOINT_ENABLED=false)
+CHECKPOINT_ENABLED = os.getenv('CHECKPOINT_ENABLED', 'true').lower() == 'true'
+CHECKPOINT_DIR = os.getenv('CHECKPOINT_DIR', f'{LOG_DIR}/checkpoints')
+CHECKPOINT_EVERY_PAGES = int(os.getenv('CHECKPOINT_EVERY_PAGES', '20'))
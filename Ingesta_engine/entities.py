@@ -0,0 +1,388 @@
+import json
+from urllib.parse import quote
+
+from boto3.dynamodb.types import TypeDeserializer
+
+_deserializer = TypeDeserializer()
+
+# Definición de una columna de salida: nombre, tipo de Glue y ruta del atributo en el item
+def column(name, column_type, path=None, default=None, encode=None):
+    if default is None:
+        default = '' if column_type == 'string' else 0
+    return {
+        'name': name,
+        'type': column_type,
+        'path': (path or name).split('.'),
+        'default': default,
+        'encode': encode,
+    }
+
+# Función para construir la extracción de valores a partir de las columnas de una salida: agrega
+# el valor de cada columna del item, convertido a su tipo, al final de la lista de esa columna
+# (target: una lista por columna, en el orden de las columnas), sin armar una fila por item
+def build_extractor(columns):
+    getters = [(c['path'][:-1], c['path'][-1], c['default'], c['encode'], COLUMN_CASTS[c['type']]) for c in columns]
+
+    def extract(item, target):
+        for values, (parents, attribute, default, encode, cast) in zip(target, getters):
+            value = item
+            for parent in parents:
+                value = value.get(parent, {})
+            value = value.get(attribute, default)
+            values.append(json.dumps(value) if encode == 'json' else cast(value))  # Convertir las listas en JSON
+
+    return extract
+
+# Función para convertir un item del cliente de bajo nivel a tipos de Python (igual que boto3.resource)
+def deserialize_item(item):
+    return {name: _deserializer.deserialize(value) for name, value in item.items()}
+
+# Función para convertir un número de DynamoDB (texto) a int o float, sin pasar por Decimal
+def decode_number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+# Función para convertir un valor crudo de DynamoDB ({'S': ...}, {'N': ...}, {'M': ...}, ...) a tipos de Python
+def decode_value(value):
+    (kind, data), = value.items()
+    if kind == 'S' or kind == 'BOOL':
+        return data
+    if kind == 'N':
+        return decode_number(data)
+    if kind == 'M':
+        return {name: decode_value(item) for name, item in data.items()}
+    if kind == 'L':
+        return [decode_value(item) for item in data]
+    if kind == 'NULL':
+        return None
+    if kind == 'NS':
+        return [decode_number(item) for item in data]
+    return list(data) if kind in ('SS', 'BS') else data
+
+def to_int_number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return int(float(text))
+
+# Función para leer un número de una fila (ya convertido, o texto si la fila llegó codificada)
+def to_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    return to_int_number(value) if value else 0
+
+# Conversión de los valores al tipo de la columna (el mismo que en los esquemas de Glue de setup.py)
+def to_string(value):
+    if value is None:
+        return ''
+    return value if isinstance(value, str) else str(value)
+
+def to_int(value):
+    if value is None or value == '':
+        return None
+    return to_int_number(value) if isinstance(value, str) else int(value)
+
+def to_double(value):
+    return None if value is None or value == '' else float(value)
+
+COLUMN_CASTS = {'string': to_string, 'int': to_int, 'double': to_double}
+RAW_NUMBER_CASTS = {'string': None, 'int': to_int_number, 'double': float}
+
+# Función para construir la extracción de valores directamente sobre los items crudos
+# del cliente de bajo nivel, sin TypeDeserializer ni Decimal; como build_extractor,
+# agrega los valores ya tipados a la lista de cada columna
+def build_raw_extractor(columns):
+    # Las columnas se agrupan por mapa padre para recorrer cada mapa una sola vez por item
+    groups = {}
+    for index, c in enumerate(columns):
+        encode_json = c['encode'] == 'json'
+        default = json.dumps(c['default']) if encode_json else c['default']
+        cast = COLUMN_CASTS[c['type']]
+        # Los textos solo se convierten en las columnas numéricas
+        text_cast = None if c['type'] == 'string' else cast
+        getter = (index, c['path'][-1], default, RAW_NUMBER_CASTS[c['type']], text_cast, cast, encode_json)
+        groups.setdefault(tuple(c['path'][:-1]), []).append(getter)
+    groups = list(groups.items())
+
+    def extract(item, target):
+        for parents, getters in groups:
+            values = item
+            for parent in parents:
+                values = values.get(parent, {}).get('M', {})
+            for index, attribute, default, number_cast, text_cast, cast, encode_json in getters:
+                value = values.get(attribute)
+                if value is None:
+                    value = default
+                elif encode_json:
+                    value = json.dumps(decode_value(value))  # Convertir las listas en JSON
+                elif 'S' in value:
+                    value = value['S'] if text_cast is None else text_cast(value['S'])
+                elif 'N' in value:
+                    value = value['N'] if number_cast is None else number_cast(value['N'])
+                else:
+                    value = cast(decode_value(value))
+                target[index].append(value)
+
+    return extract
+
+# Función para leer un atributo escalar (S o N) de primer nivel de un item crudo
+def raw_scalar(item, name, default=''):
+    value = item.get(name)
+    if value is None:
+        return default
+    return value.get('S', value.get('N', default))
+
+# Definición de una clave de partición Hive (clave=valor en la ruta del objeto) a partir
+# de un atributo de primer nivel del item; 'date' se queda con el día de una fecha ISO
+def partition(name, field=None, transform=None):
+    return {'name': name, 'field': field or name, 'transform': transform}
+
+HIVE_DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'  # Valor de Hive para una partición sin dato
+
+# Función para construir la ruta de partición (p. ej. tenant_id=t1/dt=2024-01-31) de un item crudo
+def build_partitioner(partitions):
+    keys = [(p['name'], p['field'], p['transform']) for p in partitions]
+
+    def partition_path(item):
+        parts = []
+        for name, field, transform in keys:
+            value = raw_scalar(item, field)
+            if transform == 'date':
+                value = value[:10]
+            parts.append(f"{name}={quote(value, safe='') if value else HIVE_DEFAULT_PARTITION}")
+        return '/'.join(parts)
+
+    return partition_path
+
+# Esquema (nombre, tipo) de una salida, con los mismos tipos que las tablas de Glue en setup.py
+def output_schema(output):
+    return [(c['name'], c['type']) for c in output['columns']]
+
+# Función para construir la proyección del scan con los atributos que usa la entidad
+# (columnas y particiones de todas sus salidas, id, campo de ruteo y campo incremental)
+def projection(spec):
+    paths = {(spec['id_field'],)}
+    if spec.get('route'):
+        paths.add((spec['route']['field'],))
+    if spec.get('incremental_field'):
+        paths.add((spec['incremental_field'],))
+    for output in spec['outputs'].values():
+        paths.update(tuple(c['path']) for c in output['columns'])
+        paths.update((p['field'],) for p in output.get('partition_by', []))
+
+    # DynamoDB rechaza rutas que se solapan: si se pide un mapa completo sobran sus atributos
+    paths = [path for path in paths
+             if not any(other != path and path[:len(other)] == other for other in paths)]
+
+    names = {}
+    expressions = []
+    for path in sorted(paths):
+        placeholders = []
+        for attribute in path:
+            if attribute not in names:
+                names[attribute] = f"#p{len(names)}"
+            placeholders.append(names[attribute])
+        expressions.append('.'.join(placeholders))
+
+    return {
+        'ProjectionExpression': ', '.join(expressions),
+        'ExpressionAttributeNames': {placeholder: attribute for attribute, placeholder in names.items()},
+    }
+
+
+# Entidades a ingestar. Cada una declara su tabla de DynamoDB y sus salidas
+# (clave en S3, particiones Hive y columnas); 'route' reparte los items entre
+# varias salidas según un atributo y 'incremental_field' habilita la ingesta incremental.
+# Las claves de partición no se repiten como columnas (Glue las lee de la ruta).
+ENTITIES = {
+    'students': {
+        'table': 't_students',
+        'id_field': 'student_id',
+        'outputs': {
+            'students': {
+                'key': 't_students/students_data',
+                'partition_by': [partition('tenant_id'), partition('dt', 'creation_date', 'date')],
+                'columns': [
+                    column('student_id', 'string'),
+                    column('student_email', 'string'),
+                    column('creation_date', 'string'),
+                    column('student_name', 'string', 'student_data.student_name'),
+                    column('password', 'string', 'student_data.password'),
+                    column('birthday', 'string', 'student_data.birthday'),
+                    column('gender', 'string', 'student_data.gender'),
+                    column('telephone', 'string', 'student_data.telephone'),
+                    column('rockie_coins', 'int', 'student_data.rockie_coins'),
+                    column('rockie_gems', 'int', 'student_data.rockie_gems'),
+                    column('student_promos', 'string', default=[], encode='json'),
+                ],
+            },
+        },
+    },
+    'rockies': {
+        'table': 't_rockies',
+        'id_field': 'student_id',
+        'outputs': {
+            'rockies': {
+                'key': 't_rockies/rockie_data',
+                'partition_by': [partition('tenant_id')],
+                'columns': [
+                    column('student_id', 'string'),
+                    column('level', 'int'),
+                    column('experience', 'int'),
+                    column('evolution', 'string'),
+                    column('rockie_name', 'string', 'rockie_data.rockie_name'),
+                    column('head_accessory', 'string', 'rockie_data.rockie_adorned.head_acc'),
+                    column('arms_accessory', 'string', 'rockie_data.rockie_adorned.arms_acc'),
+                    column('body_accessory', 'string', 'rockie_data.rockie_adorned.body_acc'),
+                    column('face_accessory', 'string', 'rockie_data.rockie_adorned.face_acc'),
+                    column('background_accessory', 'string', 'rockie_data.rockie_adorned.bg_acc'),
+                    column('rockie_all_accessories_ids', 'string', 'rockie_data.rockie_all_accessories_ids',
+                           default=[], encode='json'),
+                ],
+            },
+        },
+    },
+    'rewards': {
+        'table': 't_rewards',
+        'id_field': 'reward_id',
+        'incremental_field': 'creation_date',
+        'outputs': {
+            'rewards': {
+                'key': 't_rewards/rewards_data',
+                'partition_by': [partition('tenant_id'), partition('dt', 'creation_date', 'date')],
+                'columns': [
+                    column('student_id', 'string'),
+                    column('reward_id', 'string'),
+                    column('experience', 'int'),
+                    column('activity_id', 'string', 'reward_data.activity_id'),
+                    column('rockie_coins', 'int', 'reward_data.rockie_coins'),
+                ],
+            },
+        },
+    },
+    'activities': {
+        'table': 't_activities',
+        'id_field': 'activity_id',
+        'incremental_field': 'creation_date',
+        'outputs': {
+            'activities': {
+                'key': 't_activities/activities_data',
+                'partition_by': [partition('tenant_id'), partition('dt', 'creation_date', 'date')],
+                'columns': [
+                    column('activity_id', 'string'),
+                    column('student_id', 'string'),
+                    column('activity_type', 'string'),
+                    column('creation_date', 'string'),
+                    column('time', 'int', 'activity_data.time'),
+                ],
+            },
+        },
+    },
+    'purchasables': {
+        'table': 't_purchasable',
+        'id_field': 'product_id',
+        'route': {
+            'field': 'store_type',
+            'values': {'Promotion': 'promos', 'Accessories': 'accesories'},
+        },
+        'outputs': {
+            'promos': {
+                'key': 't_promos/promos_data',
+                'partition_by': [partition('tenant_id')],
+                'columns': [
+                    column('product_id', 'string'),
+                    column('price', 'double'),
+                    column('image', 'string', 'product_info.image'),
+                    column('product_brand', 'string', 'product_info.product_brand'),
+                    column('category', 'string', 'product_info.category'),
+                    column('product_name', 'string', 'product_info.product_name'),
+                ],
+            },
+            'accesories': {
+                'key': 't_accesories/accesories_data',
+                'partition_by': [partition('tenant_id')],
+                'columns': [
+                    column('product_id', 'string'),
+                    column('price', 'double'),
+                    column('image', 'string', 'product_info.image'),
+                    column('category', 'string', 'product_info.category'),
+                    column('product_name', 'string', 'product_info.product_name'),
+                ],
+            },
+        },
+    },
+}
+
+
+# Columna de la tabla student-360: agregación de una columna de una de las salidas que se unen
+# por tenant_id/student_id ('key' es la clave, 'first' el primer valor, 'count', 'sum' o 'max')
+def joined(name, column_type, source, aggregate, field=None):
+    return {**column(name, column_type), 'source': source, 'aggregate': aggregate, 'field': field}
+
+# Tabla desnormalizada por estudiante que se arma durante la ingesta de sus salidas de origen
+# (STUDENT_360=true). Solo se exportan los estudiantes presentes en 'students'; la contraseña no se copia
+STUDENT_360_ENTITY = {
+    'table': 't_student_360',
+    'id_field': 'student_id',
+    'sources': ['students', 'rockies', 'rewards', 'activities'],
+    'outputs': {
+        'student_360': {
+            'key': 't_student_360/student_360_data',
+            'partition_by': [partition('tenant_id')],
+            'columns': [
+                joined('student_id', 'string', None, 'key'),
+                joined('student_email', 'string', 'students', 'first', 'student_email'),
+                joined('student_name', 'string', 'students', 'first', 'student_name'),
+                joined('creation_date', 'string', 'students', 'first', 'creation_date'),
+                joined('gender', 'string', 'students', 'first', 'gender'),
+                joined('rockie_coins', 'int', 'students', 'first', 'rockie_coins'),
+                joined('rockie_gems', 'int', 'students', 'first', 'rockie_gems'),
+                joined('rockie_name', 'string', 'rockies', 'first', 'rockie_name'),
+                joined('rockie_level', 'int', 'rockies', 'first', 'level'),
+                joined('rockie_experience', 'int', 'rockies', 'first', 'experience'),
+                joined('rockie_evolution', 'string', 'rockies', 'first', 'evolution'),
+                joined('rewards_count', 'int', 'rewards', 'count'),
+                joined('rewards_experience', 'int', 'rewards', 'sum', 'experience'),
+                joined('rewards_coins', 'int', 'rewards', 'sum', 'rockie_coins'),
+                joined('activities_count', 'int', 'activities', 'count'),
+                joined('activities_time', 'int', 'activities', 'sum', 'time'),
+                joined('last_activity_date', 'string', 'activities', 'max', 'creation_date'),
+            ],
+        },
+    },
+}
+
+
+# Columna de una tabla de agregados: 'group' agrupa por field (de la ruta de partición o de la fila),
+# 'count' cuenta las filas y 'sum' suma field
+def rolled(name, column_type, aggregate, field=None):
+    return {**column(name, column_type), 'aggregate': aggregate, 'field': field or name}
+
+# Agregados diarios por tenant que se calculan con las filas de su salida de origen mientras se
+# ingesta (ROLLUPS=true); se exportan completos en cada ejecución, también en las incrementales
+ROLLUP_TABLES = {
+    'activities_daily': {
+        'source': 'activities',
+        'key': 't_activities_daily/activities_daily_data',
+        'partition_by': [partition('tenant_id')],
+        'columns': [
+            rolled('dt', 'string', 'group'),
+            rolled('activity_type', 'string', 'group'),
+            rolled('activities_count', 'int', 'count'),
+            rolled('total_time', 'int', 'sum', 'time'),
+        ],
+    },
+    'rewards_daily': {
+        'source': 'rewards',
+        'key': 't_rewards_daily/rewards_daily_data',
+        'partition_by': [partition('tenant_id')],
+        'columns': [
+            rolled('dt', 'string', 'group'),
+            rolled('rewards_count', 'int', 'count'),
+            rolled('total_experience', 'int', 'sum', 'experience'),
+            rolled('total_rockie_coins', 'int', 'sum', 'rockie_coins'),
+        ],
+    },
+}
@@ -0,0 +1,914 @@
+import argparse
+import json
+import os
+import posixpath
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from datetime import datetime
+from functools import partial
+
+from loguru import logger
+
+from aws import s3
+from batches import RowBatch
+from config import (CHECKPOINT_DIR, CHECKPOINT_ENABLED, COMPRESSION, ENTITY_WORKERS, FAST_DESERIALIZER, HASH_DIR,
+                    INCREMENTAL, LOG_DIR, LOG_ITEMS, OUTPUT_FORMAT, PROGRESS_INTERVAL, ROLLUP_DIR, ROLLUPS, S3_BUCKET_NAME,
+                    SKIP_UNCHANGED, STREAM_TO_S3, STUDENT_360, TRANSFORM_WORKERS, WATERMARK_DIR, stage)
+from entities import (ENTITIES, ROLLUP_TABLES, STUDENT_360_ENTITY, build_extractor, build_partitioner, build_raw_extractor,
+                      deserialize_item, output_schema, projection, raw_scalar)
+from metrics import RunMetrics
+from pipeline import PagePipeline, TransformedPage, transform_pool, write_page
+from rollups import Rollup
+from scan import ScanCheckpoint, scan_table, sharded_states
+from student360 import StudentJoin
+from writers import (DEAD_LETTER_SCHEMA, PartitionedWriter, S3StagedUpload, ShardedWriter, SinkRouter, UploadPool,
+                     abort_sealed, abort_upload, complete_sealed, csv_extension, error_code, file_extension, open_writer,
+                     seal_file, sealed_available, upload_args, upload_exists)
+
+# docker run -e STAGE=dev -v C:\Users\LENOVO\.aws:/root/.aws ingesta_engine --entities students rockies
+
+# Crear el directorio si no existe
+if not os.path.exists(LOG_DIR):
+    os.makedirs(LOG_DIR)
+
+# Nombre del archivo de log basado en el contenedor
+container_name = os.getenv('HOSTNAME', 'container_name')  # Usando el nombre del contenedor o default
+log_filename = f"{LOG_DIR}/{container_name}_log.log"
+
+# Configurar loguru para que los logs se escriban en el archivo y tengan el formato necesario;
+# con enqueue=True la escritura la hace un hilo aparte y no frena la extracción
+logger.remove()
+logger.add(sys.stderr, level="INFO", enqueue=True)
+logger.add(log_filename,
+           format="{time:YYYY-MM-DD HH:mm:ss.SSS} {level} {name} {message}",
+           level="INFO",
+           enqueue=True)
+
+RUN_ID = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+
+
+# Progreso agregado de una entidad: en lugar de una línea por item se registra
+# periódicamente la cantidad de items, páginas y errores y el ritmo en items/s
+class Progress:
+    def __init__(self, log_id, interval=PROGRESS_INTERVAL):
+        self.log_id = log_id
+        self.interval = interval
+        self.items = 0
+        self.pages = 0
+        self.errors = 0
+        self.started = self.reported = time.monotonic()
+
+    def page(self, items, errors):
+        self.pages += 1
+        self.items += items
+        self.errors += errors
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.report(now)
+
+    def report(self, now=None, label="Progress"):
+        now = now or time.monotonic()
+        elapsed = max(now - self.started, 1e-6)
+        logger.info(f"{self.log_id} - {label}: {self.items} items in {self.pages} pages "
+                    f"({self.items / elapsed:.0f} items/s), {self.errors} errors.")
+        self.reported = now
+
+
+# Ingesta de una entidad: scan de su tabla, extracción de filas, escritura y subida a S3
+class EntityIngestion:
+    def __init__(self, name, spec, transform_pool=None, student_join=None):
+        self.name = name
+        self.spec = spec
+        self.transform_pool = transform_pool  # Pool de procesos de transformación (TRANSFORM_MODE=process)
+        self.student_join = student_join  # Join de la tabla student-360 si la entidad es una de sus fuentes
+        self.id = f"ingesta_{stage}_{name}"  # Identificador único de la entidad en los logs
+        self.table_name = f"{stage}_{spec['table']}"
+        self.id_field = spec['id_field']
+        self.route = spec.get('route')
+        self.incremental_field = spec.get('incremental_field')
+        self.outputs = spec['outputs']
+        # Tablas de agregados que se calculan con las filas de alguna salida de la entidad
+        self.rollups = {table: Rollup(table, rollup) for table, rollup in ROLLUP_TABLES.items()
+                        if ROLLUPS and rollup['source'] in self.outputs}
+        self.definitions = {**self.outputs, **{table: ROLLUP_TABLES[table] for table in self.rollups}}
+        self.schemas = {output: output_schema(definition) for output, definition in self.definitions.items()}
+        self.extractors = {output: self.extractor(self.outputs[output]['columns']) for output in self.outputs}
+        self.partitioners = {output: build_partitioner(self.outputs[output].get('partition_by', []))
+                             for output in self.outputs}
+        self.projection = projection(spec)
+        self.checkpoint_file = f"{CHECKPOINT_DIR}/{name}_{stage}.json"
+        self.watermark_file = f"{WATERMARK_DIR}/{name}_{stage}.json"
+        self.s3_watermark_key = f"_watermarks/{name}_{stage}.json"
+        self.s3_manifest_key = f"_manifests/{name}_{stage}_{RUN_ID}.json"
+        self.hash_file = f"{HASH_DIR}/{name}_{stage}.json"
+        self.s3_hash_key = f"_hashes/{name}_{stage}.json"
+        self.rollup_file = f"{ROLLUP_DIR}/{name}_{stage}.json"
+        self.s3_rollup_key = f"_rollups/{name}_{stage}.json"
+        self.previous_hashes = {}  # Hash de contenido y ETag de cada objeto según la ejecución anterior
+        self.progress = Progress(self.id)
+        self.metrics = RunMetrics(name, self.id)
+        self.unknown_routes = set()
+        self.newest = None  # Valor incremental más reciente de las páginas confirmadas
+        self.newest_ids = set()  # Ids de los items con ese valor, que la próxima ejecución descarta
+        self.upload_pool = None  # Sube las partes o sella los shards cerrados mientras sigue el scan
+        self.uploads = []
+        self.sealing = {}  # Subidas de los shards abiertos en streaming, por clave del objeto
+        # Los shards cerrados quedan sellados (partes subidas, objeto sin publicar) en pending hasta
+        # que la ejecución termina bien
+        self.pending = []
+
+    # Extracción de los valores tipados de un item a la lista de cada columna, sobre los items crudos
+    # del scan: decodificación directa al tipo de cada columna o, con FAST_DESERIALIZER=false,
+    # TypeDeserializer como boto3.resource
+    @staticmethod
+    def extractor(columns):
+        if FAST_DESERIALIZER:
+            return build_raw_extractor(columns)
+        extract = build_extractor(columns)
+        return lambda item, target: extract(deserialize_item(item), target)
+
+    # Destinos de cada salida (carpeta de la tabla y nombre base de los objetos dentro de
+    # cada partición), para la foto completa o un delta; los agregados siempre se reemplazan
+    def targets(self, delta):
+        targets = {}
+        for output, definition in self.definitions.items():
+            suffix = f"_delta_{RUN_ID}" if delta and output in self.outputs else ""
+            targets[output] = {'prefix': posixpath.dirname(definition['key']),
+                               'object_name': f"{posixpath.basename(definition['key'])}_{stage}{suffix}"}
+        return targets
+
+    # Destino del dead letter de la ejecución: items que no se pudieron rutear o transformar
+    def dead_letter_target(self):
+        return {'prefix': '_dead_letter', 'object_name': f"{self.name}_{stage}_{RUN_ID}"}
+
+    # Archivo local y clave en S3 de un shard de una partición
+    # (p. ej. t_activities/tenant_id=t1/dt=2024-01-31/activities_data_dev.part-00000.csv)
+    @staticmethod
+    def partition_target(target, path, shard=0, extension=None):
+        object_name = f"{target['object_name']}.part-{shard:05d}.{extension or file_extension()}"
+        object_key = '/'.join(part for part in (target['prefix'], path, object_name) if part)
+        return {'file_name': f"/tmp/{object_key}", 'object_key': object_key}
+
+    # Función para armar el ruteo del scan: una salida particionada por cada destino y el dead letter
+    def open_router(self, targets, dead_letter_target, resume=None):
+        sinks = {output: PartitionedWriter(partial(self.open_partition, output, target), self.id,
+                                           resume=resume and resume['sinks'].get(output))
+                 for output, target in targets.items()}
+        dead_letter = ShardedWriter(partial(self.open_dead_letter, dead_letter_target), self.id,
+                                    on_close=self.shard_closed, resume=resume and resume['dead_letter'])
+        return SinkRouter(sinks, dead_letter, self.id)
+
+    # Función para abrir el escritor de una partición de una salida, repartido en shards
+    def open_partition(self, output, target, path, resume=None):
+        return ShardedWriter(partial(self.open_shard, output, target, path), self.id, on_close=self.shard_closed,
+                             resume=resume)
+
+    # Función para abrir el escritor de un shard de una partición
+    def open_shard(self, output, target, path, shard, resume=None):
+        partition_target = self.partition_target(target, path, shard)
+        writer = self.open_target(partition_target, self.schemas[output], resume)
+        return writer, partition_target
+
+    # Función para abrir el escritor de un shard del dead letter (siempre CSV)
+    def open_dead_letter(self, target, shard, resume=None):
+        dead_letter_target = self.partition_target(target, '', shard, csv_extension())
+        writer = self.open_target(dead_letter_target, DEAD_LETTER_SCHEMA, resume, output_format='csv')
+        return writer, dead_letter_target
+
+    # Función para abrir el escritor de un destino
+    def open_target(self, target, schema, resume=None, output_format=OUTPUT_FORMAT):
+        # Con STREAM_TO_S3 el archivo se sube por partes mientras avanza el scan y en /tmp solo queda
+        # lo que todavía no completa una parte; al cerrar el shard la subida queda sellada hasta
+        # que se publica
+        os.makedirs(os.path.dirname(target['file_name']), exist_ok=True)
+        upload = None
+        if STREAM_TO_S3:
+            upload = S3StagedUpload(S3_BUCKET_NAME, target['object_key'], target['file_name'], self.id,
+                                    self.upload_pool, resume=resume and resume.get('upload'), metrics=self.metrics,
+                                    extra_args=upload_args(target['object_key']), defer=True)
+            self.sealing[target['object_key']] = upload
+        return open_writer(target['file_name'], schema, self.id, upload=upload, resume=resume, metrics=self.metrics,
+                           output_format=output_format)
+
+    # Función para extraer y transformar los datos de una página (puede correr en varios hilos a la vez)
+    def extract_data(self, items):
+        with self.metrics.stage('transform'):
+            page = self.transform_page(items)
+        self.metrics.count('transform', items=len(items))
+        return page
+
+    # Los valores se extraen directamente a un lote columnar por salida y partición (una lista por
+    # columna del esquema); la etapa de escritura los manda al router
+    def transform_page(self, items):
+        logger.debug(f"{self.id} - Extracting and transforming {self.name} data.")
+        partitions = {}  # Columnas de la página por (salida, partición)
+        rejected = []
+        newest = None
+        newest_ids = []
+        errors = 0
+        for item in items:
+            columns = None
+            try:
+                if self.route:
+                    store_value = raw_scalar(item, self.route['field'])
+                    output = self.route['values'].get(store_value)
+                    if output is None:
+                        # Cada valor desconocido se registra una sola vez; los items van al dead letter
+                        errors += 1
+                        item_id = raw_scalar(item, self.id_field, 'unknown')
+                        if store_value not in self.unknown_routes:
+                            self.unknown_routes.add(store_value)
+                            logger.error(f"{self.id} - Unknown {self.route['field']} '{store_value}' for item {item_id}.")
+                        rejected.append((item, item_id, f"unknown {self.route['field']} '{store_value}'"))
+                        continue
+                else:
+                    output = next(iter(self.outputs))
+
+                # Los datos extraídos van a la partición correspondiente de la salida
+                key = (output, self.partitioners[output](item))
+                columns = partitions.get(key)
+                if columns is None:
+                    columns = partitions[key] = [[] for _ in self.schemas[output]]
+                length = len(columns[0])
+                self.extractors[output](item, columns)
+
+                if self.incremental_field:
+                    value = raw_scalar(item, self.incremental_field)
+                    if value and (newest is None or value > newest):
+                        newest, newest_ids = value, []
+                    if value and value == newest:
+                        newest_ids.append(raw_scalar(item, self.id_field))
+
+                if LOG_ITEMS:
+                    logger.info(f"{self.id} - Processed {self.name}: {raw_scalar(item, self.id_field, 'unknown')}.")
+            except Exception as e:
+                # Se descartan los valores que el item llegó a agregar antes del error
+                if columns is not None:
+                    for values in columns:
+                        del values[length:]
+                    if not length:
+                        del partitions[key]
+                # Solo los items con error se registran completos, con el item crudo y la traza
+                errors += 1
+                item_id = raw_scalar(item, self.id_field, 'unknown')
+                logger.opt(exception=e).error(f"{self.id} - Error processing item {item_id}: "
+                                              f"{e} | item: {json.dumps(item, default=str)}")
+                rejected.append((item, item_id, f"{type(e).__name__}: {e}"))
+
+        batches = [(output, path, RowBatch(self.schemas[output], columns, len(columns[0])))
+                   for (output, path), columns in partitions.items()]
+        return TransformedPage(len(items), batches, rejected, newest, errors, newest_ids)
+
+    # Función para transformar la página de la entidad en el pool de procesos o en el hilo actual
+    def transform(self):
+        return partial(transform_in_process, self.name) if self.transform_pool is not None else self.extract_data
+
+    # Función para confirmar una página ya entregada a la etapa de escritura (en el orden del scan)
+    def commit_page(self, checkpoint, segment, last_evaluated_key, page):
+        if page.wall is not None:
+            # Transformada en otro proceso: el tiempo se midió allá
+            self.metrics.add_time('transform', page.wall, page.cpu, start=page.started)
+            self.metrics.count('transform', items=page.items)
+        self.progress.page(page.items, page.errors)
+        if self.student_join is not None:
+            self.student_join.add(page.batches)
+        for rollup in self.rollups.values():
+            rollup.add(page.batches)
+        if page.newest and (self.newest is None or page.newest > self.newest):
+            self.newest, self.newest_ids = page.newest, set(page.newest_ids)
+        elif page.newest and page.newest == self.newest:
+            self.newest_ids.update(page.newest_ids)
+        if checkpoint is not None:
+            checkpoint.state['newest'] = self.newest
+            checkpoint.state['newest_ids'] = sorted(self.newest_ids)
+            checkpoint.advance(segment, last_evaluated_key)
+
+    # Función para leer la marca de agua guardada (local y en S3), se usa la más reciente. Devuelve
+    # su valor y los ids de los items con ese valor que ya se exportaron (una marca de agua guardada
+    # sin ids no descarta nada: esos items se vuelven a exportar una vez)
+    def load_watermark(self):
+        watermarks = []
+        try:
+            with open(self.watermark_file) as f:
+                watermarks.append(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"{self.id} - Error reading local watermark {self.watermark_file}: {e}")
+
+        try:
+            response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=self.s3_watermark_key)
+            watermarks.append(json.loads(response['Body'].read()))
+        except s3.exceptions.NoSuchKey:
+            pass
+        except Exception as e:
+            logger.error(f"{self.id} - Error reading watermark from S3 at {self.s3_watermark_key}: {e}")
+
+        if not watermarks:
+            return None, set()
+        creation_date = max(watermark['creation_date'] for watermark in watermarks)
+        return creation_date, {item_id for watermark in watermarks if watermark['creation_date'] == creation_date
+                               for item_id in watermark.get('ids', [])}
+
+    # Función para guardar la marca de agua después de una ejecución exitosa, con los ids de los
+    # items que tienen ese valor
+    def save_watermark(self, creation_date, ids):
+        body = json.dumps({'creation_date': creation_date, 'ids': sorted(ids), 'run_id': RUN_ID})
+        try:
+            os.makedirs(os.path.dirname(self.watermark_file), exist_ok=True)
+            with open(self.watermark_file, "w") as f:
+                f.write(body)
+            s3.put_object(Bucket=S3_BUCKET_NAME, Key=self.s3_watermark_key, Body=body.encode('utf-8'))
+            logger.info(f"{self.id} - Watermark saved: {creation_date}.")
+        except Exception as e:
+            logger.error(f"{self.id} - Error saving watermark: {e}")
+
+    # Función para borrar, una vez subida una nueva foto completa, los deltas anteriores
+    # y los objetos de particiones que ya no aparecen en la foto
+    def delete_stale(self, written):
+        for definition in self.definitions.values():
+            prefix = f"{posixpath.dirname(definition['key'])}/"
+            base_name = f"{posixpath.basename(definition['key'])}_{stage}"
+            try:
+                paginator = s3.get_paginator('list_objects_v2')
+                for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=prefix):
+                    keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])
+                            if obj['Key'] not in written
+                            and posixpath.basename(obj['Key']).startswith((f"{base_name}.", f"{base_name}_delta_"))]
+                    if keys:
+                        s3.delete_objects(Bucket=S3_BUCKET_NAME, Delete={'Objects': keys})
+                        logger.info(f"{self.id} - Deleted {len(keys)} stale object(s) under {prefix}.")
+            except Exception as e:
+                logger.error(f"{self.id} - Error deleting stale objects: {e}")
+
+    # Función para leer los hashes de contenido de la ejecución anterior; antes se guardaba solo el
+    # hash de cada objeto, sin su ETag
+    def load_hashes(self):
+        return {key: entry if isinstance(entry, dict) else {'hash': entry, 'etag': None}
+                for key, entry in self.read_hashes().items()}
+
+    # Función para leer el archivo de hashes (local o, si no está, de S3)
+    def read_hashes(self):
+        try:
+            with open(self.hash_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"{self.id} - Error reading local content hashes {self.hash_file}: {e}")
+
+        try:
+            response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=self.s3_hash_key)
+            return json.loads(response['Body'].read())
+        except s3.exceptions.NoSuchKey:
+            pass
+        except Exception as e:
+            logger.error(f"{self.id} - Error reading content hashes from S3 at {self.s3_hash_key}: {e}")
+        return {}
+
+    # Función para guardar los hashes de los objetos vigentes después de una ejecución exitosa
+    def save_hashes(self, watermark, shards):
+        # Una foto completa reemplaza a todos los objetos anteriores; un delta se agrega a ellos
+        hashes = dict(self.previous_hashes) if watermark else {}
+        hashes.update({shard['object_key']: {'hash': shard['hash'], 'etag': shard.get('etag')} for shard in shards})
+        body = json.dumps(hashes)
+        try:
+            os.makedirs(os.path.dirname(self.hash_file), exist_ok=True)
+            with open(self.hash_file, "w") as f:
+                f.write(body)
+            s3.put_object(Bucket=S3_BUCKET_NAME, Key=self.s3_hash_key, Body=body.encode('utf-8'))
+        except Exception as e:
+            logger.error(f"{self.id} - Error saving content hashes: {e}")
+
+    # Función para preparar los agregados de la ejecución: una foto completa empieza de cero, un delta
+    # suma sobre los agregados guardados y una ejecución reanudada sigue con los de su checkpoint
+    def start_rollups(self, watermark, checkpoint=None):
+        if not self.rollups:
+            return
+        if checkpoint is not None and checkpoint.resumed:
+            state = checkpoint.get('rollups')
+        elif watermark:
+            state = self.load_rollups()
+        else:
+            state = {}
+        if state is None:
+            logger.warning(f"{self.id} - No saved rollups to add this delta to, rollup tables skipped "
+                           f"until the next full snapshot.")
+            self.rollups = {}
+            return
+        for table, rollup in self.rollups.items():
+            rollup.load(state.get(table, []))
+        if checkpoint is not None:
+            checkpoint.track('rollups', self.rollups_state)
+
+    def rollups_state(self):
+        return {table: rollup.state() for table, rollup in self.rollups.items()}
+
+    # Función para leer los agregados de la ejecución anterior (local o, si no está, de S3)
+    def load_rollups(self):
+        try:
+            with open(self.rollup_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"{self.id} - Error reading local rollups {self.rollup_file}: {e}")
+
+        try:
+            response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=self.s3_rollup_key)
+            return json.loads(response['Body'].read())
+        except s3.exceptions.NoSuchKey:
+            pass
+        except Exception as e:
+            logger.error(f"{self.id} - Error reading rollups from S3 at {self.s3_rollup_key}: {e}")
+        return None
+
+    # Función para guardar los agregados después de una ejecución exitosa
+    def save_rollups(self):
+        body = json.dumps(self.rollups_state())
+        try:
+            os.makedirs(os.path.dirname(self.rollup_file), exist_ok=True)
+            with open(self.rollup_file, "w") as f:
+                f.write(body)
+            s3.put_object(Bucket=S3_BUCKET_NAME, Key=self.s3_rollup_key, Body=body.encode('utf-8'))
+        except Exception as e:
+            logger.error(f"{self.id} - Error saving rollups: {e}")
+
+    # Función para escribir las tablas de agregados como salidas más, una vez terminado el scan
+    def write_rollups(self, router):
+        for table, rollup in self.rollups.items():
+            batches = [(table, path, batch) for path, batch in rollup.batches(self.schemas[table])]
+            write_page(router, batches, [], self.metrics)
+            logger.info(f"{self.id} - Rollup {table}: {sum(len(batch) for _, _, batch in batches)} row(s).")
+
+    # Función para saber si un shard tiene el mismo contenido que el objeto actual en S3; siempre se
+    # consulta el objeto, así uno borrado o reemplazado desde la ejecución anterior se vuelve a subir
+    def unchanged(self, target):
+        if not SKIP_UNCHANGED:
+            return False
+        try:
+            response = s3.head_object(Bucket=S3_BUCKET_NAME, Key=target['object_key'])
+        except Exception as e:
+            return self.missing(target, e)
+        return self.same_content(target, response)
+
+    # Función para tratar un error de head_object: un objeto que no existe se sube y uno que no se
+    # pudo consultar, también
+    def missing(self, target, error):
+        if error_code(error) not in ('404', 'NoSuchKey'):
+            logger.warning(f"{self.id} - Error checking s3://{S3_BUCKET_NAME}/{target['object_key']}, "
+                           f"uploading it: {error}")
+        return False
+
+    # Función para comparar un shard con el objeto actual (respuesta de head_object): por el hash de
+    # sus metadatos o, si no lo tiene (subida multipart en streaming), por el hash y el ETag que
+    # registró la ejecución anterior
+    def same_content(self, target, response):
+        previous = self.previous_hashes.get(target['object_key'], {})
+        same = (response.get('Metadata', {}).get('content-hash') == target['hash']
+                or (previous.get('hash') == target['hash'] and previous.get('etag') == response['ETag']))
+        if same:
+            target['etag'] = response['ETag']
+        return same
+
+    # Argumentos de subida del objeto de un shard, con su hash de contenido en los metadatos
+    @staticmethod
+    def object_args(target):
+        return {**upload_args(target['object_key']), 'Metadata': {'content-hash': target['hash']}}
+
+    # Función para sellar un shard cerrado: sus partes se suben sin publicar el objeto (en streaming
+    # ya están en S3) o se descarta si el objeto actual tiene el mismo contenido
+    def seal(self, target):
+        try:
+            if self.unchanged(target):
+                target['skipped'] = True
+                if 'upload' in target:
+                    abort_sealed(S3_BUCKET_NAME, target, self.id)
+                    del target['upload']
+                else:
+                    logger.info(f"{self.id} - Content unchanged, skipping upload to S3 at {target['object_key']}.")
+            elif 'upload' not in target:
+                target['upload'] = seal_file(S3_BUCKET_NAME, target['object_key'], target['file_name'], self.id,
+                                             metrics=self.metrics, extra_args=self.object_args(target))
+        except Exception as e:
+            logger.error(f"{self.id} - Error sealing {target['object_key']}: {e}")
+            return False
+        return True
+
+    # Función para publicar un shard sellado
+    def publish(self, target):
+        if target.get('skipped') or target.get('published'):
+            return True
+        try:
+            complete_sealed(S3_BUCKET_NAME, target, self.id, metrics=self.metrics, extra_args=self.object_args(target))
+            target['etag'] = target['upload']['etag']
+        except Exception as e:
+            logger.error(f"{self.id} - Error publishing {target['object_key']}: {e}")
+            return False
+        target['published'] = True
+        del target['upload']
+        return True
+
+    # Función para publicar en paralelo los shards sellados; devuelve False si alguno falló
+    def publish_all(self, targets):
+        with UploadPool(name='publish') as pool:
+            results = [future.result() for future in [pool.submit(self.publish, target) for target in targets]]
+        if not all(results):
+            logger.error(f"{self.id} - {results.count(False)} shard(s) could not be published.")
+        return all(results)
+
+    # Función para descartar las subidas de una ejecución que falló: las de los shards sellados sin
+    # publicar y las que quedaron abiertas en los shards en curso, salvo las que usa el checkpoint
+    # guardado (saved: subida de cada objeto que retoma la próxima ejecución)
+    def discard_uploads(self, saved):
+        for target in self.pending:
+            if 'upload' not in target:
+                continue
+            key, upload_id = target['object_key'], target['upload']['upload_id']
+            try:
+                if key not in saved:
+                    abort_sealed(S3_BUCKET_NAME, target, self.id, reason='run failed')
+                elif upload_id not in (None, saved[key]):
+                    # El checkpoint retoma el objeto desde sus archivos de staging: solo sobra la subida
+                    abort_upload(S3_BUCKET_NAME, key, upload_id)
+            except Exception as e:
+                logger.error(f"{self.id} - Error discarding upload to {key}: {e}")
+        for key, upload in self.sealing.items():
+            if upload.upload_id not in (None, saved.get(key)):
+                upload.abort()
+
+    # Cada shard cerrado se sella en paralelo con el resto del scan y queda pendiente de publicación.
+    # Al reanudar un checkpoint los shards cerrados vuelven a llegar acá: los que ya se sellaron
+    # solo vuelven a pending
+    def shard_closed(self, target):
+        upload = self.sealing.pop(target['object_key'], None)
+        if upload is not None:
+            target['upload'] = upload.sealed
+        if target.get('published') or target.get('skipped'):
+            return
+        self.pending.append(target)
+        if upload is not None or 'upload' not in target:
+            self.uploads.append(self.upload_pool.submit(self.seal, target))
+
+    # Antes de cada checkpoint se terminan de escribir las páginas en vuelo y de sellar los shards
+    # cerrados, así el estado registra cada shard cerrado con su subida sellada
+    def barrier(self, pipeline):
+        pipeline.drain()
+        for upload in self.uploads:
+            upload.result()
+
+    # Función para saber si las subidas de un checkpoint siguen ahí: las de los shards en curso en
+    # streaming deben seguir abiertas y las de los shards sellados, abiertas o ya publicadas
+    def uploads_available(self, checkpoint):
+        for partition_state in sharded_states(checkpoint.state):
+            for target in partition_state.get('closed', []):
+                if 'upload' in target and not sealed_available(S3_BUCKET_NAME, target):
+                    logger.warning(f"{self.id} - Upload of {target['object_key']} is gone.")
+                    return False
+            current = (partition_state.get('current') or {}).get('upload') or {}
+            if current.get('upload_id') is not None and not upload_exists(S3_BUCKET_NAME, current['key'],
+                                                                          current['upload_id']):
+                logger.warning(f"{self.id} - Multipart upload to {current['key']} is gone.")
+                return False
+        return True
+
+    # Función para guardar el manifiesto de la ejecución con los shards escritos y los del dead letter
+    def save_manifest(self, watermark, newest, shards, dead_letters):
+        manifest = {
+            'entity': self.name,
+            'stage': stage,
+            'run_id': RUN_ID,
+            'delta': bool(watermark),
+            'watermark': watermark,
+            'newest': newest,
+            'format': file_extension(),
+            'rows': sum(shard['rows'] for shard in shards),
+            'bytes': sum(shard['bytes'] for shard in shards),
+            'skipped': sum(1 for shard in shards if shard.get('skipped')),
+            'shards': [{'key': shard['object_key'], 'rows': shard['rows'], 'bytes': shard['bytes'], 'hash': shard['hash'],
+                        'skipped': shard.get('skipped', False)} for shard in shards],
+            'dead_letter': [{'key': shard['object_key'], 'rows': shard['rows'], 'bytes': shard['bytes']}
+                            for shard in dead_letters],
+        }
+        try:
+            s3.put_object(Bucket=S3_BUCKET_NAME, Key=self.s3_manifest_key,
+                          Body=json.dumps(manifest, indent=2).encode('utf-8'), ContentType='application/json')
+            logger.info(f"{self.id} - Manifest with {len(shards)} shard(s) saved to {self.s3_manifest_key}.")
+            return True
+        except Exception as e:
+            logger.error(f"{self.id} - Error saving manifest: {e}")
+            return False
+
+    # Opciones del scan: solo los atributos que se exportan y, en una ejecución incremental, solo
+    # los items desde la marca de agua. Los que tienen el mismo valor que la marca de agua se vuelven
+    # a leer (varios items pueden compartirlo) y unexported() descarta los que ya se exportaron. Las
+    # tablas no tienen un índice por fecha de creación, así que sigue siendo un scan completo filtrado
+    def scan_options(self, watermark):
+        options = {
+            'ProjectionExpression': self.projection['ProjectionExpression'],
+            'ExpressionAttributeNames': dict(self.projection['ExpressionAttributeNames']),
+        }
+        if watermark:
+            logger.info(f"{self.id} - Incremental run, reading items created since {watermark}.")
+            options['FilterExpression'] = '#incremental >= :watermark'
+            options['ExpressionAttributeNames']['#incremental'] = self.incremental_field
+            options['ExpressionAttributeValues'] = {':watermark': {'S': watermark}}
+        return options
+
+    # Función para descartar de una página los items con el valor de la marca de agua que ya se exportaron
+    def unexported(self, items, watermark, exported):
+        return [item for item in items if raw_scalar(item, self.incremental_field) != watermark
+                or raw_scalar(item, self.id_field) not in exported]
+
+    # Función para recorrer las páginas del scan sin los items ya exportados de la marca de agua
+    def skip_exported(self, pages, watermark, exported):
+        try:
+            for segment, items, last_evaluated_key in pages:
+                yield segment, self.unexported(items, watermark, exported), last_evaluated_key
+        finally:
+            pages.close()
+
+    # Función para cerrar una ejecución exitosa: manifiesto, publicación de los shards, limpieza de la
+    # foto anterior y marca de agua. Hasta acá ningún shard de la ejecución es visible en S3, así
+    # Glue/Athena nunca ven una foto a medias; devuelve False si no se pudo publicar
+    def finish(self, watermark, newest, shards, dead_letters=()):
+        skipped = [shard for shard in shards if shard.get('skipped')]
+        for shard in skipped:
+            self.metrics.count('skipped', items=1, size=shard['bytes'])
+        logger.info(f"{self.id} - Skipped {len(skipped)} of {len(shards)} upload(s) with unchanged content.")
+        if not self.save_manifest(watermark, newest, shards, dead_letters) or not self.publish_all(self.pending):
+            return False
+        self.save_hashes(watermark, shards)
+        if self.rollups:
+            self.save_rollups()
+        # Una foto completa reemplaza a los deltas y a las particiones anteriores
+        if not watermark:
+            self.delete_stale({shard['object_key'] for shard in shards})
+        if self.incremental_field and newest:
+            self.save_watermark(newest, self.newest_ids)
+        return True
+
+    # Función que ejecuta la ingesta y deja el resumen de métricas, también si falla
+    def run(self):
+        success = False
+        try:
+            success = self.ingest()
+            return success
+        finally:
+            self.metrics.write(success, self.progress)
+
+    # Función que orquesta el proceso de la entidad
+    def ingest(self):
+        logger.info(f"{self.id} - Process started.")
+        incremental = INCREMENTAL and self.incremental_field is not None
+
+        # Checkpoint para reanudar el scan si el proceso se interrumpe (solo para CSV)
+        checkpoint = None
+        if CHECKPOINT_ENABLED and OUTPUT_FORMAT == 'csv':
+            checkpoint = ScanCheckpoint(self.checkpoint_file,
+                                        {'table': self.table_name, 'stream': STREAM_TO_S3, 'incremental': incremental,
+                                         'layout': 'hive-sharded-staged', 'compression': COMPRESSION,
+                                         'rollups': sorted(self.rollups)},
+                                        self.id)
+            # Si alguna subida del checkpoint ya no existe (p. ej. la borró una regla de ciclo de vida)
+            # no se puede continuar: se vuelve a leer la tabla completa
+            if checkpoint.resumed and not self.uploads_available(checkpoint):
+                logger.warning(f"{self.id} - Checkpoint uploads are no longer available, starting from scratch.")
+                checkpoint.reset()
+
+        # En modo incremental se escribe un delta junto a la foto base con los items nuevos;
+        # al reanudar se conservan la marca de agua y los destinos de la ejecución interrumpida
+        if checkpoint is not None and checkpoint.resumed:
+            watermark, exported = checkpoint.get('watermark'), set(checkpoint.get('exported', []))
+        else:
+            watermark, exported = self.load_watermark() if incremental else (None, set())
+        scan_options = self.scan_options(watermark)
+        # La tabla student-360 solo se arma con fotos completas leídas en esta ejecución
+        if self.student_join is not None and (watermark or (checkpoint is not None and checkpoint.resumed)):
+            self.student_join.invalidate(f"{self.name} is {'a delta' if watermark else 'resumed from a checkpoint'}")
+        self.start_rollups(watermark, checkpoint)
+        self.previous_hashes = self.load_hashes() if SKIP_UNCHANGED else {}
+        targets = self.targets(delta=bool(watermark))
+        dead_letter_target = self.dead_letter_target()
+        if checkpoint is not None:
+            targets = checkpoint.get('targets', targets)
+            dead_letter_target = checkpoint.get('dead_letter', dead_letter_target)
+            checkpoint.state.update({'watermark': watermark, 'exported': sorted(exported), 'targets': targets,
+                                     'dead_letter': dead_letter_target})
+
+        self.newest = checkpoint.get('newest', watermark) if checkpoint is not None else watermark
+        self.newest_ids = set(checkpoint.get('newest_ids', exported) if checkpoint is not None else exported)
+        published = False
+        try:
+            published = self.scan_and_publish(checkpoint, watermark, exported, scan_options, targets,
+                                              dead_letter_target)
+        finally:
+            # Las subidas de una ejecución fallida se descartan, salvo las que usa el checkpoint
+            # guardado, que retoma la próxima ejecución
+            if not published:
+                self.discard_uploads(checkpoint.saved_uploads() if checkpoint is not None else {})
+        if not published:
+            return False
+
+        # La publicación terminó, el checkpoint ya no es necesario
+        if checkpoint is not None:
+            checkpoint.discard()
+
+        self.progress.report(label="Finished")
+        logger.success(f"{self.id} - Data ingestion process completed successfully.")
+        return True
+
+    # Función para escanear la tabla, sellar sus shards y publicarlos si todo terminó bien
+    def scan_and_publish(self, checkpoint, watermark, exported, scan_options, targets, dead_letter_target):
+        with ExitStack() as stack:
+            # Se registra antes que los escritores para que al salir espere el sellado de sus últimos shards
+            self.upload_pool = stack.enter_context(UploadPool())
+            # Un único scan reparte las filas entre las salidas; al cerrar se vacían y sellan en paralelo
+            router = stack.enter_context(self.open_router(
+                targets, dead_letter_target, resume=checkpoint.writer_state(0) if checkpoint is not None else None))
+
+            # Realizar el scan en la tabla DynamoDB; scan, transformación y escritura se solapan en el pipeline
+            pages = scan_table(self.table_name, self.id, scan_options=scan_options, checkpoint=checkpoint,
+                               metrics=self.metrics)
+            if exported:
+                pages = self.skip_exported(pages, watermark, exported)
+            pipeline = PagePipeline(pages, self.transform(), router, partial(self.commit_page, checkpoint), self.id,
+                                    executor=self.transform_pool, metrics=self.metrics)
+            if checkpoint is not None:
+                # El checkpoint se guarda cuando ya se escribieron todas las páginas confirmadas y se
+                # sellaron los shards cerrados
+                checkpoint.attach(router, barrier=partial(self.barrier, pipeline))
+            pipeline.run()
+            # Un checkpoint guardado después de cerrar las salidas ya incluye los agregados
+            if checkpoint is None or not checkpoint.get('sealed'):
+                self.write_rollups(router)
+
+        # Los últimos shards se sellaron al cerrar el router: se registran en el checkpoint antes de
+        # publicar, así una ejecución que se corta a mitad de la publicación la termina al reanudar
+        if checkpoint is not None:
+            checkpoint.state['sealed'] = True
+            try:
+                checkpoint.save()
+            except Exception as e:
+                logger.error(f"{self.id} - {e}, watermark not updated and checkpoint kept for the next run.")
+                return False
+
+        # Los shards se sellaron a medida que se cerraban
+        if not all(upload.result() for upload in self.uploads):
+            logger.error(f"{self.id} - Upload failed, watermark not updated and checkpoint kept for the next run.")
+            return False
+
+        if not self.finish(watermark, self.newest, router.shards(), router.dead_letter.closed):
+            logger.error(f"{self.id} - Publication failed, watermark not updated and checkpoint kept for the next run.")
+            return False
+        return True
+
+
+# Exportación de la tabla student-360 con el resultado del join de sus salidas de origen; se
+# escribe y sube como una foto completa más, con su manifiesto y sus hashes de contenido
+class Student360Ingestion(EntityIngestion):
+    def __init__(self, student_join):
+        super().__init__('student_360', STUDENT_360_ENTITY)
+        self.join = student_join
+
+    def ingest(self):
+        logger.info(f"{self.id} - Process started.")
+        self.previous_hashes = self.load_hashes() if SKIP_UNCHANGED else {}
+        published = False
+        try:
+            published = self.write_and_publish()
+        finally:
+            if not published:
+                self.discard_uploads({})
+        if not published:
+            return False
+
+        self.progress.report(label="Finished")
+        logger.success(f"{self.id} - Data ingestion process completed successfully.")
+        return True
+
+
+    # Función para escribir la tabla, sellar sus shards y publicarlos si todo terminó bien
+    def write_and_publish(self):
+        output = next(iter(self.outputs))
+        with ExitStack() as stack:
+            self.upload_pool = stack.enter_context(UploadPool())
+            router = stack.enter_context(self.open_router(self.targets(delta=False), self.dead_letter_target()))
+            for path, batch in self.join.batches(self.schemas[output]):
+                write_page(router, [(output, path, batch)], [], self.metrics)
+                self.progress.page(len(batch), 0)
+
+        if not all(upload.result() for upload in self.uploads):
+            logger.error(f"{self.id} - Upload failed.")
+            return False
+
+        if not self.finish(None, None, router.shards(), router.dead_letter.closed):
+            logger.error(f"{self.id} - Publication failed.")
+            return False
+        return True
+
+
+# Función para crear el join de la tabla student-360 si está activada y se ingestan todas sus fuentes
+def student_join(names):
+    if not STUDENT_360:
+        return None
+    missing = [name for name in STUDENT_360_ENTITY['sources'] if name not in names]
+    if missing:
+        logger.warning(f"ingesta_{stage}_student_360 - Student 360 table skipped, "
+                       f"missing entities: {', '.join(missing)}.")
+        return None
+    return StudentJoin(f"ingesta_{stage}_student_360")
+
+# El join solo se entrega a las entidades que son fuente de la tabla student-360
+def student_source(join, name):
+    return join if name in STUDENT_360_ENTITY['sources'] else None
+
+# Función para exportar la tabla student-360 una vez que todas sus fuentes terminaron bien
+def build_student_360(join, failed):
+    try:
+        if failed:
+            logger.warning(f"ingesta_{stage}_student_360 - Student 360 table skipped, source ingestion failed.")
+            return True
+        if join.invalid is not None:
+            return True
+        return Student360Ingestion(join).run()
+    except Exception as e:
+        logger.error(f"ingesta_{stage}_student_360 - Ingestion failed: {e}")
+        return False
+    finally:
+        join.close()
+
+
+# Extracción de cada entidad en los procesos del pool de transformación (se arma una vez por proceso)
+_process_transforms = {}
+
+# Función que transforma una página en un proceso del pool; en CSV devuelve los lotes ya codificados
+def transform_in_process(name, items):
+    ingestion = _process_transforms.get(name)
+    if ingestion is None:
+        ingestion = _process_transforms[name] = EntityIngestion(name, ENTITIES[name])
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    page = ingestion.transform_page(items)
+    page.started = start_wall
+    if OUTPUT_FORMAT == 'csv':
+        for _, _, batch in page.batches:
+            batch.encode()
+    page.wall = time.perf_counter() - start_wall
+    page.cpu = time.process_time() - start_cpu
+    return page
+
+# Función para leer las entidades a ingestar desde la línea de comandos
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ingesta de las tablas de DynamoDB a S3.")
+    parser.add_argument('--entities', nargs='+', default=os.getenv('ENTITIES', 'all').split(','),
+                        help=f"Entidades a ingestar: all o una lista de {', '.join(ENTITIES)}.")
+    args = parser.parse_args()
+
+    # Se aceptan tanto nombres separados por espacios como por comas
+    requested = [name for value in args.entities for name in value.split(',') if name]
+    names = list(ENTITIES) if 'all' in requested else requested
+    unknown = [name for name in names if name not in ENTITIES]
+    if unknown:
+        parser.error(f"Unknown entities: {', '.join(unknown)}")
+    return names
+
+# Función principal que ingesta las entidades en paralelo en un único proceso
+def main():
+    names = parse_args()
+    logger.info(f"ingesta_{stage} - Process started for entities: {', '.join(names)}.")
+
+    failed = []
+    join = student_join(names)
+    pool = transform_pool()
+    if pool is not None:
+        logger.info(f"ingesta_{stage} - Transforming pages in {TRANSFORM_WORKERS} process(es).")
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(ENTITY_WORKERS, len(names)))) as executor:
+            futures = {executor.submit(EntityIngestion(name, ENTITIES[name], pool, student_source(join, name)).run): name
+                       for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    if not future.result():
+                        failed.append(name)
+                except Exception as e:
+                    logger.error(f"ingesta_{stage}_{name} - Ingestion failed: {e}")
+                    failed.append(name)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    if join is not None and not build_student_360(join, failed):
+        failed.append('student_360')
+
+    if failed:
+        logger.error(f"ingesta_{stage} - Ingestion failed for: {', '.join(failed)}.")
+        exit(1)
+
+    logger.success(f"ingesta_{stage} - Data ingestion process completed successfully.")
+
+if __name__ == "__main__":
+    main()
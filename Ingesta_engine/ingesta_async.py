@@ -0,0 +1,523 @@
+import asyncio
+import io
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from loguru import logger
+
+from config import (CHECKPOINT_ENABLED, INCREMENTAL, MAX_POOL_CONNECTIONS, OUTPUT_FORMAT, PIPELINE_QUEUE_PAGES,
+                    REGION, S3_BUCKET_NAME, S3_MAX_CONCURRENCY, S3_PART_SIZE, SCAN_MAX_WORKERS, SCAN_QUEUE_SIZE,
+                    SCAN_SEGMENTS, SKIP_UNCHANGED, STREAM_TO_S3, TRANSFORM_WORKERS, stage)
+from entities import ENTITIES
+from ingesta import EntityIngestion, build_student_360, parse_args, student_join, student_source
+from metrics import NO_METRICS
+from pipeline import transform_pool, write_page
+from scan import CapacityLimiter, is_throttling, observe_page, read_budget, segment_count, throttle_delay
+from writers import (DEAD_LETTER_SCHEMA, PartitionedWriter, ShardedWriter, SinkRouter, csv_extension, md5_etag,
+                     multipart_etag, open_writer, upload_args)
+
+# docker run -e STAGE=dev -e CHECKPOINT_ENABLED=false -v C:\Users\LENOVO\.aws:/root/.aws ingesta_engine python ingesta_async.py --entities all
+#
+# Esta variante no guarda checkpoints (un scan interrumpido vuelve a empezar) y se niega a arrancar
+# con CHECKPOINT_ENABLED=true en CSV. Prueba de humo contra moto: python benchmarks/check_async.py
+
+_SEGMENT_DONE = object()  # Marca de fin de un segmento en la cola de páginas
+
+
+# Archivo local de staging donde escriben los escritores (CSV o Parquet) desde el hilo de escritura;
+# entre dos páginas el bucle asyncio lo vacía en una parte cada vez que junta part_size bytes, así en
+# memoria solo están las partes en vuelo. Un shard estacionado (suspend) cierra el archivo y se retoma con otro PartBuffer en la
+# misma posición
+class PartBuffer(io.RawIOBase):
+    def __init__(self, uri, file_name, position=0):
+        super().__init__()
+        self.uri = uri
+        self.file_name = file_name
+        self.position = position
+        self.aborted = False
+        self.suspended = False
+        self.staging = open(file_name, "r+b" if position else "w+b")
+        self.staged = self.staging.seek(0, os.SEEK_END)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        if not self.aborted:
+            self.position += len(data)
+            self.staged += len(data)
+            self.staging.write(data)
+        return len(data)
+
+    def ready(self, part_size, final=False):
+        return not self.aborted and not self.suspended and (self.staged >= part_size or (final and self.staged > 0))
+
+    # Devuelve lo acumulado como una parte y vacía el archivo de staging
+    def take(self):
+        self.staging.seek(0)
+        body = self.staging.read()
+        self.staging.seek(0)
+        self.staging.truncate()
+        self.staged = 0
+        return body
+
+    def checkpoint(self):
+        self.staging.flush()
+        return {'position': self.position}
+
+    def suspend(self):
+        self.suspended = True
+
+    def close(self):
+        # El archivo sigue abierto hasta sellar la subida, salvo que el shard quede estacionado
+        if self.suspended:
+            self.staging.close()
+        super().close()
+
+    def release(self):
+        self.staging.close()
+        try:
+            os.remove(self.file_name)
+        except FileNotFoundError:
+            pass
+
+    def abort(self):
+        self.aborted = True
+        self.release()
+
+
+# Subida multipart asíncrona: las partes en vuelo de todos los shards de una entidad comparten los
+# lugares de slots (S3_MAX_CONCURRENCY). La subida multipart se inicia con la primera parte; al cerrar
+# el shard la subida queda sellada como la de S3StagedUpload (un shard que no llega a una parte queda
+# en su archivo de staging) y EntityIngestion la publica cuando termina bien la ingesta
+class AsyncMultipartUpload:
+    def __init__(self, s3, bucket, key, staging_path, log_id, slots, part_size=S3_PART_SIZE, metrics=NO_METRICS):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.log_id = log_id
+        self.metrics = metrics
+        self.part_size = part_size
+        self.staging_path = f"{staging_path}.staging-0"  # El nombre que borra remove_staging_files()
+        self.buffer = PartBuffer(f"s3://{bucket}/{key}", self.staging_path)
+        self.slots = slots
+        self.tasks = []
+        self.part_number = 0
+        self.upload_id = None
+
+    # Función para retomar un shard estacionado en la posición de su último checkpoint
+    def reopen(self, resume):
+        self.buffer = PartBuffer(self.buffer.uri, self.staging_path, resume['position'])
+        return self.buffer
+
+    async def start(self):
+        response = await self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, **upload_args(self.key))
+        self.upload_id = response['UploadId']
+        logger.info(f"{self.log_id} - Started multipart upload to {self.buffer.uri}.")
+
+    async def send_ready(self, final=False):
+        # Fallar pronto si alguna parte anterior ya falló
+        for task in self.tasks:
+            if task.done() and task.exception():
+                raise task.exception()
+        if not self.buffer.ready(self.part_size, final):
+            return
+        # La parte se lee del archivo recién cuando hay un lugar libre para subirla
+        await self.slots.acquire()
+        try:
+            if self.upload_id is None:
+                await self.start()
+        except BaseException:
+            self.slots.release()
+            raise
+        self.part_number += 1
+        self.tasks.append(asyncio.create_task(self.send_part(self.part_number, self.buffer.take())))
+
+    async def send_part(self, part_number, body):
+        try:
+            start = time.perf_counter()
+            response = await self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                 PartNumber=part_number, Body=body)
+            # Las corrutinas se intercalan en el mismo hilo: solo se mide el tiempo de pared
+            self.metrics.add_time('upload', time.perf_counter() - start, start=start)
+            self.metrics.count('upload', items=1, size=len(body))
+            logger.info(f"{self.log_id} - Uploaded part {part_number} ({len(body)} bytes) to {self.buffer.uri}.")
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    # Función para subir todo salvo el paso que publica el objeto; devuelve el mismo estado que deja
+    # S3StagedUpload.seal(), que luego publica complete_sealed()
+    async def seal(self):
+        if self.upload_id is None:
+            self.buffer.staging.flush()
+            self.buffer.staging.seek(0)
+            etag = await asyncio.to_thread(md5_etag, self.buffer.staging)
+            self.buffer.staging.close()
+            sealed = {'upload_id': None, 'parts': [], 'file_name': self.staging_path, 'etag': etag}
+        else:
+            await self.send_ready(final=True)
+            parts = list(await asyncio.gather(*self.tasks))
+            self.buffer.release()
+            sealed = {'upload_id': self.upload_id, 'parts': parts, 'file_name': None, 'etag': multipart_etag(parts)}
+        logger.info(f"{self.log_id} - Upload to {self.buffer.uri} sealed, pending publication.")
+        return sealed
+
+    async def abort(self, unchanged=False):
+        self.buffer.abort()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.upload_id is None:
+            return
+        try:
+            await self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            if unchanged:
+                logger.info(f"{self.log_id} - Multipart upload to {self.buffer.uri} discarded, content unchanged.")
+            else:
+                logger.error(f"{self.log_id} - Multipart upload to {self.buffer.uri} aborted.")
+        except Exception as e:
+            logger.error(f"{self.log_id} - Error aborting multipart upload to {self.buffer.uri}: {e}")
+
+
+# Ingesta asíncrona de una entidad: usa la misma definición y extracción de filas
+# que EntityIngestion, pero el scan y la subida se hacen con clientes asyncio
+class AsyncEntityIngestion:
+    def __init__(self, name, dynamodb, s3, transform_pool=None, student_join=None):
+        self.ingestion = EntityIngestion(name, ENTITIES[name], transform_pool, student_join)
+        self.id = self.ingestion.id
+        self.table_name = self.ingestion.table_name
+        self.dynamodb = dynamodb
+        self.s3 = s3
+        self.uploads = {}  # Subidas de los shards abiertos, por clave del objeto
+        self.upload_slots = asyncio.Semaphore(S3_MAX_CONCURRENCY)  # Partes en vuelo de toda la entidad
+        self.closed = []  # Shards que cerró el hilo de escritura y el bucle todavía no mandó a sellar
+        self.sealing = []  # Sellado en segundo plano de los shards cerrados: (subida, tarea)
+
+    # Función para abrir el escritor de una partición, repartido en shards
+    def open_partition(self, output, target, path, resume=None):
+        return ShardedWriter(partial(self.open_shard, output, target, path), self.id, on_close=self.shard_closed)
+
+    # Función para abrir el escritor de un shard de una partición
+    def open_shard(self, output, target, path, shard, resume=None):
+        partition_target = self.ingestion.partition_target(target, path, shard)
+        writer = self.open_target(partition_target, self.ingestion.schemas[output], resume)
+        return writer, partition_target
+
+    # Función para abrir el escritor de un shard del dead letter (siempre CSV)
+    def open_dead_letter(self, target, shard, resume=None):
+        dead_letter_target = self.ingestion.partition_target(target, '', shard, csv_extension())
+        writer = self.open_target(dead_letter_target, DEAD_LETTER_SCHEMA, resume, output_format='csv')
+        return writer, dead_letter_target
+
+    # Función para abrir un escritor: con STREAM_TO_S3 sobre un archivo de staging que se sube por
+    # partes a S3, donde un shard estacionado (resume) sigue en la misma subida; sin streaming, sobre
+    # el archivo local de EntityIngestion, que se sella entero al cerrarse
+    def open_target(self, target, schema, resume=None, **kwargs):
+        if not STREAM_TO_S3:
+            return self.ingestion.open_target(target, schema, resume, **kwargs)
+        if resume:
+            upload = self.uploads[target['object_key']]
+            buffer = upload.reopen(resume['upload'])
+        else:
+            os.makedirs(os.path.dirname(target['file_name']), exist_ok=True)
+            upload = AsyncMultipartUpload(self.s3, S3_BUCKET_NAME, target['object_key'], target['file_name'], self.id,
+                                          self.upload_slots, metrics=self.ingestion.metrics)
+            self.uploads[target['object_key']] = upload
+            buffer = upload.buffer
+        return open_writer(target['file_name'], schema, self.id, upload=buffer, resume=resume,
+                           metrics=self.ingestion.metrics, **kwargs)
+
+    # Los escritores corren en el hilo de escritura: un shard cerrado solo se anota ahí y el bucle
+    # lo manda a sellar (seal_closed) cuando vuelve la escritura
+    def shard_closed(self, target):
+        self.closed.append(target)
+
+    # Cada shard cerrado se sella en una tarea aparte mientras sigue el scan y queda pendiente de
+    # publicación hasta que la ingesta termina bien, como en EntityIngestion
+    def seal_closed(self):
+        closed, self.closed = self.closed, []
+        for target in closed:
+            upload = self.uploads.pop(target['object_key'], None)
+            self.ingestion.pending.append(target)
+            self.sealing.append((upload, asyncio.create_task(self.seal(upload, target))))
+
+    # Función para sellar un shard cerrado; si su contenido no cambió desde la ejecución anterior la
+    # subida se descarta. Sin streaming (upload None) el archivo local se sella con el cliente síncrono
+    async def seal(self, upload, target):
+        if upload is None:
+            if not await asyncio.to_thread(self.ingestion.seal, target):
+                raise RuntimeError(f"Error sealing {target['object_key']}")
+        elif await self.unchanged(target):
+            target['skipped'] = True
+            await upload.abort(unchanged=True)
+        else:
+            target['upload'] = await upload.seal()
+
+    # Igual que EntityIngestion.unchanged, consultando el objeto con el cliente asyncio
+    async def unchanged(self, target):
+        if not SKIP_UNCHANGED:
+            return False
+        try:
+            response = await self.s3.head_object(Bucket=S3_BUCKET_NAME, Key=target['object_key'])
+        except Exception as e:
+            return self.ingestion.missing(target, e)
+        return self.ingestion.same_content(target, response)
+
+    # Función para obtener la descripción de la tabla (tamaño y capacidad) con DescribeTable
+    async def describe_table(self):
+        try:
+            return (await self.dynamodb.describe_table(TableName=self.table_name))['Table']
+        except Exception as e:
+            logger.error(f"{self.id} - Error describing table {self.table_name}, using a single segment and default capacity: {e}")
+            return {}
+
+    # Función para leer una página respetando el limitador y reintentando ante throttling
+    async def scan_page(self, scan_kwargs, limiter):
+        attempt = 0
+        while True:
+            reserved = 0
+            while limiter is not None:
+                reserved, delay = limiter.reserve()
+                if reserved is not None:
+                    break
+                await asyncio.sleep(delay)
+            try:
+                start = time.perf_counter()
+                response = await self.dynamodb.scan(TableName=self.table_name, ReturnConsumedCapacity='TOTAL', **scan_kwargs)
+                observe_page(self.ingestion.metrics, response, time.perf_counter() - start)
+            except Exception as e:
+                if not is_throttling(e, attempt):
+                    raise
+                if limiter is not None:
+                    limiter.throttled(reserved)
+                attempt += 1
+                await asyncio.sleep(throttle_delay(attempt))
+                continue
+            if limiter is not None:
+                retried = response.get('ResponseMetadata', {}).get('RetryAttempts', 0) > 0
+                limiter.consume(response.get('ConsumedCapacity', {}).get('CapacityUnits', 0), reserved, retried)
+            return response
+
+    # Generador asíncrono de páginas: cada segmento se pagina en su propia tarea
+    # y deja las páginas en una cola acotada
+    async def scan_pages(self, scan_options=None):
+        description = await self.describe_table()
+        budget = read_budget(description, self.table_name, self.id)
+        limiter = CapacityLimiter(budget, self.id, self.table_name) if budget else None
+        total_segments = SCAN_SEGMENTS or segment_count(description, self.table_name, self.id)
+        logger.info(f"{self.id} - Starting DynamoDB scan for {self.table_name} with {total_segments} segment(s).")
+        pages = asyncio.Queue(maxsize=SCAN_QUEUE_SIZE)
+        slots = asyncio.Semaphore(SCAN_MAX_WORKERS)
+
+        async def scan_segment(segment):
+            try:
+                async with slots:
+                    last_evaluated_key = None
+                    while True:
+                        scan_kwargs = dict(scan_options or {})
+                        if total_segments > 1:
+                            scan_kwargs['Segment'] = segment
+                            scan_kwargs['TotalSegments'] = total_segments
+                        if last_evaluated_key:
+                            scan_kwargs['ExclusiveStartKey'] = last_evaluated_key
+                        response = await self.scan_page(scan_kwargs, limiter)
+                        await pages.put(response['Items'])
+                        last_evaluated_key = response.get('LastEvaluatedKey')
+                        if not last_evaluated_key:
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"{self.id} - Error scanning segment {segment}: {e}")
+                await pages.put(e)
+                return
+            await pages.put(_SEGMENT_DONE)
+
+        tasks = [asyncio.create_task(scan_segment(segment)) for segment in range(total_segments)]
+        try:
+            pending = total_segments
+            while pending:
+                page = await pages.get()
+                if page is _SEGMENT_DONE:
+                    pending -= 1
+                    continue
+                if isinstance(page, Exception):
+                    raise page
+                logger.debug(f"{self.id} - Retrieved a batch of items, processing...")
+                yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        logger.info(f"{self.id} - Scan completed for table {self.table_name}.")
+
+    # Función para escribir una página transformada en el hilo de escritura, mandar a sellar los shards
+    # que cerró y enviar las partes de los buffers ya completas
+    async def write_transformed(self, writer, router, transformed):
+        page = await transformed
+        await asyncio.get_running_loop().run_in_executor(writer, write_page, router, page.batches, page.rejected,
+                                                         self.ingestion.metrics)
+        self.ingestion.commit_page(None, None, None, page)
+        self.seal_closed()
+        await asyncio.gather(*(upload.send_ready() for upload in self.uploads.values()))
+
+    # Función que ejecuta la ingesta y deja el resumen de métricas, también si falla
+    async def run(self):
+        success = False
+        try:
+            success = await self.ingest()
+            return success
+        finally:
+            self.ingestion.metrics.write(success, self.ingestion.progress)
+
+    # Función que orquesta el proceso de la entidad: scan → transformación → subida
+    async def ingest(self):
+        ingestion = self.ingestion
+        logger.info(f"{self.id} - Process started (asyncio).")
+        incremental = INCREMENTAL and ingestion.incremental_field is not None
+        watermark, exported = await asyncio.to_thread(ingestion.load_watermark) if incremental else (None, set())
+        scan_options = ingestion.scan_options(watermark)
+        if ingestion.student_join is not None and watermark:
+            ingestion.student_join.invalidate(f"{ingestion.name} is a delta")
+        await asyncio.to_thread(ingestion.start_rollups, watermark)
+        if SKIP_UNCHANGED:
+            ingestion.previous_hashes = await asyncio.to_thread(ingestion.load_hashes)
+        targets = ingestion.targets(delta=bool(watermark))
+
+        # Los escritores hacen E/S de disco síncrona: corren en un único hilo de escritura, en el orden
+        # del scan, y el bucle sigue atendiendo el scan y las subidas de todas las entidades. El cierre
+        # de las salidas también va en ese hilo (max_workers=1), el sellado ya es concurrente
+        sinks = {output: PartitionedWriter(partial(self.open_partition, output, target), self.id)
+                 for output, target in targets.items()}
+        dead_letter = ShardedWriter(partial(self.open_dead_letter, ingestion.dead_letter_target()), self.id,
+                                    on_close=self.shard_closed)
+        router = SinkRouter(sinks, dead_letter, self.id, max_workers=1)
+        ingestion.newest, ingestion.newest_ids = watermark, set(exported)
+        pages = self.scan_pages(scan_options)
+        # Las páginas se transforman en hilos o en el pool de procesos (a lo sumo PIPELINE_QUEUE_PAGES en
+        # vuelo) para que el bucle siga atendiendo el scan y las subidas
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=TRANSFORM_WORKERS, thread_name_prefix=f"{self.id}_transform")
+        writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.id}_write")
+        transform = ingestion.transform()
+        in_flight = deque()
+        try:
+            while True:
+                # Tiempo que la transformación espera la siguiente página del scan
+                start = time.perf_counter()
+                try:
+                    items = await pages.__anext__()
+                except StopAsyncIteration:
+                    break
+                ingestion.metrics.add_time('scan', time.perf_counter() - start, start=start)
+                if exported:
+                    items = ingestion.unexported(items, watermark, exported)
+
+                in_flight.append(loop.run_in_executor(ingestion.transform_pool or executor, transform, items))
+                if len(in_flight) >= max(PIPELINE_QUEUE_PAGES, TRANSFORM_WORKERS):
+                    await self.write_transformed(writer, router, in_flight.popleft())
+            while in_flight:
+                await self.write_transformed(writer, router, in_flight.popleft())
+            await loop.run_in_executor(writer, ingestion.write_rollups, router)
+
+            await loop.run_in_executor(writer, router.close)
+            self.seal_closed()
+            await asyncio.gather(*(task for _, task in self.sealing))
+        except BaseException:
+            # Los escritores se abortan cuando termina la escritura en curso
+            await asyncio.to_thread(writer.shutdown)
+            router.abort()
+            # Se abortan las subidas abiertas y las de shards cerrados que no llegaron a sellarse; el
+            # sellado de un archivo local corre en un hilo y se espera
+            for upload, task in self.sealing:
+                if upload is not None:
+                    task.cancel()
+            results = await asyncio.gather(*(task for _, task in self.sealing), return_exceptions=True)
+            unsealed = [upload for (upload, _), result in zip(self.sealing, results)
+                        if upload is not None and isinstance(result, BaseException)]
+            await asyncio.gather(*(upload.abort() for upload in [*self.uploads.values(), *unsealed]),
+                                 return_exceptions=True)
+            await asyncio.to_thread(ingestion.discard_uploads, {})
+            raise
+        finally:
+            for transformed in in_flight:
+                transformed.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+            writer.shutdown(wait=False)
+            await pages.aclose()
+
+        # Los shards se publican recién después del manifiesto; si algo falla se descartan los que
+        # quedaron sin publicar y la marca de agua no avanza
+        published = False
+        try:
+            published = await asyncio.to_thread(ingestion.finish, watermark, ingestion.newest, router.shards(),
+                                                 dead_letter.closed)
+        finally:
+            if not published:
+                await asyncio.to_thread(ingestion.discard_uploads, {})
+        if not published:
+            logger.error(f"{self.id} - Publication failed, watermark not updated.")
+            return False
+        ingestion.progress.report(label="Finished")
+
+        logger.success(f"{self.id} - Data ingestion process completed successfully.")
+        return True
+
+
+# Función para ingestar todas las entidades sobre los mismos clientes asíncronos
+async def run_entities(names):
+    session = get_session()
+    config = AioConfig(max_pool_connections=MAX_POOL_CONNECTIONS)
+    join = student_join(names)
+    pool = transform_pool()
+    try:
+        async with session.create_client('dynamodb', region_name=REGION, config=config) as dynamodb, \
+                session.create_client('s3', region_name=REGION, config=config) as s3:
+            entities = [AsyncEntityIngestion(name, dynamodb, s3, pool, student_source(join, name)) for name in names]
+            results = await asyncio.gather(*(entity.run() for entity in entities), return_exceptions=True)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    failed = []
+    for name, result in zip(names, results):
+        if isinstance(result, BaseException):
+            logger.error(f"ingesta_{stage}_{name} - Ingestion failed: {result}")
+            failed.append(name)
+        elif not result:
+            failed.append(name)
+
+    # La tabla student-360 se escribe y sube con el cliente síncrono, fuera del bucle
+    if join is not None and not await asyncio.to_thread(build_student_360, join, failed):
+        failed.append('student_360')
+    return failed
+
+# Función principal de la variante asyncio
+def main():
+    names = parse_args()
+    # Sin checkpoints un scan interrumpido vuelve a empezar: no se arranca si se pidió poder reanudarlo
+    if CHECKPOINT_ENABLED and OUTPUT_FORMAT == 'csv':
+        logger.error(f"ingesta_{stage} - The asyncio variant cannot resume from a checkpoint, "
+                     f"set CHECKPOINT_ENABLED=false to run it.")
+        exit(1)
+    logger.info(f"ingesta_{stage} - Async process started for entities: {', '.join(names)}.")
+
+    failed = asyncio.run(run_entities(names))
+    if failed:
+        logger.error(f"ingesta_{stage} - Ingestion failed for: {', '.join(failed)}.")
+        exit(1)
+
+    logger.success(f"ingesta_{stage} - Data ingestion process completed successfully.")
+
+if __name__ == "__main__":
+    main()
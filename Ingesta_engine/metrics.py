@@ -0,0 +1,226 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+from config import METRICS_DIR, stage
+
+# Límites (segundos) del histograma de latencia de las páginas del scan
+PAGE_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Métricas de la ejecución de una entidad: tiempo de pared y de CPU, items y bytes
+# por etapa, histograma de latencia de páginas y RCU consumidas. Etapas:
+#   dynamodb  - pedidos Scan (tiempo acumulado de todos los segmentos)
+#   scan      - espera del consumidor por la siguiente página
+#   transform - construcción de filas; write - escritura en las particiones
+#   encode    - codificación CSV/Parquet (y compresión)
+#   upload    - subida a S3 (archivo completo o partes de la subida multipart)
+# Las etapas anidadas se descuentan de la etapa que las contiene, así que el
+# tiempo de 'write' no incluye el de 'encode'. Con el pipeline las etapas corren
+# en hilos distintos y sus tiempos se solapan: wall_seconds es la suma de lo que
+# midió cada hilo o corrutina (p. ej. las partes que se suben a la vez) y
+# elapsed_seconds el lapso entre el primer inicio y el último fin de la etapa.
+class RunMetrics:
+    def __init__(self, entity, log_id):
+        self.entity = entity
+        self.log_id = log_id
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.steps = {}
+        self.spans = {}  # Primer inicio y último fin de cada etapa (perf_counter)
+        self.page_buckets = [0] * (len(PAGE_LATENCY_BUCKETS) + 1)
+        self.page_latency_sum = 0.0
+        self.pages = 0
+        self.consumed_rcu = 0.0
+        self.started = time.time()
+        self.started_wall = time.perf_counter()
+
+    def step(self, name):
+        step = self.steps.get(name)
+        if step is None:
+            step = self.steps[name] = {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0, 'bytes': 0}
+        return step
+
+    def span(self, name, start, end):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [start, end]
+        else:
+            span[0] = min(span[0], start)
+            span[1] = max(span[1], end)
+
+    @contextmanager
+    def stage(self, name):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        frame = [0.0, 0.0]  # Tiempo de pared y de CPU de las etapas anidadas
+        stack.append(frame)
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.thread_time() - start_cpu
+            stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            with self.lock:
+                step = self.step(name)
+                step['wall_seconds'] += wall - frame[0]
+                step['cpu_seconds'] += cpu - frame[1]
+                self.span(name, start_wall, start_wall + wall)
+
+    def count(self, name, items=0, size=0):
+        with self.lock:
+            step = self.step(name)
+            step['items'] += items
+            step['bytes'] += size
+
+    # Tiempo medido por fuera de stage(), p. ej. en corrutinas que se intercalan en un mismo hilo
+    # o en otro proceso; start (perf_counter, reloj monótono común a los procesos) ubica el lapso
+    def add_time(self, name, wall, cpu=0.0, start=None):
+        with self.lock:
+            step = self.step(name)
+            step['wall_seconds'] += wall
+            step['cpu_seconds'] += cpu
+            if start is not None:
+                self.span(name, start, start + wall)
+
+    # Función para medir el tiempo que el consumidor espera cada elemento de un iterador
+    def timed(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    return
+            yield value
+
+    def observe_page(self, latency, consumed_rcu, items, size):
+        now = time.perf_counter()
+        with self.lock:
+            index = next((i for i, bound in enumerate(PAGE_LATENCY_BUCKETS) if latency <= bound),
+                         len(PAGE_LATENCY_BUCKETS))
+            self.page_buckets[index] += 1
+            self.page_latency_sum += latency
+            self.pages += 1
+            self.consumed_rcu += consumed_rcu
+            step = self.step('dynamodb')
+            step['wall_seconds'] += latency
+            step['items'] += items
+            step['bytes'] += size
+            self.span('dynamodb', now - latency, now)
+
+    def summary(self, success, progress=None):
+        with self.lock:
+            duration = time.perf_counter() - self.started_wall
+            steps = {}
+            for name, step in self.steps.items():
+                span = self.spans.get(name)
+                steps[name] = dict(step, elapsed_seconds=span[1] - span[0] if span else 0.0)
+            upload = steps.get('upload', {})
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(PAGE_LATENCY_BUCKETS + ('+Inf',), self.page_buckets):
+                cumulative += count
+                buckets.append({'le': bound, 'count': cumulative})
+            return {
+                'entity': self.entity,
+                'stage': stage,
+                'success': success,
+                'started_at': self.started,
+                'duration_seconds': duration,
+                'items': progress.items if progress else 0,
+                'errors': progress.errors if progress else 0,
+                'steps': steps,
+                'pages': {'count': self.pages, 'latency_sum_seconds': self.page_latency_sum, 'latency_buckets': buckets},
+                'consumed_rcu': self.consumed_rcu,
+                'consumed_rcu_per_second': self.consumed_rcu / duration if duration else 0,
+                # Throughput sobre el lapso de la etapa; la latencia de cada subida (parte u objeto) va aparte
+                'upload_bytes_per_second': upload['bytes'] / upload['elapsed_seconds'] if upload.get('elapsed_seconds') else 0,
+                'upload_latency': {'count': upload.get('items', 0), 'sum_seconds': upload.get('wall_seconds', 0.0)},
+            }
+
+    # Función para escribir el resumen de la ejecución en JSON y en formato textfile de Prometheus
+    def write(self, success, progress=None):
+        summary = self.summary(success, progress)
+        base_name = f"{METRICS_DIR}/{self.entity}_{stage}"
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            write_atomic(f"{base_name}.json", json.dumps(summary, indent=2))
+            write_atomic(f"{base_name}.prom", prometheus_text(summary))
+            logger.info(f"{self.log_id} - Metrics written to {base_name}.json and {base_name}.prom.")
+        except Exception as e:
+            logger.error(f"{self.log_id} - Error writing metrics: {e}")
+        return summary
+
+
+# Métricas vacías para cuando no se mide (misma interfaz que RunMetrics)
+class NullMetrics:
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, items=0, size=0):
+        pass
+
+    def add_time(self, name, wall, cpu=0.0, start=None):
+        pass
+
+    def timed(self, iterable, name):
+        return iterable
+
+    def observe_page(self, latency, consumed_rcu, items, size):
+        pass
+
+NO_METRICS = NullMetrics()
+
+
+# Función para escribir un archivo de forma atómica (el recolector nunca lee uno a medias)
+def write_atomic(path, content):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+# Función para convertir el resumen al formato textfile de Prometheus (node_exporter)
+def prometheus_text(summary):
+    labels = f'entity="{summary["entity"]}",env="{summary["stage"]}"'
+    lines = [
+        '# TYPE ingesta_run_success gauge',
+        f'ingesta_run_success{{{labels}}} {int(summary["success"])}',
+        '# TYPE ingesta_run_timestamp_seconds gauge',
+        f'ingesta_run_timestamp_seconds{{{labels}}} {summary["started_at"]:.3f}',
+        '# TYPE ingesta_run_duration_seconds gauge',
+        f'ingesta_run_duration_seconds{{{labels}}} {summary["duration_seconds"]:.6f}',
+        '# TYPE ingesta_items gauge',
+        f'ingesta_items{{{labels}}} {summary["items"]}',
+        '# TYPE ingesta_errors gauge',
+        f'ingesta_errors{{{labels}}} {summary["errors"]}',
+        '# TYPE ingesta_consumed_rcu gauge',
+        f'ingesta_consumed_rcu{{{labels}}} {summary["consumed_rcu"]:.3f}',
+        '# TYPE ingesta_upload_bytes_per_second gauge',
+        f'ingesta_upload_bytes_per_second{{{labels}}} {summary["upload_bytes_per_second"]:.3f}',
+        '# TYPE ingesta_upload_latency_seconds summary',
+        f'ingesta_upload_latency_seconds_sum{{{labels}}} {summary["upload_latency"]["sum_seconds"]:.6f}',
+        f'ingesta_upload_latency_seconds_count{{{labels}}} {summary["upload_latency"]["count"]}',
+    ]
+    for metric in ('wall_seconds', 'elapsed_seconds', 'cpu_seconds', 'items', 'bytes'):
+        lines.append(f'# TYPE ingesta_step_{metric} gauge')
+        for name, step in sorted(summary['steps'].items()):
+            lines.append(f'ingesta_step_{metric}{{{labels},step="{name}"}} {step[metric]}')
+    pages = summary['pages']
+    lines.append('# TYPE ingesta_page_latency_seconds histogram')
+    for bucket in pages['latency_buckets']:
+        lines.append(f'ingesta_page_latency_seconds_bucket{{{labels},le="{bucket["le"]}"}} {bucket["count"]}')
+    lines.append(f'ingesta_page_latency_seconds_sum{{{labels}}} {pages["latency_sum_seconds"]:.6f}')
+    lines.append(f'ingesta_page_latency_seconds_count{{{labels}}} {pages["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,206 @@
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from config import PIPELINE_QUEUE_PAGES, TRANSFORM_MODE, TRANSFORM_WORKERS, WRITE_WORKERS
+from metrics import NO_METRICS
+
+_DONE = object()  # Marca de fin en las colas del pipeline
+
+
+# Resultado de transformar una página: lotes de filas ruteados (salida, partición, RowBatch), items
+# que van al dead letter (item, id, motivo), valor incremental más reciente y cantidad de errores. Si
+# se transformó en otro proceso, started, wall y cpu traen el tiempo medido allá para sumarlo a las métricas
+class TransformedPage:
+    def __init__(self, items, batches, rejected, newest, errors, newest_ids=()):
+        self.items = items
+        self.batches = batches
+        self.rejected = rejected
+        self.newest = newest
+        self.newest_ids = newest_ids  # Ids de los items con el valor incremental newest
+        self.errors = errors
+        self.started = None
+        self.wall = None
+        self.cpu = None
+
+
+# Función para crear el pool de procesos de transformación (None con TRANSFORM_MODE=thread).
+# Los procesos se inician con 'spawn': no heredan los hilos ni los locks del proceso principal
+def transform_pool():
+    if TRANSFORM_MODE != 'process':
+        return None
+    return ProcessPoolExecutor(max_workers=TRANSFORM_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+# Función para escribir en el router los lotes y los rechazos de una página transformada
+def write_page(router, batches, rejected, metrics=NO_METRICS):
+    with metrics.stage('write'):
+        for output, path, batch in batches:
+            router.write(output, path, batch)
+        if rejected:
+            router.reject(rejected)
+    metrics.count('write', items=sum(len(batch) for _, _, batch in batches) + len(rejected))
+
+
+# Pipeline de una entidad en tres etapas unidas por colas acotadas:
+#   scan      - un hilo recorre las páginas (el scan paralelo ya reparte los segmentos en SCAN_MAX_WORKERS)
+#   transform - transform(items) en transform_workers hilos (o en el pool de procesos executor, que
+#               no se cierra al terminar), con a lo sumo queue_pages páginas en vuelo
+#   write     - write_workers hilos; cada partición (salida, ruta) la escribe siempre el mismo worker
+#               y el dead letter el primero, así ningún escritor se comparte entre hilos
+# Cuando una cola se llena la etapa anterior espera (backpressure). Las páginas se confirman en el
+# orden del scan con commit(segment, key, page) desde el hilo que llama a run(); drain() espera a
+# que se escriba todo lo confirmado, p. ej. antes de guardar el checkpoint.
+class PagePipeline:
+    def __init__(self, pages, transform, router, commit, log_id, transform_workers=TRANSFORM_WORKERS,
+                 write_workers=WRITE_WORKERS, queue_pages=PIPELINE_QUEUE_PAGES, executor=None, metrics=NO_METRICS):
+        self.pages = pages
+        self.transform = transform
+        self.router = router
+        self.commit = commit
+        self.log_id = log_id
+        self.transform_workers = transform_workers
+        self.executor = executor
+        self.max_in_flight = max(queue_pages, transform_workers)
+        self.in_flight = deque()  # (segmento, LastEvaluatedKey, futuro) de las páginas en transformación
+        self.metrics = metrics
+        self.scanned = queue.Queue(maxsize=queue_pages)
+        self.write_queues = [queue.Queue(maxsize=queue_pages) for _ in range(write_workers)]
+        self.owners = {}  # Worker de escritura de cada partición
+        self.stop = threading.Event()
+        self.error = None
+
+    # Función para dejar un elemento en una cola acotada; devuelve False si el pipeline se detuvo
+    def put(self, target, value):
+        while not self.stop.is_set():
+            try:
+                target.put(value, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # Función para esperar la siguiente página del scan; si otra etapa falló se propaga su error
+    def next_page(self):
+        while True:
+            try:
+                return self.scanned.get(timeout=1)
+            except queue.Empty:
+                if self.error is not None:
+                    raise self.error
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    # Etapa de scan: el generador se recorre y se cierra en su propio hilo
+    def scan(self):
+        try:
+            for page in self.pages:
+                if not self.put(self.scanned, page):
+                    break
+        except Exception as e:
+            self.put(self.scanned, e)
+        finally:
+            close = getattr(self.pages, 'close', None)
+            if close is not None:
+                close()
+            self.put(self.scanned, _DONE)
+
+    # Etapa de escritura: si el pipeline se detuvo se descarta lo pendiente sin escribirlo
+    def write(self, index):
+        tasks = self.write_queues[index]
+        while True:
+            task = tasks.get()
+            try:
+                if task is _DONE:
+                    return
+                if not self.stop.is_set():
+                    write_page(self.router, *task, metrics=self.metrics)
+            except Exception as e:
+                self.fail(e)
+            finally:
+                tasks.task_done()
+
+    # Función para repartir los lotes de una página entre los workers de escritura
+    def dispatch(self, page):
+        workers = len(self.write_queues)
+        if workers == 1:
+            tasks = [(page.batches, page.rejected)]
+        else:
+            tasks = [([], page.rejected if index == 0 else []) for index in range(workers)]
+            for output, path, batch in page.batches:
+                owner = self.owners.get((output, path))
+                if owner is None:
+                    owner = self.owners[(output, path)] = len(self.owners) % workers
+                tasks[owner][0].append((output, path, batch))
+        for write_queue, task in zip(self.write_queues, tasks):
+            if (task[0] or task[1]) and not self.put(write_queue, task):
+                raise self.error
+
+    def drain(self):
+        for tasks in self.write_queues:
+            tasks.join()
+        if self.error is not None:
+            raise self.error
+
+    # Función para transformar las páginas del scan y confirmarlas en orden a medida que terminan
+    def feed(self, executor):
+        in_flight = self.in_flight
+        scanning = True
+        while scanning or in_flight:
+            # Se aprovechan los lugares libres con las páginas que ya llegaron; sin páginas en vuelo se espera al scan
+            while scanning and len(in_flight) < self.max_in_flight:
+                try:
+                    if in_flight:
+                        page = self.scanned.get_nowait()
+                    else:
+                        with self.metrics.stage('scan'):
+                            page = self.next_page()
+                except queue.Empty:
+                    break
+                if page is _DONE:
+                    scanning = False
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    segment, items, last_evaluated_key = page
+                    in_flight.append((segment, last_evaluated_key, executor.submit(self.transform, items)))
+            if in_flight:
+                segment, last_evaluated_key, future = in_flight.popleft()
+                transformed = future.result()
+                if self.error is not None:
+                    raise self.error
+                self.dispatch(transformed)
+                self.commit(segment, last_evaluated_key, transformed)
+
+    def run(self):
+        scanner = threading.Thread(target=self.scan, name=f"{self.log_id}_scan", daemon=True)
+        writers = [threading.Thread(target=self.write, args=(index,), name=f"{self.log_id}_write_{index}", daemon=True)
+                   for index in range(len(self.write_queues))]
+        executor = self.executor or ThreadPoolExecutor(max_workers=self.transform_workers,
+                                                       thread_name_prefix=f"{self.log_id}_transform")
+        scanner.start()
+        for writer in writers:
+            writer.start()
+        try:
+            self.feed(executor)
+            self.drain()
+        except BaseException as e:
+            self.fail(e)
+            raise
+        finally:
+            # Detener el scan y esperar a cada etapa antes de que se cierren o suspendan los escritores
+            self.stop.set()
+            for _, _, future in self.in_flight:
+                future.cancel()
+            if executor is not self.executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+            for tasks in self.write_queues:
+                tasks.put(_DONE)
+            for writer in writers:
+                writer.join()
+            scanner.join()
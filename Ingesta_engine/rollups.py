@@ -0,0 +1,74 @@
+from urllib.parse import unquote
+
+from batches import RowBatch
+from entities import HIVE_DEFAULT_PARTITION, to_number
+
+
+# Agregados de una tabla de ROLLUP_TABLES: un total por cada partición de salida y grupo, que se
+# actualiza con los lotes de cada página confirmada de su salida de origen. El estado es chico
+# (un registro por tenant, día y grupo), se guarda en el checkpoint y después de cada ejecución
+class Rollup:
+    def __init__(self, name, spec):
+        self.name = name
+        self.source = spec['source']
+        self.partitions = [p['name'] for p in spec['partition_by']]
+        self.columns = [c['name'] for c in spec['columns']]
+        self.groups = [(c['name'], c['field']) for c in spec['columns'] if c['aggregate'] == 'group']
+        self.measures = [(c['name'], c['aggregate'], c['field']) for c in spec['columns'] if c['aggregate'] != 'group']
+        self.paths = {}  # Partición de salida y valores de la ruta de cada partición de origen
+        self.totals = {}
+
+    def load(self, state):
+        self.totals = {tuple(key): values for key, values in state}
+
+    def state(self):
+        return [[list(key), values] for key, values in self.totals.items()]
+
+    def split_path(self, path):
+        split = self.paths.get(path)
+        if split is None:
+            parts = dict(part.split('=', 1) for part in path.split('/') if part)
+            output_path = '/'.join(f"{name}={parts.get(name, HIVE_DEFAULT_PARTITION)}" for name in self.partitions)
+            split = self.paths[path] = (output_path, parts)
+        return split
+
+    # Valores de un grupo en cada fila del lote: de la ruta de partición o de la columna
+    @staticmethod
+    def group_values(field, parts, batch):
+        if field in parts:
+            value = unquote(parts[field])
+            return [('' if value == HIVE_DEFAULT_PARTITION else value)] * len(batch)
+        return ['' if value is None else str(value) for value in batch.column(field)]
+
+    # Función para sumar los lotes (salida, partición, RowBatch) de una página confirmada
+    def add(self, batches):
+        for output, path, batch in batches:
+            if output != self.source or not len(batch):
+                continue
+            output_path, parts = self.split_path(path)
+            groups = zip(*(self.group_values(field, parts, batch) for _, field in self.groups)) if self.groups \
+                else [()] * len(batch)
+            measures = [(aggregate, None if aggregate == 'count' else batch.column(field))
+                        for _, aggregate, field in self.measures]
+            for position, group in enumerate(groups):
+                key = (output_path, *group)
+                totals = self.totals.get(key)
+                if totals is None:
+                    totals = self.totals[key] = [0] * len(self.measures)
+                for index, (aggregate, values) in enumerate(measures):
+                    totals[index] += 1 if aggregate == 'count' else to_number(values[position])
+
+    # Función que entrega la tabla en un lote por partición, con las filas ordenadas por grupo
+    def batches(self, schema):
+        path = None
+        rows = []
+        for key in sorted(self.totals):
+            if rows and key[0] != path:
+                yield path, RowBatch.from_rows(schema, rows)
+                rows = []
+            path = key[0]
+            values = {name: value for (name, _), value in zip(self.groups, key[1:])}
+            values.update((name, value) for (name, _, _), value in zip(self.measures, self.totals[key]))
+            rows.append([values[name] for name in self.columns])
+        if rows:
+            yield path, RowBatch.from_rows(schema, rows)
@@ -0,0 +1,402 @@
+import json
+import math
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+from loguru import logger
+
+from aws import dynamodb
+from config import (CHECKPOINT_EVERY_PAGES, SCAN_CAPACITY_SHARE, SCAN_MAX_RCU, SCAN_MAX_RETRIES,
+                    SCAN_MAX_SEGMENTS, SCAN_MAX_WORKERS, SCAN_ONDEMAND_RCU, SCAN_QUEUE_SIZE,
+                    SCAN_SEGMENTS, SEGMENT_TARGET_BYTES, SEGMENT_TARGET_ITEMS)
+from metrics import NO_METRICS
+
+_SEGMENT_DONE = object()  # Marca de fin de un segmento en la cola de páginas
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+# Función para calcular el número de segmentos a partir de la descripción de la tabla
+def segment_count(description, table_name, log_id):
+    item_count = description.get('ItemCount', 0)
+    table_size = description.get('TableSizeBytes', 0)
+    segments = min(max(math.ceil(table_size / SEGMENT_TARGET_BYTES),
+                       math.ceil(item_count / SEGMENT_TARGET_ITEMS),
+                       1),
+                   SCAN_MAX_SEGMENTS)
+    logger.info(f"{log_id} - {table_name} has ~{item_count} items ({table_size} bytes), using {segments} segment(s).")
+    return segments
+
+# Función para obtener la descripción de la tabla (tamaño y capacidad) con DescribeTable
+def describe_table(table_name, log_id):
+    try:
+        return dynamodb.describe_table(TableName=table_name)['Table']
+    except Exception as e:
+        logger.error(f"{log_id} - Error describing table {table_name}, using a single segment and default capacity: {e}")
+        return {}
+
+# Función para calcular las RCU/s que puede usar el scan: una fracción de la capacidad
+# provisionada de la tabla (None si no hay límite). Una tabla on-demand, o cuya capacidad no se
+# conoce, no se limita salvo que se fije SCAN_ONDEMAND_RCU: el scan solo se frena ante el throttling
+def read_budget(description, table_name, log_id):
+    if SCAN_MAX_RCU > 0:
+        budget = SCAN_MAX_RCU
+    elif SCAN_CAPACITY_SHARE <= 0:
+        return None
+    else:
+        billing_mode = description.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED')
+        capacity = description.get('ProvisionedThroughput', {}).get('ReadCapacityUnits', 0)
+        if billing_mode == 'PAY_PER_REQUEST' or not capacity:
+            if SCAN_ONDEMAND_RCU <= 0:
+                logger.info(f"{log_id} - Scan of {table_name} not limited (on-demand), backing off only on throttling.")
+                return None
+            capacity = SCAN_ONDEMAND_RCU
+        budget = capacity * SCAN_CAPACITY_SHARE
+    logger.info(f"{log_id} - Scan of {table_name} limited to {budget:.1f} RCU/s.")
+    return budget
+
+
+# Limitador de lectura (token bucket) compartido por todos los segmentos de un scan.
+# Cada página reserva las RCU estimadas y luego descuenta las que informa
+# ReturnConsumedCapacity; el ritmo arranca por debajo del presupuesto, sube mientras
+# no hay throttling y baja a la mitad cuando DynamoDB lo limita.
+class CapacityLimiter:
+    def __init__(self, max_rate, log_id, table_name):
+        self.max_rate = max_rate
+        self.min_rate = max(1.0, max_rate * 0.05)
+        self.rate = max(self.min_rate, max_rate * 0.25)
+        self.log_id = log_id
+        self.table_name = table_name
+        self.tokens = self.rate
+        self.estimate = 1.0  # RCU promedio por página
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.updated = self.increased = self.reported = self.started = time.monotonic()
+        self.consumed = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Reserva capacidad para una página; devuelve las RCU reservadas o el tiempo a esperar
+    def reserve(self):
+        with self.lock:
+            self.refill(time.monotonic())
+            if self.tokens <= 0:
+                return None, -self.tokens / self.rate
+            self.tokens -= self.estimate
+            return self.estimate, 0
+
+    def acquire(self):
+        while not self.stopped.is_set():
+            reserved, delay = self.reserve()
+            if reserved is not None:
+                return reserved
+            self.stopped.wait(delay)
+        return 0
+
+    def stop(self):
+        # Despierta a los segmentos que esperan capacidad cuando el scan termina o falla
+        self.stopped.set()
+
+    def consume(self, units, reserved, throttled=False):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens -= units - reserved
+            self.estimate = 0.8 * self.estimate + 0.2 * max(units, 0.5)
+            self.consumed += units
+            if throttled:
+                self.slow_down(now)
+            elif now - self.increased >= 1 and self.rate < self.max_rate:
+                # Con margen disponible el ritmo sube un 10% del presupuesto por segundo
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+                self.increased = now
+            if now - self.reported >= 30:
+                logger.info(f"{self.log_id} - {self.table_name} scan consuming "
+                            f"{self.consumed / (now - self.started):.1f} RCU/s (limit {self.rate:.1f}/{self.max_rate:.1f}).")
+                self.reported = now
+
+    def throttled(self, reserved):
+        with self.lock:
+            self.tokens += reserved
+            self.slow_down(time.monotonic())
+
+    def slow_down(self, now):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+        self.increased = now
+        logger.info(f"{self.log_id} - {self.table_name} throttled, scan rate lowered to {self.rate:.1f} RCU/s.")
+
+# Función para calcular la espera antes de reintentar una página limitada (exponencial con jitter)
+def throttle_delay(attempt):
+    return random.uniform(0.5, 1) * min(20, 0.1 * 2 ** attempt)
+
+# Función para saber si un error de DynamoDB es de throttling y se puede reintentar
+def is_throttling(error, attempt):
+    return (isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+            and attempt < SCAN_MAX_RETRIES)
+
+# Función para registrar en las métricas la latencia, las RCU y el tamaño de una página
+def observe_page(metrics, response, latency):
+    size = int(response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('content-length', 0))
+    metrics.observe_page(latency, response.get('ConsumedCapacity', {}).get('CapacityUnits', 0),
+                         len(response['Items']), size)
+
+# Función para leer una página respetando el limitador y reintentando ante throttling
+def scan_page(table_name, scan_kwargs, limiter=None, metrics=NO_METRICS):
+    attempt = 0
+    while True:
+        reserved = limiter.acquire() if limiter is not None else 0
+        try:
+            start = time.perf_counter()
+            response = dynamodb.scan(TableName=table_name, ReturnConsumedCapacity='TOTAL', **scan_kwargs)
+            observe_page(metrics, response, time.perf_counter() - start)
+        except Exception as e:
+            if not is_throttling(e, attempt):
+                raise
+            if limiter is not None:
+                limiter.throttled(reserved)
+            attempt += 1
+            time.sleep(throttle_delay(attempt))
+            continue
+        if limiter is not None:
+            # Los reintentos internos de botocore también indican que la tabla está al límite
+            retried = response.get('ResponseMetadata', {}).get('RetryAttempts', 0) > 0
+            limiter.consume(response.get('ConsumedCapacity', {}).get('CapacityUnits', 0), reserved, retried)
+        return response
+
+# Función para recorrer un segmento del scan con paginación
+def scan_segment(table_name, segment, total_segments, scan_options=None, start_key=None, limiter=None,
+                 metrics=NO_METRICS):
+    last_evaluated_key = start_key
+    while True:
+        scan_kwargs = dict(scan_options or {})
+        if total_segments > 1:
+            scan_kwargs['Segment'] = segment
+            scan_kwargs['TotalSegments'] = total_segments
+        if last_evaluated_key:
+            scan_kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+        response = scan_page(table_name, scan_kwargs, limiter, metrics)
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        # Los items se entregan crudos; la decodificación se hace al extraer cada fila
+        yield response['Items'], last_evaluated_key  # Devuelve los elementos de cada página y la clave para continuar
+
+        if not last_evaluated_key:
+            break
+
+# Función para realizar el scan con paginación (secuencial o por segmentos en paralelo).
+# Entrega (segmento, items, LastEvaluatedKey) de cada página; el checkpoint solo se lee para
+# retomar la posición de cada segmento, quien consume lo avanza cuando la página termina de
+# escribirse (p. ej. el pipeline, que la procesa más tarde)
+def scan_table(table_name, log_id, total_segments=None, scan_options=None, checkpoint=None, metrics=NO_METRICS):
+    description = describe_table(table_name, log_id)
+    budget = read_budget(description, table_name, log_id)
+    limiter = CapacityLimiter(budget, log_id, table_name) if budget else None
+
+    # Al reanudar se mantiene la división en segmentos del checkpoint
+    if checkpoint is not None and checkpoint.get('total_segments'):
+        total_segments = checkpoint.get('total_segments')
+    total_segments = total_segments or SCAN_SEGMENTS or segment_count(description, table_name, log_id)
+    if checkpoint is not None:
+        checkpoint.state['total_segments'] = total_segments
+    logger.info(f"{log_id} - Starting DynamoDB scan for {table_name} with {total_segments} segment(s).")
+
+    starts = {segment: checkpoint.segment_position(segment) if checkpoint is not None else (False, None)
+              for segment in range(total_segments)}
+
+    if total_segments == 1:
+        done, start_key = starts[0]
+        if not done:
+            for items, last_evaluated_key in scan_segment(table_name, 0, 1, scan_options, start_key, limiter, metrics):
+                logger.debug(f"{log_id} - Retrieved a batch of items, processing...")
+                yield 0, items, last_evaluated_key
+        logger.info(f"{log_id} - Scan completed for table {table_name}.")
+        return
+
+    # Cada worker recorre un segmento y deja sus páginas en una cola acotada;
+    # el hilo que consume el generador las procesa de a una
+    pages = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    stop = threading.Event()
+    segments = [segment for segment, (done, _) in starts.items() if not done]
+
+    def put_page(page):
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def worker(segment):
+        try:
+            start_key = starts[segment][1]
+            for items, last_evaluated_key in scan_segment(table_name, segment, total_segments, scan_options,
+                                                          start_key, limiter, metrics):
+                if stop.is_set():
+                    return
+                put_page((segment, items, last_evaluated_key))
+        except Exception as e:
+            logger.error(f"{log_id} - Error scanning segment {segment}: {e}")
+            put_page(e)
+        finally:
+            put_page(_SEGMENT_DONE)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(SCAN_MAX_WORKERS, len(segments)))) as executor:
+        for segment in segments:
+            executor.submit(worker, segment)
+        try:
+            pending = len(segments)
+            while pending:
+                page = pages.get()
+                if page is _SEGMENT_DONE:
+                    pending -= 1
+                    continue
+                if isinstance(page, Exception):
+                    raise page
+                logger.debug(f"{log_id} - Retrieved a batch of items, processing...")
+                yield page
+        finally:
+            stop.set()
+            if limiter is not None:
+                limiter.stop()
+
+    logger.info(f"{log_id} - Scan completed for table {table_name}.")
+
+
+# Checkpoint del scan: LastEvaluatedKey de cada segmento junto con la posición de
+# cada escritor (offset del archivo o partes ya subidas de la subida multipart)
+class ScanCheckpoint:
+    def __init__(self, path, run_options, log_id, every_pages=CHECKPOINT_EVERY_PAGES):
+        self.path = path
+        self.log_id = log_id
+        self.every_pages = every_pages
+        self.writers = []
+        self.barrier = None
+        self.snapshots = {}
+        self.pages = 0
+        self.run_options = run_options
+        self.state = self.load(run_options)
+        self.resumed = self.state is not None
+        if self.state is None:
+            self.reset()
+
+    def load(self, run_options):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"{self.log_id} - Error reading checkpoint {self.path}, starting from scratch: {e}")
+            return None
+
+        # Solo se reanuda si la ejecución es equivalente y los archivos locales siguen ahí
+        if state.get('run_options') != run_options:
+            logger.info(f"{self.log_id} - Checkpoint {self.path} belongs to a different run configuration, starting from scratch.")
+            return None
+        for partition_state in sharded_states(state):
+            # Los shards cerrados sin streaming se sellan o publican desde /tmp al reanudar
+            if not run_options.get('stream'):
+                for shard in partition_state.get('closed', []):
+                    if not os.path.exists(shard['file_name']):
+                        logger.info(f"{self.log_id} - Shard {shard['file_name']} is missing, starting from scratch.")
+                        return None
+            # En streaming el shard en curso sigue en su archivo de staging, sin streaming en /tmp
+            current = partition_state.get('current') or {}
+            current = current.get('upload') or current
+            file_name = current.get('file_name')
+            if 'offset' in current and (not os.path.exists(file_name) or os.path.getsize(file_name) < current['offset']):
+                logger.info(f"{self.log_id} - Output {file_name} is missing or truncated, starting from scratch.")
+                return None
+        logger.info(f"{self.log_id} - Resuming from checkpoint {self.path}.")
+        return state
+
+    # Función para descartar el estado cargado y empezar de cero con el mismo archivo
+    def reset(self):
+        self.state = {'run_options': self.run_options, 'segments': {}, 'writers': []}
+        self.resumed = False
+
+    def get(self, name, default=None):
+        return self.state.get(name, default)
+
+    def writer_state(self, index):
+        writers = self.state.get('writers', [])
+        return writers[index] if index < len(writers) else None
+
+    # barrier() se llama antes de cada guardado para que los escritores terminen las páginas en vuelo
+    def attach(self, *writers, barrier=None):
+        self.writers = list(writers)
+        self.barrier = barrier
+        for writer in writers:
+            writer.resumable = True
+
+    # snapshot() se guarda en el estado con el nombre dado cada vez que se guarda el checkpoint
+    def track(self, name, snapshot):
+        self.snapshots[name] = snapshot
+
+    def segment_position(self, segment):
+        position = self.state['segments'].get(str(segment))
+        if position is None:
+            return False, None
+        if position == 'done':
+            return True, None
+        return False, position
+
+    def advance(self, segment, last_evaluated_key):
+        # Las claves del cliente de bajo nivel ya están en formato JSON de DynamoDB
+        self.state['segments'][str(segment)] = last_evaluated_key or 'done'
+        self.pages += 1
+        if self.pages % self.every_pages == 0:
+            self.save()
+
+    def save(self):
+        # Los escritores vuelcan lo pendiente antes de registrar su posición
+        if self.barrier is not None:
+            self.barrier()
+        self.state['writers'] = [writer.checkpoint() for writer in self.writers]
+        for name, snapshot in self.snapshots.items():
+            self.state[name] = snapshot()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+    # Subida multipart (o None si todavía no llega a una parte) de cada objeto que usa el checkpoint
+    # guardado en disco, por clave: shards cerrados y, en streaming, shards en curso. La próxima
+    # ejecución las retoma
+    def saved_uploads(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if state.get('run_options') != self.run_options:
+            return {}
+        uploads = {}
+        for partition_state in sharded_states(state):
+            for shard in partition_state.get('closed', []):
+                uploads[shard['object_key']] = (shard.get('upload') or {}).get('upload_id')
+            current = (partition_state.get('current') or {}).get('upload')
+            if current:
+                uploads[current['key']] = current['upload_id']
+        return uploads
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+            logger.info(f"{self.log_id} - Checkpoint {self.path} discarded.")
+        except FileNotFoundError:
+            pass
+
+
+# Estado de cada partición de cada salida y del dead letter (todos escritores por shards) de un checkpoint
+def sharded_states(state):
+    for writer_state in state.get('writers', []):
+        for sink_state in writer_state.get('sinks', {}).values():
+            yield from sink_state.get('partitions', {}).values()
+        yield writer_state.get('dead_letter') or {}
@@ -0,0 +1,168 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+
+from loguru import logger
+
+from config import STUDENT_360_MAX_KEYS, STUDENT_360_PARTITIONS, STUDENT_360_SPILL_DIR
+from batches import RowBatch
+from entities import STUDENT_360_ENTITY, to_number
+
+ROWS_PER_BATCH = 1000  # Filas por lote al exportar el resultado del join
+
+
+# Hash join de las salidas de origen por (tenant_id, student_id) con memoria acotada. Cada página
+# que confirma una entidad de origen se agrega al estado parcial de sus estudiantes (primer valor,
+# conteo, suma o máximo de cada columna). Con más de max_keys estudiantes en memoria los estados se
+# vuelcan a partitions archivos según el hash de la clave; al exportar, cada archivo se une por
+# separado, así en memoria queda solo una partición del join a la vez.
+class StudentJoin:
+    def __init__(self, log_id, spec=STUDENT_360_ENTITY, max_keys=STUDENT_360_MAX_KEYS,
+                 partitions=STUDENT_360_PARTITIONS, spill_dir=STUDENT_360_SPILL_DIR):
+        self.log_id = log_id
+        self.id_field = spec['id_field']
+        self.sources = spec['sources']
+        self.columns = next(iter(spec['outputs'].values()))['columns']
+        self.aggregates = [c['aggregate'] for c in self.columns]
+        # Columnas que alimenta cada salida de origen: (posición en el estado, agregación, columna)
+        self.updates = {}
+        for index, c in enumerate(self.columns):
+            if c['source'] is not None:
+                self.updates.setdefault(c['source'], []).append((index, c['aggregate'], c['field']))
+        self.bits = {source: 1 << index for index, source in enumerate(self.sources)}
+        self.max_keys = max_keys
+        self.partitions = partitions
+        self.spill_dir = spill_dir
+        self.lock = threading.Lock()
+        self.states = {}
+        self.spill_path = None
+        self.spill_files = None
+        self.spilled = 0
+        self.orphans = 0
+        self.invalid = None
+
+    # El estado de un estudiante guarda un valor por columna y, al final, qué salidas lo tienen
+    def new_state(self):
+        return [0 if aggregate in ('count', 'sum') else None for aggregate in self.aggregates] + [0]
+
+    # Función para agregar los lotes (salida, partición, RowBatch) de una página confirmada
+    def add(self, batches):
+        with self.lock:
+            if self.invalid is not None:
+                return
+            for output, path, batch in batches:
+                updates = self.updates.get(output)
+                if updates is None:
+                    continue
+                # La partición de las salidas de origen empieza por tenant_id=...
+                tenant = path.split('/', 1)[0]
+                columns = [(index, aggregate, batch.column(field) if field else None)
+                           for index, aggregate, field in updates]
+                for position, student_id in enumerate(batch.column(self.id_field)):
+                    key = (tenant, student_id)
+                    state = self.states.get(key)
+                    if state is None:
+                        state = self.states[key] = self.new_state()
+                    state[-1] |= self.bits[output]
+                    for index, aggregate, values in columns:
+                        if aggregate == 'count':
+                            state[index] += 1
+                        elif aggregate == 'sum':
+                            state[index] += to_number(values[position])
+                        elif aggregate == 'max':
+                            value = values[position]
+                            if value and (state[index] is None or value > state[index]):
+                                state[index] = value
+                        elif state[index] is None:
+                            state[index] = values[position]
+            if len(self.states) > self.max_keys:
+                self.spill()
+
+    def merge(self, state, other):
+        for index, aggregate in enumerate(self.aggregates):
+            if aggregate in ('count', 'sum'):
+                state[index] += other[index]
+            elif aggregate == 'max':
+                if other[index] is not None and (state[index] is None or other[index] > state[index]):
+                    state[index] = other[index]
+            elif state[index] is None:
+                state[index] = other[index]
+        state[-1] |= other[-1]
+
+    def partition(self, tenant, student_id):
+        return zlib.crc32(f"{tenant}/{student_id}".encode('utf-8')) % self.partitions
+
+    # Función para volcar los estados en memoria a los archivos de su partición
+    def spill(self):
+        if self.spill_files is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill_path = tempfile.mkdtemp(prefix='join_', dir=self.spill_dir)
+            self.spill_files = [open(os.path.join(self.spill_path, f"part-{index:03d}.jsonl"), "w")
+                                for index in range(self.partitions)]
+        for (tenant, student_id), state in self.states.items():
+            self.spill_files[self.partition(tenant, student_id)].write(json.dumps([tenant, student_id, state]) + '\n')
+        logger.info(f"{self.log_id} - Student 360 join spilled {len(self.states)} student(s) to {self.spill_path}.")
+        self.spilled += len(self.states)
+        self.states = {}
+
+    # Función para descartar el join cuando alguna salida de origen no es una foto completa
+    def invalidate(self, reason):
+        with self.lock:
+            if self.invalid is None:
+                logger.warning(f"{self.log_id} - Student 360 table skipped: {reason}.")
+            self.invalid = reason
+            self.states = {}
+
+    # Función que entrega el resultado del join en lotes de filas de una misma partición (tenant_id=...)
+    def batches(self, schema):
+        if self.spill_files is None:
+            yield from self.emit(self.states, schema)
+        else:
+            self.spill()
+            for spill_file in self.spill_files:
+                spill_file.close()
+            for index in range(self.partitions):
+                states = {}
+                with open(os.path.join(self.spill_path, f"part-{index:03d}.jsonl")) as f:
+                    for line in f:
+                        tenant, student_id, state = json.loads(line)
+                        current = states.get((tenant, student_id))
+                        if current is None:
+                            states[(tenant, student_id)] = state
+                        else:
+                            self.merge(current, state)
+                yield from self.emit(states, schema)
+        self.states = {}
+        if self.orphans:
+            logger.info(f"{self.log_id} - {self.orphans} student id(s) found only in rockies, rewards or activities.")
+
+    def emit(self, states, schema):
+        required = self.bits[self.sources[0]]
+        path = None
+        rows = []
+        for (tenant, student_id), state in sorted(states.items()):
+            if not state[-1] & required:
+                self.orphans += 1
+                continue
+            if rows and (tenant != path or len(rows) >= ROWS_PER_BATCH):
+                yield path, RowBatch.from_rows(schema, rows)
+                rows = []
+            path = tenant
+            row = []
+            for c, aggregate, value in zip(self.columns, self.aggregates, state):
+                if aggregate == 'key':
+                    value = student_id
+                row.append(c['default'] if value is None else value)
+            rows.append(row)
+        if rows:
+            yield path, RowBatch.from_rows(schema, rows)
+
+    def close(self):
+        if self.spill_files is not None:
+            for spill_file in self.spill_files:
+                spill_file.close()
+            shutil.rmtree(self.spill_path, ignore_errors=True)
+            self.spill_files = None
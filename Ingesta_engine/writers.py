@@ -0,0 +1,873 @@
+import csv
+import glob
+import hashlib
+import io
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+from loguru import logger
+
+from aws import s3
+from batches import RowBatch
+from config import (COMPRESSION, COMPRESSION_LEVEL, CSV_BUFFER_ROWS, OUTPUT_FORMAT, PARQUET_ROW_GROUP_ROWS,
+                    PARTITION_MAX_OPEN, S3_MAX_CONCURRENCY, S3_PART_SIZE, SHARD_MAX_BYTES, SHARD_MAX_ROWS)
+from metrics import NO_METRICS
+
+# Extensión que se agrega a los CSV comprimidos con cada códec (Athena elige el códec por la extensión)
+CODEC_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+# Content-Type de los CSV comprimidos: se descargan tal cual están guardados
+CODEC_CONTENT_TYPES = {'gzip': 'application/gzip', 'zstd': 'application/zstd'}
+# Códec de las columnas Parquet según COMPRESSION ('none' mantiene snappy)
+PARQUET_CODECS = {'none': 'snappy', 'gzip': 'gzip', 'zstd': 'zstd'}
+HASH_MASK = (1 << 128) - 1
+# Columnas de los archivos de dead letter: motivo, id y el item crudo en JSON de DynamoDB
+DEAD_LETTER_FIELDS = ['reason', 'id', 'item']
+DEAD_LETTER_SCHEMA = [(name, 'string') for name in DEAD_LETTER_FIELDS]
+
+
+# Subidas a S3 de una ingesta: un único pool de hilos compartido por todos sus shards, con a lo
+# sumo max_concurrency cuerpos (partes u objetos) en memoria o en vuelo entre todas las particiones
+class UploadPool:
+    def __init__(self, max_concurrency=S3_MAX_CONCURRENCY, name='upload'):
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=name)
+
+    # Espera un lugar libre (backpressure para quien escribe) y encola la subida
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+
+
+# Destino binario que sube a S3 a medida que se escribe. Lo escrito se acumula en un archivo local
+# de staging (staging_path.staging-N); al juntar part_size bytes el archivo completo se sube como
+# una parte de la subida multipart, que se crea con la primera parte, y se sigue en un archivo
+# nuevo. Un objeto que nunca llega a una parte se sube al cerrar con un único put_object. Así la
+# memoria no crece con la cantidad de particiones abiertas y el checkpoint solo guarda la subida,
+# las partes y la posición en el archivo de staging, que se conserva hasta el checkpoint siguiente.
+# Con defer=True close() sube todas las partes pero no publica el objeto: deja en sealed lo que
+# necesita complete_sealed() (o abort_sealed()) para hacerlo después, también desde otra ejecución
+class S3StagedUpload(io.RawIOBase):
+    def __init__(self, bucket, key, staging_path, log_id, uploader, part_size=S3_PART_SIZE, resume=None,
+                 metrics=NO_METRICS, extra_args=None, defer=False):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.staging_path = staging_path
+        self.log_id = log_id
+        self.uploader = uploader
+        self.metrics = metrics
+        self.extra_args = extra_args or {}
+        self.uri = f"s3://{bucket}/{key}"
+        self.part_size = part_size
+        self.upload_id = None
+        self.part_number = 0
+        self.position = 0
+        self.futures = []
+        self.aborted = False
+        self.suspended = False
+        self.defer = defer
+        self.sealed = None
+        self.kept = None  # Archivo de staging del último checkpoint
+        self.released = []  # Archivos de checkpoints anteriores, que se borran en el siguiente
+        if resume:
+            # Continuar la subida del checkpoint con sus partes ya subidas y el resto en staging
+            self.upload_id = resume['upload_id']
+            self.part_number = resume['part_number']
+            self.position = resume['position']
+            self.generation = resume['generation']
+            for part in resume['parts']:
+                future = Future()
+                future.set_result(part)
+                self.futures.append(future)
+            self.kept = resume['file_name']
+            self.staging = open(self.kept, "r+b")
+            self.staging.truncate(resume['offset'])
+            self.staging.seek(resume['offset'])
+            self.staged = resume['offset']
+            logger.debug(f"{log_id} - Resuming upload to {self.uri} after part {self.part_number}.")
+        else:
+            self.generation = 0
+            self.staging = open(self.staging_name(), "w+b")
+            self.staged = 0
+
+    def staging_name(self, generation=None):
+        return f"{self.staging_path}.staging-{self.generation if generation is None else generation}"
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        if self.aborted or self.suspended:
+            return len(data)
+        self.position += len(data)
+        self.staged += len(data)
+        self.staging.write(data)
+        if self.staged >= self.part_size:
+            self.send_staged()
+        return len(data)
+
+    # Función para subir el archivo de staging como una parte y seguir en uno nuevo
+    def send_staged(self):
+        if self.upload_id is None:
+            self.upload_id = s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra_args)['UploadId']
+            logger.info(f"{self.log_id} - Started multipart upload to {self.uri}.")
+        self.staging.seek(0)
+        self.upload_part(self.staging.read())
+        self.staging.close()
+        # El archivo del último checkpoint se conserva: una ejecución reanudada vuelve a leerlo
+        if self.staging_name() != self.kept:
+            os.remove(self.staging_name())
+        self.generation += 1
+        self.staging = open(self.staging_name(), "w+b")
+        self.staged = 0
+
+    def upload_part(self, body):
+        # Fallar pronto si alguna parte anterior ya falló
+        for future in self.futures:
+            if future.done() and future.exception():
+                raise future.exception()
+        self.part_number += 1
+        self.futures.append(self.uploader.submit(self.send_part, self.part_number, body))
+
+    def send_part(self, part_number, body):
+        with self.metrics.stage('upload'):
+            response = s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                      PartNumber=part_number, Body=body)
+        self.metrics.count('upload', items=1, size=len(body))
+        logger.info(f"{self.log_id} - Uploaded part {part_number} ({len(body)} bytes) to {self.uri}.")
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def complete(self):
+        if self.upload_id is None:
+            # Objeto más chico que una parte: se sube de una vez desde el archivo de staging
+            self.staging.seek(0)
+            body = self.staging.read()
+            with self.metrics.stage('upload'):
+                s3.put_object(Bucket=self.bucket, Key=self.key, Body=body, **self.extra_args)
+            self.metrics.count('upload', items=1, size=len(body))
+            logger.info(f"{self.log_id} - File uploaded successfully to {self.uri}.")
+            return
+        if self.staged:
+            self.staging.seek(0)
+            self.upload_part(self.staging.read())
+        parts = [future.result() for future in self.futures]
+        s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                     MultipartUpload={'Parts': parts})
+        logger.info(f"{self.log_id} - File uploaded successfully to {self.uri} in {len(parts)} part(s).")
+
+    # Función para subir todo salvo el paso que publica el objeto; etag es el que tendrá el objeto
+    # publicado, con el que se reconoce una publicación que ya ocurrió
+    def seal(self):
+        if self.upload_id is None:
+            self.staging.flush()
+            self.staging.seek(0)
+            self.sealed = {'upload_id': None, 'parts': [], 'file_name': self.staging_name(),
+                           'etag': md5_etag(self.staging)}
+        else:
+            if self.staged:
+                self.staging.seek(0)
+                self.upload_part(self.staging.read())
+            parts = [future.result() for future in self.futures]
+            self.sealed = {'upload_id': self.upload_id, 'parts': parts, 'file_name': None,
+                           'etag': multipart_etag(parts)}
+        logger.info(f"{self.log_id} - Upload to {self.uri} sealed, pending publication.")
+
+    def checkpoint(self):
+        # Espera las partes en vuelo; lo que todavía no llega a una parte queda en el archivo de staging
+        parts = [future.result() for future in self.futures]
+        self.staging.flush()
+        # Un archivo se borra recién cuando ya hay un checkpoint guardado que no lo usa
+        self.remove_files(self.released)
+        self.released = [self.kept] if self.kept not in (None, self.staging_name()) else []
+        self.kept = self.staging_name()
+        return {'key': self.key, 'upload_id': self.upload_id, 'part_number': self.part_number,
+                'position': self.position, 'parts': parts, 'generation': self.generation, 'file_name': self.kept,
+                'offset': self.staged}
+
+    def suspend(self):
+        # Deja la subida abierta y el archivo de staging en disco para continuarla después
+        self.suspended = True
+        if self.upload_id is not None:
+            logger.debug(f"{self.log_id} - Multipart upload to {self.uri} left open for resume.")
+
+    def abort(self):
+        if self.aborted:
+            return
+        self.aborted = True
+        if self.upload_id is None:
+            return
+        try:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            logger.error(f"{self.log_id} - Multipart upload to {self.uri} aborted.")
+        except Exception as e:
+            logger.error(f"{self.log_id} - Error aborting multipart upload to {self.uri}: {e}")
+
+    @staticmethod
+    def remove_files(names):
+        for name in names:
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def remove_staging(self):
+        remove_staging_files(self.staging_path)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self.aborted and not self.suspended:
+                self.seal() if self.defer else self.complete()
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.staging.close()
+            # Un objeto sellado conserva sus archivos hasta publicarse
+            if not self.suspended and self.sealed is None:
+                self.remove_staging()
+            super().close()
+
+
+# ETag del objeto que resulta de un único put_object: MD5 del contenido
+def md5_etag(data):
+    digest = hashlib.md5()
+    for chunk in iter(lambda: data.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return f'"{digest.hexdigest()}"'
+
+# ETag del objeto que resulta de completar una subida multipart: MD5 de los MD5 de sus partes
+def multipart_etag(parts):
+    digest = hashlib.md5(b''.join(bytes.fromhex(part['ETag'].strip('"')) for part in parts))
+    return f'"{digest.hexdigest()}-{len(parts)}"'
+
+def error_code(error):
+    return error.response.get('Error', {}).get('Code') if isinstance(error, ClientError) else None
+
+# Función para saber si una subida multipart sigue abierta
+def upload_exists(bucket, key, upload_id):
+    try:
+        s3.list_parts(Bucket=bucket, Key=key, UploadId=upload_id, MaxParts=1)
+        return True
+    except ClientError as e:
+        if error_code(e) == 'NoSuchUpload':
+            return False
+        raise
+
+# Función para saber si el objeto en S3 es el que publica una subida sellada
+def sealed_published(bucket, target):
+    try:
+        return s3.head_object(Bucket=bucket, Key=target['object_key']).get('ETag') == target['upload']['etag']
+    except ClientError:
+        return False
+
+# Función para saber si una subida sellada todavía se puede publicar (o ya está publicada)
+def sealed_available(bucket, target):
+    sealed = target['upload']
+    if sealed['upload_id'] is not None:
+        available = upload_exists(bucket, target['object_key'], sealed['upload_id'])
+    else:
+        available = os.path.exists(sealed['file_name'])
+    return available or sealed_published(bucket, target)
+
+# Función para publicar el objeto de una subida sellada (target: destino del shard con el estado en 'upload').
+# Es idempotente: si la subida ya no existe o falta el archivo de staging porque el objeto ya se
+# publicó (p. ej. una ejecución anterior se cortó antes de registrarlo), no hace nada
+def complete_sealed(bucket, target, log_id, metrics=NO_METRICS, extra_args=None):
+    sealed = target['upload']
+    key = target['object_key']
+    try:
+        if sealed['upload_id'] is not None:
+            s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=sealed['upload_id'],
+                                         MultipartUpload={'Parts': sealed['parts']})
+            logger.info(f"{log_id} - File uploaded successfully to s3://{bucket}/{key} in {len(sealed['parts'])} part(s).")
+        else:
+            size = os.path.getsize(sealed['file_name'])
+            with metrics.stage('upload'), open(sealed['file_name'], "rb") as data:
+                s3.put_object(Bucket=bucket, Key=key, Body=data, **(extra_args or {}))
+            metrics.count('upload', items=1, size=size)
+            logger.info(f"{log_id} - File uploaded successfully to s3://{bucket}/{key}.")
+    except (ClientError, FileNotFoundError) as e:
+        missing = isinstance(e, FileNotFoundError) or error_code(e) == 'NoSuchUpload'
+        if not missing or not sealed_published(bucket, target):
+            raise
+        logger.info(f"{log_id} - s3://{bucket}/{key} was already published.")
+    remove_staging_files(target['file_name'])
+
+# Función para sellar un archivo local ya escrito (shard cerrado sin STREAM_TO_S3), con el mismo
+# estado que deja S3StagedUpload.seal(): se sube por partes sin completar la subida o, si no llega
+# a una parte, queda en disco para publicarlo con un único put_object
+def seal_file(bucket, key, file_name, log_id, part_size=S3_PART_SIZE, metrics=NO_METRICS, extra_args=None):
+    uri = f"s3://{bucket}/{key}"
+    if os.path.getsize(file_name) < part_size:
+        with open(file_name, "rb") as data:
+            sealed = {'upload_id': None, 'parts': [], 'file_name': file_name, 'etag': md5_etag(data)}
+    else:
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **(extra_args or {}))['UploadId']
+        parts = []
+        try:
+            with open(file_name, "rb") as data:
+                for body in iter(lambda: data.read(part_size), b''):
+                    with metrics.stage('upload'):
+                        response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                  PartNumber=len(parts) + 1, Body=body)
+                    metrics.count('upload', items=1, size=len(body))
+                    parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+        except Exception:
+            try:
+                s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            except Exception as e:
+                logger.error(f"{log_id} - Error aborting multipart upload to {uri}: {e}")
+            raise
+        sealed = {'upload_id': upload_id, 'parts': parts, 'file_name': None, 'etag': multipart_etag(parts)}
+    logger.info(f"{log_id} - Upload to {uri} sealed, pending publication.")
+    return sealed
+
+# Función para abortar una subida multipart (una que ya no existe se da por abortada)
+def abort_upload(bucket, key, upload_id):
+    try:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except ClientError as e:
+        if error_code(e) != 'NoSuchUpload':
+            raise
+
+# Función para descartar una subida sellada sin publicarla (contenido sin cambios o ejecución fallida)
+def abort_sealed(bucket, target, log_id, reason='content unchanged'):
+    sealed = target['upload']
+    if sealed['upload_id'] is not None:
+        abort_upload(bucket, target['object_key'], sealed['upload_id'])
+    remove_staging_files(target['file_name'])
+    logger.info(f"{log_id} - Upload to s3://{bucket}/{target['object_key']} discarded, {reason}.")
+
+# Borra todos los archivos de staging de un objeto, también los de ejecuciones interrumpidas
+def remove_staging_files(staging_path):
+    for name in glob.glob(f"{glob.escape(staging_path)}.staging-*"):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+# Destino binario que comprime lo que recibe (gzip o zstd) y lo pasa a otro destino.
+# end_frame() cierra el miembro gzip / frame zstd en curso: los archivos con varios
+# miembros concatenados siguen siendo válidos, y así cada checkpoint queda en un
+# límite a partir del cual se puede seguir escribiendo al reanudar
+class CompressedStream(io.RawIOBase):
+    def __init__(self, raw, codec, level=COMPRESSION_LEVEL):
+        super().__init__()
+        self.raw = raw
+        self.codec = codec
+        self.level = level
+        self.dirty = True  # Siempre se escribe al menos un frame, aunque el archivo quede vacío
+        self.compressor = self.new_compressor()
+
+    def new_compressor(self):
+        if self.codec == 'gzip':
+            # wbits=31 genera el formato gzip (cabecera con mtime 0, salida reproducible)
+            return zlib.compressobj(self.level or zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 31)
+        import zstandard
+        return zstandard.ZstdCompressor(level=self.level or 3).compressobj()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.dirty = True
+        compressed = self.compressor.compress(bytes(data))
+        if compressed:
+            self.raw.write(compressed)
+        return len(data)
+
+    def end_frame(self):
+        if self.dirty:
+            self.raw.write(self.compressor.flush())
+            self.compressor = self.new_compressor()
+            self.dirty = False
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.end_frame()
+        finally:
+            self.raw.close()
+            super().close()
+
+
+# Escritor CSV que mantiene un único archivo abierto durante toda la ejecución; recibe lotes
+# columnares (RowBatch) con las columnas en el orden de fieldnames
+class CsvWriter:
+    def __init__(self, file_name, fieldnames, log_id, buffer_rows=CSV_BUFFER_ROWS, upload=None, resume=None,
+                 metrics=NO_METRICS, compression=COMPRESSION):
+        self.file_name = file_name if upload is None else upload.uri
+        self.log_id = log_id
+        self.metrics = metrics
+        self.buffer_rows = buffer_rows
+        self.upload = upload
+        self.resumable = False
+        self.batches = []
+        self.pending = 0
+        self.count = resume['count'] if resume else 0
+        if upload is not None:
+            # Las filas se codifican y se entregan directamente a la subida multipart
+            self.raw = upload
+        elif resume:
+            # Al reanudar se descarta lo escrito después del último checkpoint
+            self.raw = open(file_name, "r+b")
+            self.raw.truncate(resume['offset'])
+            self.raw.seek(resume['offset'])
+        else:
+            # Se abre en modo "wb" para truncar el archivo de la ejecución anterior
+            self.raw = open(file_name, "wb")
+        self.compressed = CompressedStream(self.raw, compression) if compression != 'none' else None
+        self.file = io.TextIOWrapper(self.compressed or self.raw, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        if not resume:
+            self.writer.writerow(fieldnames)
+
+    def write(self, batch):
+        self.batches.append(batch)
+        self.pending += len(batch)
+        if self.pending >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.batches:
+            with self.metrics.stage('encode'):
+                for batch in self.batches:
+                    if batch.lines is not None:
+                        # Lote codificado en el pool de procesos: solo se concatenan sus líneas
+                        self.file.write(''.join(batch.lines))
+                    else:
+                        # Las columnas se recorren en paralelo, sin armar una lista por fila
+                        self.writer.writerows(batch.rows())
+            self.metrics.count('encode', items=self.pending)
+            self.count += self.pending
+            self.batches = []
+            self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        logger.info(f"{self.log_id} - Wrote {self.count} rows to {self.file_name}.")
+
+    def size(self):
+        # Bytes ya entregados al destino (no incluye las filas que siguen en el buffer)
+        return self.upload.tell() if self.upload is not None else os.path.getsize(self.file_name)
+
+    def checkpoint(self):
+        self.flush()
+        self.file.flush()
+        if self.compressed is not None:
+            self.compressed.end_frame()
+        if self.upload is not None:
+            return {'count': self.count, 'upload': self.upload.checkpoint()}
+        self.raw.flush()
+        return {'count': self.count, 'file_name': self.file_name, 'offset': self.raw.tell()}
+
+    def abort(self):
+        self.batches = []
+        if self.upload is not None:
+            self.upload.abort()
+        self.file.close()
+
+    def suspend(self):
+        # Ante un error con checkpoint activo se conserva la salida para reanudar
+        self.batches = []
+        if self.upload is not None:
+            self.upload.suspend()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.resumable:
+            self.suspend()
+        elif exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+# Escritor Parquet con columnas tipadas y la misma interfaz que CsvWriter: las columnas de
+# cada lote ya vienen con el tipo del esquema y se agregan tal cual al row group en curso
+class ParquetWriter:
+    def __init__(self, file_name, schema, log_id, buffer_rows=PARQUET_ROW_GROUP_ROWS, upload=None, metrics=NO_METRICS,
+                 compression=COMPRESSION):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.file_name = file_name if upload is None else upload.uri
+        self.log_id = log_id
+        self.metrics = metrics
+        self.buffer_rows = buffer_rows
+        self.upload = upload
+        self.names = [name for name, _ in schema]
+        arrow_types = {'string': pa.string(), 'int': pa.int32(), 'double': pa.float64()}
+        self.schema = pa.schema([(name, arrow_types[column_type]) for name, column_type in schema])
+        self.columns = [[] for _ in self.names]
+        self.pending = 0
+        self.count = 0
+        # Se sobreescribe el archivo de la ejecución anterior o se escribe sobre la subida multipart
+        # Snappy no admite nivel de compresión
+        level = COMPRESSION_LEVEL if compression != 'none' and COMPRESSION_LEVEL else None
+        self.writer = pq.ParquetWriter(upload if upload is not None else file_name, self.schema,
+                                       compression=PARQUET_CODECS[compression], compression_level=level)
+
+    def write(self, batch):
+        for column, values in zip(self.columns, batch.decoded()):
+            column.extend(values)
+        self.pending += len(batch)
+        if self.pending >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with self.metrics.stage('encode'):
+                self.writer.write_table(self.pa.Table.from_arrays(self.columns, schema=self.schema))
+            self.metrics.count('encode', items=self.pending)
+            self.count += self.pending
+            self.columns = [[] for _ in self.names]
+            self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.upload is not None:
+            self.upload.close()
+        logger.info(f"{self.log_id} - Wrote {self.count} rows to {self.file_name}.")
+
+    def size(self):
+        # Los row groups llegan al destino al vaciar el buffer de filas
+        return self.upload.tell() if self.upload is not None else os.path.getsize(self.file_name)
+
+    def abort(self):
+        self.columns = [[] for _ in self.names]
+        self.pending = 0
+        if self.upload is not None:
+            self.upload.abort()
+        self.writer.close()
+        if self.upload is not None:
+            self.upload.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+# Escritor de una partición repartido en shards (part-00000, part-00001, ...): pasa al
+# shard siguiente al llegar a max_rows filas (un lote se parte si hace falta) o a unos max_bytes
+# escritos, que se consultan después de cada lote. open_shard(index, resume)
+# devuelve el escritor y el destino de cada shard, y on_close(target) recibe cada shard cerrado
+# (con sus filas, bytes y hash de contenido) para subirlo o publicarlo mientras el scan continúa.
+# El hash es la suma de los hashes de las filas, así no depende del orden en que llegan las
+# páginas de los segmentos. park() libera el escritor del shard en curso sin cerrarlo: se
+# guarda su posición como en un checkpoint y se reabre con el lote siguiente
+class ShardedWriter:
+    def __init__(self, open_shard, log_id, max_rows=SHARD_MAX_ROWS, max_bytes=SHARD_MAX_BYTES, on_close=None,
+                 resume=None):
+        self.open_shard = open_shard
+        self.log_id = log_id
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.on_close = on_close
+        self.resumable = False
+        self.writer = None
+        self.target = None
+        self.fields = resume.get('fields') if resume else None
+        self.index = resume['shard'] if resume else 0
+        self.rows = resume['rows'] if resume else 0
+        self.row_hashes = int(resume['row_hashes'], 16) if resume else 0
+        self.closed = list(resume['closed']) if resume else []
+        # El shard en curso de un checkpoint queda estacionado hasta que llegue su próximo lote
+        self.parked = resume['current'] if resume else None
+        if resume:
+            # Los shards cerrados antes de la interrupción se vuelven a entregar por si no llegaron a subirse
+            for target in self.closed:
+                self.shard_closed(target)
+
+    def write(self, batch):
+        if self.fields is None:
+            self.fields = ','.join(batch.names())
+        hashes = batch.row_hashes()
+        start = 0
+        while start < len(batch):
+            # El shard siguiente se abre con su primera fila, así nunca queda un shard vacío
+            if self.writer is None:
+                self.unpark()
+            stop = len(batch) if not self.max_rows else min(len(batch), start + self.max_rows - self.rows)
+            self.writer.write(batch if start == 0 and stop == len(batch) else batch.slice(start, stop))
+            self.rows += stop - start
+            self.row_hashes = (self.row_hashes + sum(hashes[start:stop])) & HASH_MASK
+            if (self.max_rows and self.rows >= self.max_rows) or \
+                    (self.max_bytes and self.writer.size() >= self.max_bytes):
+                self.rollover()
+            start = stop
+
+    def content_hash(self):
+        content = f"{self.fields}|{self.rows}|{self.row_hashes:032x}"
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+    def rollover(self):
+        writer, target = self.writer, self.target
+        self.writer = self.target = None
+        target.update(rows=self.rows, hash=self.content_hash())
+        writer.close()
+        target['bytes'] = writer.size()
+        self.closed.append(target)
+        self.index += 1
+        self.rows = 0
+        self.row_hashes = 0
+        self.shard_closed(target)
+
+    def shard_closed(self, target):
+        if self.on_close is not None:
+            self.on_close(target)
+
+    # Función para abrir el shard en curso, retomando el estacionado si lo hay
+    def unpark(self):
+        self.writer, self.target = self.open_shard(self.index, self.parked)
+        self.parked = None
+
+    def park(self):
+        if self.writer is None:
+            return
+        if not hasattr(self.writer, 'checkpoint'):
+            # Un Parquet no se puede retomar: el shard se cierra y la partición sigue en el siguiente
+            self.rollover()
+            return
+        self.parked = self.writer.checkpoint()
+        self.writer.suspend()
+        self.writer = None
+
+    def close(self):
+        if self.writer is None and self.parked is not None:
+            self.unpark()
+        if self.writer is not None:
+            self.rollover()
+
+    def checkpoint(self):
+        current = self.writer.checkpoint() if self.writer is not None else self.parked
+        return {'shard': self.index, 'rows': self.rows, 'fields': self.fields, 'row_hashes': f"{self.row_hashes:032x}",
+                'closed': self.closed, 'current': current}
+
+    def abort(self):
+        # Los shards ya cerrados quedan sellados sin publicar: la ingesta los descarta o, con
+        # checkpoint, los conserva para la ejecución que lo reanude
+        if self.writer is None and self.parked is not None:
+            try:
+                self.unpark()
+            except Exception as e:
+                logger.error(f"{self.log_id} - Error reopening a parked shard to abort it: {e}")
+        if self.writer is not None:
+            self.writer.abort()
+
+    def suspend(self):
+        if self.writer is not None:
+            self.writer.suspend()
+
+
+# Escritor de una salida particionada: reparte los lotes entre particiones Hive
+# (tenant_id=.../dt=...) y abre un escritor por partición con open_partition(path, resume)
+# la primera vez que llega un lote para ella. Cada hilo de escritura mantiene abiertas a lo sumo
+# max_open particiones (el pipeline asigna cada partición siempre al mismo hilo); al pasarse se
+# estaciona la que lleva más tiempo sin lotes, que se reabre cuando le vuelve a llegar uno
+class PartitionedWriter:
+    def __init__(self, open_partition, log_id, max_open=PARTITION_MAX_OPEN, resume=None):
+        self.open_partition = open_partition
+        self.log_id = log_id
+        self.max_open = max_open
+        self.resumable = False
+        self.writers = {}
+        self.recent = {}  # Particiones abiertas por cada hilo, de la menos a la más usada
+        # Al reanudar las particiones del checkpoint se registran con su shard en curso estacionado
+        for path, state in (resume or {}).get('partitions', {}).items():
+            self.writers[path] = self.open_partition(path, state)
+
+    def write(self, path, batch):
+        writer = self.writers.get(path)
+        if writer is None:
+            writer = self.writers[path] = self.open_partition(path)
+        writer.write(batch)
+        if self.max_open:
+            self.touch(path)
+
+    def touch(self, path):
+        recent = self.recent.get(threading.get_ident())
+        if recent is None:
+            recent = self.recent[threading.get_ident()] = OrderedDict()
+        recent[path] = True
+        recent.move_to_end(path)
+        while len(recent) > self.max_open:
+            oldest, _ = recent.popitem(last=False)
+            self.writers[oldest].park()
+
+    # Destinos de los shards ya cerrados de todas las particiones
+    def shards(self):
+        return [target for writer in self.writers.values() for target in writer.closed]
+
+    def close(self):
+        # Si falla el cierre de una partición se descartan las que quedan
+        error = None
+        for writer in self.writers.values():
+            try:
+                if error is None:
+                    writer.close()
+                else:
+                    writer.abort()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        logger.info(f"{self.log_id} - Closed {len(self.writers)} partition(s) in {len(self.shards())} shard(s).")
+
+    def checkpoint(self):
+        return {'partitions': {path: writer.checkpoint() for path, writer in self.writers.items()}}
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+
+    def suspend(self):
+        for writer in self.writers.values():
+            writer.suspend()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.resumable:
+            self.suspend()
+        elif exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+# Etapa de ruteo de un scan: reparte los lotes de filas entre N salidas (sinks), cada una con su
+# escritor, esquema y subida, y manda a dead_letter los items que no se pueden rutear o
+# transformar. Al cerrar, las salidas se vacían y suben en paralelo (max_workers=1 las
+# cierra en orden, p. ej. en la variante asyncio, donde el cierre no debe salir del bucle)
+class SinkRouter:
+    def __init__(self, sinks, dead_letter, log_id, max_workers=None):
+        self.sinks = sinks
+        self.dead_letter = dead_letter
+        self.log_id = log_id
+        self.max_workers = max_workers or len(sinks) + 1
+        self.rejected = 0
+        self.resumable = False
+
+    def writers(self):
+        return [*self.sinks.values(), self.dead_letter]
+
+    def write(self, output, path, batch):
+        self.sinks[output].write(path, batch)
+
+    # Función para mandar al dead letter los items rechazados de una página: (item, id, motivo)
+    def reject(self, rejected):
+        self.rejected += len(rejected)
+        rows = [(reason, item_id, json.dumps(item, default=str)) for item, item_id, reason in rejected]
+        self.dead_letter.write(RowBatch.from_rows(DEAD_LETTER_SCHEMA, rows))
+
+    # Destinos de los shards cerrados de todas las salidas (sin el dead letter)
+    def shards(self):
+        return [target for sink in self.sinks.values() for target in sink.shards()]
+
+    def close(self):
+        if self.max_workers == 1:
+            errors = []
+            for writer in self.writers():
+                try:
+                    if not errors:
+                        writer.close()
+                    else:
+                        writer.abort()
+                except Exception as e:
+                    errors.append(e)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(writer.close) for writer in self.writers()]
+            errors = [future.exception() for future in futures if future.exception()]
+        if errors:
+            raise errors[0]
+        if self.rejected:
+            logger.warning(f"{self.log_id} - {self.rejected} item(s) sent to the dead letter sink.")
+
+    def checkpoint(self):
+        return {'sinks': {output: sink.checkpoint() for output, sink in self.sinks.items()},
+                'dead_letter': self.dead_letter.checkpoint()}
+
+    def abort(self):
+        for writer in self.writers():
+            writer.abort()
+
+    def suspend(self):
+        for writer in self.writers():
+            writer.suspend()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.resumable:
+            self.suspend()
+        elif exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+# Extensión de los CSV según la compresión (p. ej. csv.gz); el dead letter siempre es CSV
+def csv_extension():
+    return f"csv{CODEC_EXTENSIONS.get(COMPRESSION, '')}"
+
+# Función para obtener la extensión de los objetos según el formato y la compresión
+def file_extension():
+    return csv_extension() if OUTPUT_FORMAT == 'csv' else OUTPUT_FORMAT
+
+# Atributos de un objeto en S3 según su extensión: en los CSV, tipo de contenido. Un CSV comprimido
+# se declara como archivo comprimido y no con Content-Encoding, que haría que los clientes HTTP lo
+# descompriman al descargarlo sin cambiarle la extensión .gz / .zst (en Parquet la compresión es interna)
+def upload_args(object_key):
+    if object_key.endswith('.parquet'):
+        return {}
+    if COMPRESSION != 'none':
+        return {'ContentType': CODEC_CONTENT_TYPES[COMPRESSION]}
+    return {'ContentType': 'text/csv'}
+
+# Función para abrir el escritor correspondiente a OUTPUT_FORMAT
+def open_writer(file_name, schema, log_id, upload=None, resume=None, metrics=NO_METRICS, output_format=OUTPUT_FORMAT):
+    if output_format == 'parquet':
+        return ParquetWriter(file_name, schema, log_id, upload=upload, metrics=metrics)
+    return CsvWriter(file_name, [name for name, _ in schema], log_id, upload=upload, resume=resume, metrics=metrics)
@@ -0,0 +1,54 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+from boto3.dynamodb.types import TypeSerializer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Ingesta_engine'))
+
+from entities import ENTITIES, build_extractor, build_raw_extractor, deserialize_item  # noqa: E402
+from synthetic import sample_item  # noqa: E402
+
+# python benchmarks/bench_deserializer.py --items 50000 --repeat 3
+
+_serializer = TypeSerializer()
+
+
+# Función para medir el mejor tiempo de varias pasadas sobre todos los items (cada pasada
+# extrae a columnas nuevas)
+def best_of(repeat, extract, items, size):
+    best = None
+    for _ in range(repeat):
+        columns = [[] for _ in range(size)]
+        start = time.perf_counter()
+        for item in items:
+            extract(item, columns)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara TypeDeserializer (boto3.resource) con la decodificación directa.")
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"{'entity':<30}{'resource (s)':>14}{'raw (s)':>10}{'speedup':>10}")
+    for name, spec in ENTITIES.items():
+        items = [{key: _serializer.serialize(value) for key, value in sample_item(name, i, rng).items()}
+                 for i in range(args.items)]
+        for output in spec['outputs'].values():
+            baseline = build_extractor(output['columns'])
+            fast = build_raw_extractor(output['columns'])
+            size = len(output['columns'])
+            resource_time = best_of(args.repeat, lambda item, columns: baseline(deserialize_item(item), columns),
+                                    items, size)
+            raw_time = best_of(args.repeat, fast, items, size)
+            label = name if len(spec['outputs']) == 1 else f"{name}/{output['key'].split('/')[-1]}"
+            print(f"{label:<30}{resource_time:>14.3f}{raw_time:>10.3f}{resource_time / raw_time:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+ENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Ingesta_engine')
+sys.path.insert(0, ENGINE_DIR)
+
+# Benchmark de punta a punta contra un servidor local de moto (DynamoDB y S3 falsos):
+# carga items sintéticos en las tablas {stage}_t_*, ejecuta cada ingesta en un
+# proceso aparte y reporta items/s, pico de memoria (RSS) y tiempos por etapa.
+#
+# pip install "moto[server]" boto3 loguru pyarrow aiobotocore
+# python benchmarks/bench_ingesta.py --items 100000 --entities students purchasables --output bench.json
+# python benchmarks/bench_ingesta.py --items 100000 --baseline bench.json   # marca regresiones
+# python benchmarks/bench_ingesta.py --items 500000 --transform-workers 1 2 4 8   # escalado con TRANSFORM_MODE=process
+
+STEPS = ('dynamodb', 'scan', 'transform', 'write', 'encode', 'upload')
+ENGINES = {'sync': 'ingesta.py', 'async': 'ingesta_async.py'}
+CREDENTIALS = {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing', 'AWS_SESSION_TOKEN': 'testing',
+               'AWS_DEFAULT_REGION': 'us-east-1'}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark de las ingestas contra DynamoDB/S3 locales (moto).")
+    parser.add_argument('--items', type=int, default=10000, help="Items por tabla (p. ej. 10000 a 5000000)")
+    parser.add_argument('--entities', nargs='+', default=['all'])
+    parser.add_argument('--engine', choices=['sync', 'async', 'both'], default='sync')
+    parser.add_argument('--stage', choices=['dev', 'test', 'prod'], default='dev')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--promo-share', type=float, default=0.5, help="Fracción de productos Promotion")
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--load-workers', type=int, default=8)
+    parser.add_argument('--output', help="Archivo JSON donde guardar los resultados")
+    parser.add_argument('--baseline', help="Resultados anteriores (JSON) contra los que comparar")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Variación tolerada antes de marcar regresión")
+    parser.add_argument('--transform-workers', type=int, nargs='+',
+                        help="Cantidades de procesos de transformación a comparar (TRANSFORM_MODE=process)")
+    return parser.parse_args()
+
+# Función para crear la tabla de una entidad y cargarla con items sintéticos en paralelo
+def load_table(resource, table_name, key, name, count, seed, promo_share, workers):
+    from synthetic import generate
+
+    resource.create_table(TableName=table_name, BillingMode='PAY_PER_REQUEST',
+                          KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}])
+    table = resource.Table(table_name)
+    chunk = -(-count // workers)
+
+    def load_chunk(start):
+        with table.batch_writer() as batch:
+            for item in generate(name, min(chunk, count - start), seed, start, promo_share):
+                batch.put_item(Item=item)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(load_chunk, range(0, count, chunk)))
+    print(f"Loaded {count} items into {table_name} in {time.perf_counter() - start:.1f}s", flush=True)
+
+# Función para leer el pico de memoria residente (VmHWM, en KB) de un proceso desde /proc
+def peak_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+# Función para listar los procesos hijos de pid (p. ej. el pool de transformación) según /proc/<pid>/stat
+def child_pids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # El nombre del proceso va entre paréntesis y puede tener espacios; después vienen estado y ppid
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return children
+
+# Función para esperar a la ingesta muestreando el pico de memoria de su proceso y de sus hijos.
+# Se usa VmHWM de cada proceso y no ru_maxrss de wait4: en Linux el hijo hereda en el fork el pico
+# del proceso padre, que aquí también carga las tablas, y el valor solo serviría para compararlo
+# consigo mismo. Devuelve el pico en KB por pid, o None sin /proc (p. ej. en macOS)
+def wait_sampling_rss(process, interval=0.1):
+    if not os.path.exists('/proc/self/status'):
+        process.wait()
+        return None
+    peaks = {}
+    while process.poll() is None:
+        for pid in [process.pid, *child_pids(process.pid)]:
+            peak = peak_rss_kb(pid)
+            if peak is not None:
+                peaks[pid] = max(peaks.get(pid, 0), peak)
+        time.sleep(interval)
+    return peaks
+
+# Función para ejecutar una ingesta en un proceso aparte y medir su pico de memoria: el del
+# proceso de la ingesta más el de cada proceso del pool de transformación
+def run_engine(engine, name, env, work_dir, stage, transform_workers=None):
+    run_name = engine if transform_workers is None else f"{engine}_p{transform_workers}"
+    metrics_dir = os.path.join(work_dir, 'metrics', run_name, name)
+    run_env = {**env,
+               'LOG_DIR': os.path.join(work_dir, 'logs'),
+               'METRICS_DIR': metrics_dir,
+               'WATERMARK_DIR': os.path.join(work_dir, 'watermarks', run_name, name),
+               'CHECKPOINT_DIR': os.path.join(work_dir, 'checkpoints', run_name, name),
+               'HASH_DIR': os.path.join(work_dir, 'hashes', run_name, name),
+               'HOSTNAME': f"bench_{run_name}_{name}"}
+    if transform_workers is not None:
+        run_env.update({'TRANSFORM_MODE': 'process', 'TRANSFORM_WORKERS': str(transform_workers)})
+    # La variante asyncio no guarda checkpoints y no arranca si están habilitados
+    if engine == 'async':
+        run_env['CHECKPOINT_ENABLED'] = 'false'
+    log_path = os.path.join(work_dir, f"{run_name}_{name}.log")
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, ENGINES[engine], '--entities', name], cwd=ENGINE_DIR,
+                                   env=run_env, stdout=log, stderr=subprocess.STDOUT)
+        peaks = wait_sampling_rss(process)
+    wall = time.perf_counter() - start
+
+    summary = {}
+    try:
+        with open(os.path.join(metrics_dir, f"{name}_{stage}.json")) as f:
+            summary = json.load(f)
+    except OSError:
+        pass
+    items = summary.get('items', 0)
+    return {
+        'entity': name,
+        'engine': engine,
+        'transform_workers': transform_workers,
+        'success': process.returncode == 0 and summary.get('success', False),
+        'items': items,
+        'errors': summary.get('errors', 0),
+        'wall_seconds': wall,
+        'items_per_second': items / wall if wall else 0,
+        # Suma de los picos de cada proceso (la ingesta y su pool), y aparte la parte del pool
+        'peak_rss_mb': sum(peaks.values()) / 1024 if peaks is not None else None,
+        'workers_peak_rss_mb': sum(peak for pid, peak in peaks.items() if pid != process.pid) / 1024
+        if peaks is not None else None,
+        'consumed_rcu': summary.get('consumed_rcu', 0),
+        'steps': {step: values['wall_seconds'] for step, values in summary.get('steps', {}).items()},
+        'log': log_path,
+    }
+
+def print_results(results):
+    header = f"{'entity':<14}{'engine':<7}{'procs':>6}{'items':>10}{'wall (s)':>10}{'items/s':>11}{'RSS (MB)':>10}"
+    print('\n' + header + ''.join(f"{step:>11}" for step in STEPS))
+    for result in results:
+        line = (f"{result['entity']:<14}{result['engine']:<7}{result['transform_workers'] or '-':>6}{result['items']:>10}"
+                f"{result['wall_seconds']:>10.2f}{result['items_per_second']:>11.0f}")
+        line += f"{result['peak_rss_mb']:>10.1f}" if result['peak_rss_mb'] is not None else f"{'-':>10}"
+        line += ''.join(f"{result['steps'].get(step, 0):>11.2f}" for step in STEPS)
+        if not result['success']:
+            line += f"  FAILED (see {result['log']})"
+        print(line)
+
+# Función para mostrar cómo escala el throughput con la cantidad de procesos de transformación
+# (aceleración respecto de la menor cantidad medida y eficiencia por proceso)
+def print_scaling(results):
+    runs = {}
+    for result in results:
+        if result['transform_workers'] and result['success']:
+            runs.setdefault((result['entity'], result['engine']), []).append(result)
+    if not any(len(scaling) > 1 for scaling in runs.values()):
+        return
+    print(f"\nScaling with transform processes ({os.cpu_count()} CPU(s)):")
+    for (entity, engine), scaling in runs.items():
+        scaling.sort(key=lambda result: result['transform_workers'])
+        base = scaling[0]
+        for result in scaling:
+            speedup = result['items_per_second'] / base['items_per_second'] if base['items_per_second'] else 0
+            efficiency = speedup * base['transform_workers'] / result['transform_workers']
+            print(f"{entity:<14}{engine:<7}{result['transform_workers']:>6}{result['items_per_second']:>11.0f} items/s"
+                  f"  x{speedup:.2f}  efficiency {efficiency:.0%}")
+
+# Función para comparar con una ejecución anterior; devuelve la cantidad de regresiones
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {(r['entity'], r['engine'], r.get('transform_workers')): r for r in json.load(f)['results']}
+    regressions = 0
+    print(f"\nCompared with {baseline_path} (threshold {threshold:.0%}):")
+    for result in results:
+        previous = baseline.get((result['entity'], result['engine'], result['transform_workers']))
+        if previous is None or not previous['items_per_second']:
+            continue
+        throughput = result['items_per_second'] / previous['items_per_second'] - 1
+        # Los resultados sin workers_peak_rss_mb midieron la memoria con ru_maxrss y no se comparan
+        rss = 0
+        if result['peak_rss_mb'] and previous.get('peak_rss_mb') and 'workers_peak_rss_mb' in previous:
+            rss = result['peak_rss_mb'] / previous['peak_rss_mb'] - 1
+        regression = throughput < -threshold or rss > threshold
+        regressions += regression
+        print(f"{result['entity']:<14}{result['engine']:<7}{result['transform_workers'] or '-':>6}  "
+              f"items/s {throughput:+7.1%}  RSS {rss:+7.1%}"
+              f"{'  REGRESSION' if regression else ''}")
+    return regressions
+
+def main():
+    args = parse_args()
+    from moto.server import ThreadedMotoServer
+
+    endpoint = f"http://127.0.0.1:{args.port}"
+    env = {**os.environ, **CREDENTIALS, 'STAGE': args.stage, 'AWS_ENDPOINT_URL': endpoint}
+    # Sin capacidad real en moto el límite de RCU solo frenaría el scan
+    env.setdefault('SCAN_CAPACITY_SHARE', '0')
+    env.setdefault('INCREMENTAL', 'false')
+    # Cada motor vuelve a escribir los mismos objetos: sin esto la segunda corrida omitiría las subidas
+    env.setdefault('SKIP_UNCHANGED', 'false')
+    os.environ.update({**CREDENTIALS, 'STAGE': args.stage})
+
+    from config import S3_BUCKET_NAME
+    from entities import ENTITIES
+
+    names = list(ENTITIES) if 'all' in args.entities else args.entities
+    unknown = [name for name in names if name not in ENTITIES]
+    if unknown:
+        sys.exit(f"Unknown entities: {', '.join(unknown)}")
+    engines = list(ENGINES) if args.engine == 'both' else [args.engine]
+
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+    try:
+        config = Config(region_name='us-east-1', max_pool_connections=args.load_workers * 2)
+        boto3.client('s3', endpoint_url=endpoint, config=config).create_bucket(Bucket=S3_BUCKET_NAME)
+        resource = boto3.resource('dynamodb', endpoint_url=endpoint, config=config)
+        for name in names:
+            spec = ENTITIES[name]
+            load_table(resource, f"{args.stage}_{spec['table']}", spec['id_field'], name, args.items, args.seed,
+                       args.promo_share, args.load_workers)
+
+        results = []
+        with tempfile.TemporaryDirectory(prefix='bench_ingesta_') as work_dir:
+            for name in names:
+                for engine in engines:
+                    for transform_workers in args.transform_workers or [None]:
+                        label = f" with {transform_workers} transform process(es)" if transform_workers else ""
+                        print(f"Running {engine} ingestion of {name}{label}...", flush=True)
+                        results.append(run_engine(engine, name, env, work_dir, args.stage, transform_workers))
+            print_results(results)
+            print_scaling(results)
+            failed = [result for result in results if not result['success']]
+            if failed:
+                # Los logs se pierden con el directorio temporal, así que se muestra el final de cada uno
+                for result in failed:
+                    with open(result['log']) as f:
+                        print(f"\n--- {result['log']} ---\n" + ''.join(f.readlines()[-20:]))
+    finally:
+        server.stop()
+
+    if args.output:
+        report = {'config': {'items': args.items, 'seed': args.seed, 'promo_share': args.promo_share,
+                             'stage': args.stage, 'python': platform.python_version(), 'cpus': os.cpu_count(),
+                             'settings': {key: env[key] for key in sorted(env) if key in (
+                                 'OUTPUT_FORMAT', 'COMPRESSION', 'STREAM_TO_S3', 'SCAN_SEGMENTS', 'SCAN_MAX_WORKERS',
+                                 'FAST_DESERIALIZER', 'SCAN_CAPACITY_SHARE', 'CSV_BUFFER_ROWS', 'SKIP_UNCHANGED',
+                                 'TRANSFORM_MODE', 'TRANSFORM_WORKERS', 'WRITE_WORKERS', 'PIPELINE_QUEUE_PAGES',
+                                 'PARTITION_MAX_OPEN', 'S3_MAX_CONCURRENCY')}},
+                  'results': [{key: value for key, value in result.items() if key != 'log'} for result in results]}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    regressions = compare(results, args.baseline, args.threshold) if args.baseline else 0
+    if failed or regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import boto3
+from botocore.config import Config
+
+from bench_ingesta import CREDENTIALS, ENGINE_DIR, load_table
+from check_recovery import verify
+
+# Prueba de humo de la variante asyncio (ingesta_async.py) contra un servidor local de moto: cada
+# escenario ejecuta la ingesta de una entidad en un proceso aparte y verifica que los objetos del
+# manifiesto tienen exactamente las filas de la tabla, sin subidas multipart abiertas, o que una
+# ejecución que falla no deja nada visible en el bucket.
+#
+# pip install "moto[server]" boto3 loguru aiobotocore
+# python benchmarks/check_async.py --items 3000
+#
+# Igual que en check_recovery.py, el servidor acepta partes de --part-size bytes y la ingesta se
+# lanza con ese tamaño de parte, así los shards se suben en varias partes sin generar gigas de datos.
+
+# Lanza la ingesta asyncio con el tamaño de parte de la prueba; los escenarios le agregan hooks
+ENGINE = ("import os, sys, config\n"
+          "config.S3_PART_SIZE = int(os.environ['RECOVERY_PART_SIZE'])\n"
+          "import aws, ingesta_async\n"
+          "{hooks}"
+          "sys.argv = ['ingesta_async.py', *sys.argv[1:]]\n"
+          "ingesta_async.main()\n")
+# Rechaza la escritura del manifiesto (cliente síncrono): la ejecución falla antes de publicar los shards
+FAIL_MANIFEST = ("def fail_manifest(params, **kwargs):\n"
+                 "    if params['Key'].startswith('_manifests/'):\n"
+                 "        raise RuntimeError('manifest refused by the test')\n"
+                 "aws.s3.meta.events.register('provide-client-params.s3.PutObject', fail_manifest)\n")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prueba de humo de la ingesta asyncio contra moto.")
+    parser.add_argument('--items', type=int, default=3000)
+    parser.add_argument('--entity', default='rockies', help="Entidad con una única salida")
+    parser.add_argument('--stage', choices=['dev', 'test', 'prod'], default='dev')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--port', type=int, default=5557)
+    parser.add_argument('--segments', type=int, default=8, help="Segmentos del scan (páginas por ejecución)")
+    parser.add_argument('--part-size', type=int, default=8 * 1024, help="Tamaño de parte de las subidas multipart")
+    return parser.parse_args()
+
+# Función para ejecutar la ingesta asyncio de una entidad en un proceso aparte, con los hooks del escenario
+def run_engine(name, env, work_dir, log_name, hooks=''):
+    with open(os.path.join(work_dir, f"{log_name}.log"), 'w') as log:
+        process = subprocess.run([sys.executable, '-c', ENGINE.format(hooks=hooks), '--entities', name],
+                                 cwd=ENGINE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process.returncode
+
+# Función para listar las claves del bucket
+def bucket_keys(s3, bucket):
+    return [obj['Key'] for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket)
+            for obj in page.get('Contents', [])]
+
+# Función para verificar que una ejecución fallida no dejó objetos ni subidas abiertas
+def nothing_left(s3, bucket):
+    problems = [f"{key} is visible after a failed run" for key in bucket_keys(s3, bucket)]
+    open_uploads = s3.list_multipart_uploads(Bucket=bucket).get('Uploads', [])
+    if open_uploads:
+        problems.append(f"{len(open_uploads)} multipart upload(s) left open after a failed run")
+    return problems
+
+# Escenario: con CHECKPOINT_ENABLED=true la variante asyncio no arranca
+def checkpoint_refused(name, env, work_dir, s3, bucket):
+    code = run_engine(name, {**env, 'CHECKPOINT_ENABLED': 'true'}, work_dir, 'checkpoint_refused')
+    with open(os.path.join(work_dir, 'checkpoint_refused.log')) as f:
+        refused = 'CHECKPOINT_ENABLED=false' in f.read()
+    if code == 0 or not refused:
+        return [f"the run exited with {code} instead of refusing to start with checkpoints enabled"]
+    return nothing_left(s3, bucket)
+
+# Escenario: subida de los shards en streaming mientras avanza el scan
+def stream(name, env, work_dir, s3, bucket):
+    code = run_engine(name, {**env, 'STREAM_TO_S3': 'true'}, work_dir, 'stream')
+    return [f"the run exited with {code}"] if code else []
+
+# Escenario: shards escritos en archivos locales y sellados al cerrarse
+def local_files(name, env, work_dir, s3, bucket):
+    code = run_engine(name, {**env, 'STREAM_TO_S3': 'false'}, work_dir, 'local_files')
+    return [f"the run exited with {code}"] if code else []
+
+# Escenario: falla la escritura del manifiesto; ningún shard queda visible y la ejecución siguiente publica todo
+def manifest_failed(name, env, work_dir, s3, bucket):
+    env = {**env, 'STREAM_TO_S3': 'true'}
+    code = run_engine(name, env, work_dir, 'manifest_failed', FAIL_MANIFEST)
+    if code == 0:
+        return ["the run succeeded without a manifest"]
+    problems = nothing_left(s3, bucket)
+    if problems:
+        return problems
+    code = run_engine(name, env, work_dir, 'manifest_failed_rerun')
+    return [f"the rerun exited with {code}"] if code else []
+
+SCENARIOS = {'checkpoint_refused': checkpoint_refused, 'stream': stream, 'local_files': local_files,
+             'manifest_failed': manifest_failed}
+# Escenarios que no publican nada, sin objetos que verificar
+NO_OUTPUT = {'checkpoint_refused'}
+
+def main():
+    args = parse_args()
+    # moto lee el tamaño mínimo de parte al importarse y el servidor corre en este proceso
+    os.environ['S3_UPLOAD_PART_MIN_SIZE'] = str(args.part_size)
+    from moto.server import ThreadedMotoServer
+
+    endpoint = f"http://127.0.0.1:{args.port}"
+    os.environ.update({**CREDENTIALS, 'STAGE': args.stage})
+    from config import S3_BUCKET_NAME
+    from entities import ENTITIES
+
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+    failed = 0
+    try:
+        config = Config(region_name='us-east-1')
+        s3 = boto3.client('s3', endpoint_url=endpoint, config=config)
+        spec = ENTITIES[args.entity]
+        load_table(boto3.resource('dynamodb', endpoint_url=endpoint, config=config), f"{args.stage}_{spec['table']}",
+                   spec['id_field'], args.entity, args.items, args.seed, 0.5, 4)
+        s3.create_bucket(Bucket=S3_BUCKET_NAME)
+        for scenario, check in SCENARIOS.items():
+            with tempfile.TemporaryDirectory(prefix=f"async_{scenario}_") as work_dir:
+                checkpoint_dir = os.path.join(work_dir, 'checkpoints')
+                # Buffer de pocas filas y shards sin límite de filas: cada shard abarca varias páginas
+                # y se sube por partes mientras avanza el scan
+                env = {**os.environ, 'AWS_ENDPOINT_URL': endpoint, 'SCAN_CAPACITY_SHARE': '0', 'INCREMENTAL': 'false',
+                       'CHECKPOINT_ENABLED': 'false', 'SCAN_SEGMENTS': str(args.segments), 'SHARD_MAX_ROWS': '0',
+                       'CSV_BUFFER_ROWS': '50', 'OUTPUT_FORMAT': 'csv', 'RECOVERY_PART_SIZE': str(args.part_size),
+                       'LOG_DIR': os.path.join(work_dir, 'logs'), 'CHECKPOINT_DIR': checkpoint_dir,
+                       'METRICS_DIR': os.path.join(work_dir, 'metrics'), 'HASH_DIR': os.path.join(work_dir, 'hashes'),
+                       'WATERMARK_DIR': os.path.join(work_dir, 'watermarks'), 'HOSTNAME': f"async_{scenario}"}
+                problems = check(args.entity, env, work_dir, s3, S3_BUCKET_NAME)
+                if not problems and scenario not in NO_OUTPUT:
+                    problems = verify(s3, S3_BUCKET_NAME, args.entity, args.stage, args.items,
+                                      os.path.join(checkpoint_dir, f"{args.entity}_{args.stage}.json"))
+                print(f"{scenario:<28}{'OK' if not problems else 'FAILED'}")
+                for problem in problems:
+                    print(f"  - {problem}")
+                if problems:
+                    failed += 1
+                    # Los logs se pierden con el directorio temporal, así que se muestra el final de cada uno
+                    for log_name in sorted(os.listdir(work_dir)):
+                        if log_name.endswith('.log'):
+                            with open(os.path.join(work_dir, log_name)) as f:
+                                print(f"\n--- {log_name} ---\n" + ''.join(f.readlines()[-20:]))
+            # Cada escenario empieza con el bucket vacío
+            for key in bucket_keys(s3, S3_BUCKET_NAME):
+                s3.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+    finally:
+        server.stop()
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import boto3
+from botocore.config import Config
+
+from bench_ingesta import CREDENTIALS, ENGINE_DIR, load_table
+
+# Pruebas de recuperación de punta a punta contra un servidor local de moto: cada escenario
+# corta una ingesta en un punto delicado (o toca el bucket entre dos ejecuciones), la vuelve a
+# ejecutar y verifica que la segunda ejecución termina bien, sin checkpoint ni subidas multipart
+# abiertas, y que los objetos del manifiesto tienen exactamente las filas de la tabla.
+#
+# pip install "moto[server]" boto3 loguru
+# python benchmarks/check_recovery.py --items 3000
+#
+# Para que los shards se suban en varias partes sin generar gigas de datos, el servidor acepta
+# partes de --part-size bytes y la ingesta se lanza con ese tamaño de parte (config exige 5 MB).
+# Las páginas del scan se limitan a --page-items items para que haya checkpoints durante la escritura.
+
+KILLED = 137
+# Lanza la ingesta síncrona con el tamaño de parte de la prueba; los escenarios le agregan hooks
+ENGINE = ("import os, sys, config\n"
+          "config.S3_PART_SIZE = int(os.environ['RECOVERY_PART_SIZE'])\n"
+          "import aws, scan, ingesta\n"
+          "aws.dynamodb.meta.events.register('provide-client-params.dynamodb.Scan', lambda params, **kwargs: "
+          "params.update(Limit=int(os.environ['RECOVERY_PAGE_ITEMS'])))\n"
+          "{hooks}"
+          "sys.argv = ['ingesta.py', *sys.argv[1:]]\n"
+          "ingesta.main()\n")
+# Termina el proceso justo antes de descartar el checkpoint, con los objetos ya publicados
+KILL_BEFORE_DISCARD = f"scan.ScanCheckpoint.discard = lambda self: os._exit({KILLED})\n"
+# Termina el proceso en cuanto S3 completa la primera subida multipart (la de un shard que rota)
+KILL_AFTER_COMPLETE = ("aws.s3.meta.events.register('after-call.s3.CompleteMultipartUpload', "
+                       f"lambda **kwargs: os._exit({KILLED}))\n")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pruebas de recuperación de la ingesta contra moto.")
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--entity', default='rockies', help="Entidad con una única salida")
+    parser.add_argument('--stage', choices=['dev', 'test', 'prod'], default='dev')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--port', type=int, default=5556)
+    parser.add_argument('--shard-max-rows', type=int, default=200, help="Filas por shard (0 sin límite)")
+    parser.add_argument('--page-items', type=int, default=100, help="Items por página del scan")
+    parser.add_argument('--part-size', type=int, default=8 * 1024, help="Tamaño de parte de las subidas multipart")
+    return parser.parse_args()
+
+# Función para ejecutar la ingesta de una entidad en un proceso aparte, con los hooks del escenario
+def run_engine(name, env, work_dir, log_name, hooks=''):
+    with open(os.path.join(work_dir, f"{log_name}.log"), 'w') as log:
+        process = subprocess.run([sys.executable, '-c', ENGINE.format(hooks=hooks), '--entities', name],
+                                 cwd=ENGINE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process.returncode
+
+# Función para leer las filas de datos de un objeto CSV (sin la cabecera)
+def object_rows(s3, bucket, key):
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    if key.endswith('.gz'):
+        body = gzip.decompress(body)
+    return list(csv.reader(io.StringIO(body.decode('utf-8'))))[1:]
+
+# Función para leer el manifiesto de la última ejecución de una entidad (None si no hay)
+def latest_manifest(s3, bucket, name, stage):
+    manifests = sorted(obj['Key'] for obj in s3.list_objects_v2(Bucket=bucket, Prefix=f"_manifests/{name}_{stage}_")
+                       .get('Contents', []))
+    return json.loads(s3.get_object(Bucket=bucket, Key=manifests[-1])['Body'].read()) if manifests else None
+
+# Función para verificar el resultado de la ingesta de una entidad; devuelve los problemas encontrados
+def verify(s3, bucket, name, stage, items, checkpoint_file):
+    problems = []
+    if os.path.exists(checkpoint_file):
+        problems.append(f"checkpoint {checkpoint_file} was not discarded")
+    open_uploads = s3.list_multipart_uploads(Bucket=bucket).get('Uploads', [])
+    if open_uploads:
+        problems.append(f"{len(open_uploads)} multipart upload(s) left open")
+    manifest = latest_manifest(s3, bucket, name, stage)
+    if manifest is None:
+        return problems + ["no manifest was written"]
+    ids = []
+    for shard in manifest['shards']:
+        rows = object_rows(s3, bucket, shard['key'])
+        if len(rows) != shard['rows']:
+            problems.append(f"{shard['key']} has {len(rows)} row(s), the manifest says {shard['rows']}")
+        ids.extend(row[0] for row in rows)
+    if len(ids) != items or len(set(ids)) != items:
+        problems.append(f"{len(ids)} row(s) ({len(set(ids))} distinct) for {items} item(s)")
+    return problems
+
+# Escenario: el proceso muere después de publicar los objetos y antes de descartar el checkpoint
+def killed_before_discard(name, env, work_dir, s3, bucket):
+    code = run_engine(name, env, work_dir, 'killed_before_discard', KILL_BEFORE_DISCARD)
+    if code != KILLED:
+        return [f"the first run exited with {code} instead of being killed before the discard"]
+    code = run_engine(name, env, work_dir, 'killed_before_discard_rerun')
+    return [f"the rerun exited with {code}"] if code else []
+
+# Escenario: el proceso muere con un shard ya completado en S3 y la ingesta todavía en curso
+def killed_after_complete(name, env, work_dir, s3, bucket):
+    code = run_engine(name, env, work_dir, 'killed_after_complete', KILL_AFTER_COMPLETE)
+    if code != KILLED:
+        return [f"the first run exited with {code} instead of being killed after completing an upload"]
+    code = run_engine(name, env, work_dir, 'killed_after_complete_rerun')
+    return [f"the rerun exited with {code}"] if code else []
+
+# Escenario: entre dos ejecuciones sin cambios en la tabla se borra un objeto del bucket; la caché de
+# hashes dice que no cambió, pero la segunda ejecución tiene que volver a subirlo (y omitir el resto)
+def target_deleted(name, env, work_dir, s3, bucket):
+    code = run_engine(name, env, work_dir, 'target_deleted')
+    if code:
+        return [f"the first run exited with {code}"]
+    shards = latest_manifest(s3, bucket, name, env['STAGE'])['shards']
+    s3.delete_object(Bucket=bucket, Key=shards[0]['key'])
+    code = run_engine(name, env, work_dir, 'target_deleted_rerun')
+    if code:
+        return [f"the rerun exited with {code}"]
+    skipped = {shard['key'] for shard in latest_manifest(s3, bucket, name, env['STAGE'])['shards'] if shard['skipped']}
+    if shards[0]['key'] in skipped:
+        return [f"the deleted object {shards[0]['key']} was skipped as unchanged"]
+    if len(skipped) != len(shards) - 1:
+        return [f"{len(skipped)} of {len(shards) - 1} unchanged object(s) were skipped"]
+    return []
+
+SCENARIOS = {'killed_before_discard': killed_before_discard, 'killed_after_complete': killed_after_complete,
+             'target_deleted': target_deleted}
+
+def main():
+    args = parse_args()
+    # moto lee el tamaño mínimo de parte al importarse y el servidor corre en este proceso
+    os.environ['S3_UPLOAD_PART_MIN_SIZE'] = str(args.part_size)
+    from moto.server import ThreadedMotoServer
+
+    endpoint = f"http://127.0.0.1:{args.port}"
+    os.environ.update({**CREDENTIALS, 'STAGE': args.stage})
+    from config import S3_BUCKET_NAME
+    from entities import ENTITIES
+
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+    failed = 0
+    try:
+        config = Config(region_name='us-east-1')
+        s3 = boto3.client('s3', endpoint_url=endpoint, config=config)
+        spec = ENTITIES[args.entity]
+        load_table(boto3.resource('dynamodb', endpoint_url=endpoint, config=config), f"{args.stage}_{spec['table']}",
+                   spec['id_field'], args.entity, args.items, args.seed, 0.5, 4)
+        s3.create_bucket(Bucket=S3_BUCKET_NAME)
+        for scenario, check in SCENARIOS.items():
+            with tempfile.TemporaryDirectory(prefix=f"recovery_{scenario}_") as work_dir:
+                checkpoint_dir = os.path.join(work_dir, 'checkpoints')
+                env = {**os.environ, 'AWS_ENDPOINT_URL': endpoint, 'SCAN_CAPACITY_SHARE': '0', 'INCREMENTAL': 'false',
+                       'STREAM_TO_S3': 'true', 'CHECKPOINT_ENABLED': 'true', 'CHECKPOINT_EVERY_PAGES': '1',
+                       'SHARD_MAX_ROWS': str(args.shard_max_rows), 'OUTPUT_FORMAT': 'csv',
+                       'RECOVERY_PART_SIZE': str(args.part_size), 'RECOVERY_PAGE_ITEMS': str(args.page_items),
+                       'LOG_DIR': os.path.join(work_dir, 'logs'), 'CHECKPOINT_DIR': checkpoint_dir,
+                       'METRICS_DIR': os.path.join(work_dir, 'metrics'), 'HASH_DIR': os.path.join(work_dir, 'hashes'),
+                       'WATERMARK_DIR': os.path.join(work_dir, 'watermarks'), 'HOSTNAME': f"recovery_{scenario}"}
+                problems = check(args.entity, env, work_dir, s3, S3_BUCKET_NAME)
+                if not problems:
+                    problems = verify(s3, S3_BUCKET_NAME, args.entity, args.stage, args.items,
+                                      os.path.join(checkpoint_dir, f"{args.entity}_{args.stage}.json"))
+                print(f"{scenario:<28}{'OK' if not problems else 'FAILED'}")
+                for problem in problems:
+                    print(f"  - {problem}")
+                if problems:
+                    failed += 1
+                    # Los logs se pierden con el directorio temporal, así que se muestra el final de cada uno
+                    for log_name in sorted(os.listdir(work_dir)):
+                        if log_name.endswith('.log'):
+                            with open(os.path.join(work_dir, log_name)) as f:
+                                print(f"\n--- {log_name} ---\n" + ''.join(f.readlines()[-20:]))
+            # Cada escenario empieza con el bucket vacío
+            for page in s3.get_paginator('list_objects_v2').paginate(Bucket=S3_BUCKET_NAME):
+                for obj in page.get('Contents', []):
+                    s3.delete_object(Bucket=S3_BUCKET_NAME, Key=obj['Key'])
+    finally:
+        server.stop()
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
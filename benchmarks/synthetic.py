@@ -0,0 +1,47 @@
+import random
+from decimal import Decimal
+
+# Items sintéticos con la misma forma que las tablas de cada entidad (incluye
+# atributos anidados que no se exportan, como en las tablas reales)
+
+TENANTS = 7
+STORE_TYPES = ('Promotion', 'Accessories')  # promo_share es la fracción de Promotion
+
+
+def sample_item(name, i, rng, days=90, promo_share=0.5):
+    tenant = f"tenant_{i % TENANTS}"
+    day = f"2024-{(i % days) // 28 + 1:02d}-{(i % days) % 28 + 1:02d}"
+    if name == 'students':
+        return {'tenant_id': tenant, 'student_id': f"s{i}", 'student_email': f"s{i}@mail.com",
+                'creation_date': f"{day}T08:00:00",
+                'student_data': {'student_name': f"Student {i}", 'password': 'x' * 16, 'birthday': '2010-05-04',
+                                 'gender': rng.choice(['M', 'F']), 'telephone': '999999999',
+                                 'rockie_coins': Decimal(rng.randint(0, 5000)), 'rockie_gems': Decimal(rng.randint(0, 50))},
+                'student_promos': [f"promo_{j}" for j in range(rng.randint(0, 4))]}
+    if name == 'rockies':
+        return {'tenant_id': tenant, 'student_id': f"s{i}", 'level': Decimal(rng.randint(1, 30)),
+                'experience': Decimal(rng.randint(0, 99999)), 'evolution': rng.choice(['Stage 1', 'Stage 2', 'Stage 3']),
+                'rockie_data': {'rockie_name': f"Rockie {i}",
+                                'rockie_adorned': {'head_acc': 'h1', 'arms_acc': 'a2', 'body_acc': 'b3',
+                                                   'face_acc': 'f4', 'bg_acc': 'bg5'},
+                                'rockie_all_accessories_ids': [f"acc_{j}" for j in range(rng.randint(1, 12))],
+                                'rockie_history': [{'event': 'level_up', 'level': Decimal(j)} for j in range(5)]}}
+    if name == 'rewards':
+        return {'tenant_id': tenant, 'student_id': f"s{i % 10000}", 'reward_id': f"r{i}",
+                'experience': Decimal(rng.randint(1, 100)), 'creation_date': f"{day}T{i % 24:02d}:{i % 60:02d}:00",
+                'reward_data': {'activity_id': f"a{i}", 'rockie_coins': Decimal(rng.randint(1, 50))}}
+    if name == 'activities':
+        return {'tenant_id': tenant, 'activity_id': f"a{i}", 'student_id': f"s{i % 10000}",
+                'activity_type': rng.choice(['quiz', 'game', 'video']),
+                'creation_date': f"{day}T{i % 24:02d}:{i % 60:02d}:00",
+                'activity_data': {'time': Decimal(rng.randint(1, 3600)), 'answers': ['a', 'b', 'c']}}
+    return {'tenant_id': tenant, 'product_id': f"p{i}", 'price': Decimal(f"{rng.randint(1, 999)}.99"),
+            'store_type': STORE_TYPES[0] if rng.random() < promo_share else STORE_TYPES[1],
+            'product_info': {'image': f"https://cdn/p{i}.png", 'product_brand': 'brand', 'category': 'hats',
+                             'product_name': f"Product {i}"}}
+
+# Función para generar los items de una entidad de forma reproducible (misma semilla, mismos datos)
+def generate(name, count, seed=42, start=0, promo_share=0.5):
+    rng = random.Random(f"{seed}-{name}-{start}")
+    for i in range(start, start + count):
+        yield sample_item(name, i, rng, promo_share=promo_share)
@@ -1,5 +1,9 @@
 import boto3
+import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, unquote
 from loguru import logger
 # Configuración de AWS Glue
 glue_client = boto3.client('glue', region_name='us-east-1')  # Cambia la región si es necesario
@@ -8,41 +12,39 @@ s3_client = boto3.client('s3')
 # Nombre de la base de datos de Glue
 
 # Lista de tablas a crear
-tables = ['t_rockies', 't_students', 't_rewards', 't_activities', 't_accesories', 't_promos']
+tables = ['t_rockies', 't_students', 't_rewards', 't_activities', 't_accesories', 't_promos', 't_student_360',
+          't_activities_daily', 't_rewards_daily']
 
 # Esquemas personalizados para algunas tablas
 schema_t_students = [
-    {"Name": "tenant_id", "Type": "string", "Comment": ""},
     {"Name": "student_id", "Type": "string", "Comment": ""},
     {"Name": "student_email", "Type": "string", "Comment": ""},
-    {"Name": "fecha_ingreso", "Type": "string", "Comment": ""},
-    {"Name": "nombre", "Type": "string", "Comment": ""},
-    {"Name": "contraseña", "Type": "string", "Comment": ""},
-    {"Name": "fecha_nacimiento", "Type": "string", "Comment": ""},
-    {"Name": "genero", "Type": "string", "Comment": ""},
-    {"Name": "telefono", "Type": "string", "Comment": ""},
+    {"Name": "creation_date", "Type": "string", "Comment": ""},
+    {"Name": "student_name", "Type": "string", "Comment": ""},
+    {"Name": "password", "Type": "string", "Comment": ""},
+    {"Name": "birthday", "Type": "string", "Comment": ""},
+    {"Name": "gender", "Type": "string", "Comment": ""},
+    {"Name": "telephone", "Type": "string", "Comment": ""},
     {"Name": "rockie_coins", "Type": "int", "Comment": ""},
     {"Name": "rockie_gems", "Type": "int", "Comment": ""},
     {"Name": "student_promos", "Type": "string", "Comment": ""}
 ]
 
 schema_t_rockies = [
-    {"Name": "tenant_id", "Type": "string"},
     {"Name": "student_id", "Type": "string"},
     {"Name": "level", "Type": "int"},
     {"Name": "experience", "Type": "int"},
     {"Name": "evolution", "Type": "string"},
     {"Name": "rockie_name", "Type": "string"},
-    {"Name": "arms_acc", "Type": "string"},
-    {"Name": "head_acc", "Type": "string"},
-    {"Name": "body_acc", "Type": "string"},
-    {"Name": "face_acc", "Type": "string"},
-    {"Name": "bg_acc", "Type": "string"},
-    {"Name": "student_equipment", "Type": "string"}
+    {"Name": "head_accessory", "Type": "string"},
+    {"Name": "arms_accessory", "Type": "string"},
+    {"Name": "body_accessory", "Type": "string"},
+    {"Name": "face_accessory", "Type": "string"},
+    {"Name": "background_accessory", "Type": "string"},
+    {"Name": "rockie_all_accessories_ids", "Type": "string"}
 ]
 
 schema_t_rewards = [
-    {"Name": "tenant_id", "Type": "string"},
     {"Name": "student_id", "Type": "string"},
     {"Name": "reward_id", "Type": "string"},
     {"Name": "experience", "Type": "int"},
@@ -51,7 +53,6 @@ schema_t_rewards = [
 ]
 
 schema_t_promo = [
-    {"Name": "tenant_id", "Type": "string"},
     {"Name": "product_id", "Type": "string"},
     {"Name": "price", "Type": "double"},
     {"Name": "image", "Type": "string"},
@@ -61,7 +62,6 @@ schema_t_promo = [
 ]
 
 schema_t_accesory = [
-    {"Name": "tenant_id", "Type": "string"},
     {"Name": "product_id", "Type": "string"},
     {"Name": "price", "Type": "double"},
     {"Name": "image", "Type": "string"},
@@ -70,7 +70,6 @@ schema_t_accesory = [
 ]
 
 schema_t_activities = [
-    {"Name": "tenant_id", "Type": "string"},
     {"Name": "activity_id", "Type": "string"},
     {"Name": "student_id", "Type": "string"},
     {"Name": "activity_type", "Type": "string"},
@@ -78,33 +77,97 @@ schema_t_activities = [
     {"Name": "time", "Type": "int"}
 ]
 
+# Tabla desnormalizada por estudiante (STUDENT_360=true en la ingesta)
+schema_t_student_360 = [
+    {"Name": "student_id", "Type": "string"},
+    {"Name": "student_email", "Type": "string"},
+    {"Name": "student_name", "Type": "string"},
+    {"Name": "creation_date", "Type": "string"},
+    {"Name": "gender", "Type": "string"},
+    {"Name": "rockie_coins", "Type": "int"},
+    {"Name": "rockie_gems", "Type": "int"},
+    {"Name": "rockie_name", "Type": "string"},
+    {"Name": "rockie_level", "Type": "int"},
+    {"Name": "rockie_experience", "Type": "int"},
+    {"Name": "rockie_evolution", "Type": "string"},
+    {"Name": "rewards_count", "Type": "int"},
+    {"Name": "rewards_experience", "Type": "int"},
+    {"Name": "rewards_coins", "Type": "int"},
+    {"Name": "activities_count", "Type": "int"},
+    {"Name": "activities_time", "Type": "int"},
+    {"Name": "last_activity_date", "Type": "string"}
+]
+
+# Agregados diarios por tenant (ROLLUPS=true en la ingesta)
+schema_t_activities_daily = [
+    {"Name": "dt", "Type": "string"},
+    {"Name": "activity_type", "Type": "string"},
+    {"Name": "activities_count", "Type": "int"},
+    {"Name": "total_time", "Type": "int"}
+]
+
+schema_t_rewards_daily = [
+    {"Name": "dt", "Type": "string"},
+    {"Name": "rewards_count", "Type": "int"},
+    {"Name": "total_experience", "Type": "int"},
+    {"Name": "total_rockie_coins", "Type": "int"}
+]
+
+# Claves de partición de cada tabla (las ingestas escriben en tenant_id=.../dt=.../)
+partition_keys = {
+    't_students': ['tenant_id', 'dt'],
+    't_rockies': ['tenant_id'],
+    't_rewards': ['tenant_id', 'dt'],
+    't_activities': ['tenant_id', 'dt'],
+    't_promos': ['tenant_id'],
+    't_accesories': ['tenant_id'],
+    't_student_360': ['tenant_id'],
+    't_activities_daily': ['tenant_id'],
+    't_rewards_daily': ['tenant_id'],
+}
+
+
+# Esquema declarado de cada tabla: mismos nombres, orden y tipos que las columnas que escriben
+# las ingestas (OpenCSVSerde lee las columnas por posición y Parquet por nombre)
+schemas = {
+    't_students': schema_t_students,
+    't_rockies': schema_t_rockies,
+    't_rewards': schema_t_rewards,
+    't_promos': schema_t_promo,
+    't_accesories': schema_t_accesory,
+    't_activities': schema_t_activities,
+    't_student_360': schema_t_student_360,
+    't_activities_daily': schema_t_activities_daily,
+    't_rewards_daily': schema_t_rewards_daily,
+}
+
+# Parámetros de tabla que define setup.py (Glue y Athena agregan otros propios, que no se comparan)
+managed_parameters = ['classification', 'skip.header.line.count', 'compressionType', 'parquet.compression']
+
+
+# Función para armar la definición de una tabla en AWS Glue
+def table_input(stage, table_name, bucket_name, output_format='csv', compression='none'):
+    schema = schemas[table_name]
 
-# Función para crear una tabla en AWS Glue
-def create_table(stage, table_name, bucket_name, database_name):
-    
-    # Determinar el esquema dependiendo del nombre de la tabla
-    if table_name == 't_students':
-        schema = schema_t_students
-    elif table_name == 't_rockies':
-        schema = schema_t_rockies
-    elif table_name == 't_rewards':
-        schema = schema_t_rewards
-    elif table_name == 't_promos':
-        schema = schema_t_promo
-    elif table_name == 't_accesories':
-        schema = schema_t_accesory
-    elif table_name == 't_activities':
-        schema = schema_t_activities
+    # Definir el formato de almacenamiento según el formato de salida de las ingestas
+    if output_format == 'parquet':
+        storage_format = {
+            'InputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat',
+            'OutputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat',
+            'SerdeInfo': {
+                'Name': 'ParquetHiveSerDe',
+                'SerializationLibrary': 'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe',
+                'Parameters': {
+                    'serialization.format': '1'
+                }
+            }
+        }
+        table_parameters = {
+            'classification': 'parquet',
+            'parquet.compression': 'SNAPPY' if compression == 'none' else compression.upper()
+        }
     else:
-        logger.error(f"Esquema no definido para la tabla {table_name}.")
-    
-    # Crear la definición de la tabla
-    table_input = {
-        'Name': table_name,
-        'Description': f"Tabla {table_name} para el stage {stage}",
-        'StorageDescriptor': {
-            'Columns': schema,
-            'Location': f"s3://{bucket_name}/{table_name}/",  # Cambia el bucket y la ruta
+        storage_format = {
             'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
             'OutputFormat': 'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
             'SerdeInfo': {
@@ -114,20 +177,164 @@ def create_table(stage, table_name, bucket_name, database_name):
                     'separatorChar': ','
                 }
             }
+        }
+        table_parameters = {
+            'classification': 'csv',
+            'skip.header.line.count': '1'  # Los CSV de las ingestas incluyen la cabecera
+        }
+        # Athena descomprime los CSV según la extensión del objeto (.gz / .zst)
+        if compression != 'none':
+            table_parameters['compressionType'] = compression
+
+    # Crear la definición de la tabla
+    return {
+        'Name': table_name,
+        'Description': f"Tabla {table_name} para el stage {stage}",
+        'StorageDescriptor': {
+            'Columns': schema,
+            'Location': f"s3://{bucket_name}/{table_name}/",  # Cambia el bucket y la ruta
+            **storage_format
         },
-        'PartitionKeys': [],
-        'TableType': 'EXTERNAL_TABLE'
+        'PartitionKeys': [{"Name": key, "Type": "string"} for key in partition_keys[table_name]],
+        'TableType': 'EXTERNAL_TABLE',
+        'Parameters': table_parameters
     }
-    
-    # Crear la tabla en AWS Glue
-    glue_client.create_table(
-        DatabaseName=database_name,
-        TableInput=table_input
-    )
-    logger.info(f"Tabla {table_name} creada en el stage {stage}.")
 
 
+# Función para reducir una tabla (declarada o leída del catálogo) a lo que define setup.py,
+# así dos definiciones equivalentes se comparan iguales
+def table_signature(table):
+    descriptor = table.get('StorageDescriptor', {})
+    serde = descriptor.get('SerdeInfo', {})
+    parameters = table.get('Parameters', {})
+    return {
+        'description': table.get('Description', ''),
+        'columns': [(c['Name'], c['Type'], c.get('Comment', '')) for c in descriptor.get('Columns', [])],
+        'location': descriptor.get('Location'),
+        'input_format': descriptor.get('InputFormat'),
+        'output_format': descriptor.get('OutputFormat'),
+        'serde': serde.get('SerializationLibrary'),
+        'serde_parameters': serde.get('Parameters', {}),
+        'partition_keys': [(k['Name'], k['Type']) for k in table.get('PartitionKeys', [])],
+        'table_type': table.get('TableType'),
+        'parameters': {key: parameters.get(key) for key in managed_parameters},
+    }
+
+
+# Función para leer de una sola vez las tablas que ya tiene la base de datos en Glue
+def catalog_tables(database_name):
+    current = {}
+    paginator = glue_client.get_paginator('get_tables')
+    for page in paginator.paginate(DatabaseName=database_name):
+        for table in page['TableList']:
+            current[table['Name']] = table
+    return current
+
+
+# Función para crear o actualizar una tabla en AWS Glue
+def apply_table(action, database_name, table):
+    if action == 'create':
+        try:
+            glue_client.create_table(DatabaseName=database_name, TableInput=table)
+            return action
+        except glue_client.exceptions.AlreadyExistsException:
+            # Otro setup la creó entre la lectura del catálogo y ahora: se actualiza
+            pass
+    glue_client.update_table(DatabaseName=database_name, TableInput=table)
+    return 'update'
+
+
+# Función para dejar el catálogo igual a los esquemas declarados: se lee una vez, se compara
+# y solo se crean o actualizan, en paralelo, las tablas que faltan o cambiaron
+def provision_tables(stage, bucket_name, database_name, output_format='csv', compression='none'):
+    current = catalog_tables(database_name)
+    changes = []
+    for table_name in tables:
+        table = table_input(stage, table_name, bucket_name, output_format, compression)
+        existing = current.get(table_name)
+        if existing is None:
+            changes.append(('create', table))
+        elif table_signature(existing) != table_signature(table):
+            changes.append(('update', table))
+
+    if not changes:
+        logger.info(f"Catálogo {database_name} al día: {len(tables)} tabla(s) sin cambios.")
+        return True
+
+    failed = False
+    with ThreadPoolExecutor(max_workers=len(changes)) as executor:
+        futures = {executor.submit(apply_table, action, database_name, table): table['Name'] for action, table in changes}
+        for future in as_completed(futures):
+            table_name = futures[future]
+            try:
+                action = 'creada' if future.result() == 'create' else 'actualizada'
+                logger.info(f"Tabla {table_name} ({output_format}, compresión {compression}) {action} en el stage {stage}.")
+            except Exception as e:
+                logger.error(f"Error creando o actualizando la tabla {table_name}: {e}")
+                failed = True
+    return not failed
+
+
+# Función para encontrar las tablas sin cambios en la última ingesta: según el último manifiesto
+# de cada entidad (_manifests/<entidad>_<stage>_<run_id>.json), todos sus shards se omitieron
+def unchanged_tables(bucket_name):
+    latest = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='_manifests/'):
+        for obj in page.get('Contents', []):
+            entity = obj['Key'].rsplit('_', 1)[0]
+            if obj['Key'] > latest.get(entity, ''):
+                latest[entity] = obj['Key']
 
+    seen, uploaded = set(), set()
+    for key in latest.values():
+        manifest = json.loads(s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read())
+        for shard in manifest['shards']:
+            table_name = shard['key'].split('/', 1)[0]
+            seen.add(table_name)
+            if not shard.get('skipped'):
+                uploaded.add(table_name)
+    return seen - uploaded
+
+
+# Función para registrar en Glue las particiones nuevas que dejaron las ingestas en S3
+def register_partitions(table_name, bucket_name, database_name):
+    keys = partition_keys[table_name]
+    storage_descriptor = glue_client.get_table(DatabaseName=database_name, Name=table_name)['Table']['StorageDescriptor']
+
+    # Particiones presentes en S3: cada objeto vive en <tabla>/clave=valor/.../archivo
+    found = set()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{table_name}/"):
+        for obj in page.get('Contents', []):
+            folders = obj['Key'].split('/')[1:-1]
+            if len(folders) == len(keys) and all(folder.startswith(f"{key}=") for folder, key in zip(folders, keys)):
+                found.add('/'.join(folders))
+
+    # Particiones ya registradas en Glue
+    registered = set()
+    paginator = glue_client.get_paginator('get_partitions')
+    for page in paginator.paginate(DatabaseName=database_name, TableName=table_name):
+        for partition in page['Partitions']:
+            registered.add('/'.join(f"{key}={quote(value, safe='')}" for key, value in zip(keys, partition['Values'])))
+
+    missing = sorted(found - registered)
+    partitions = []
+    for path in missing:
+        values = [unquote(folder.split('=', 1)[1]) for folder in path.split('/')]
+        partitions.append({
+            'Values': values,
+            'StorageDescriptor': {**storage_descriptor, 'Location': f"s3://{bucket_name}/{table_name}/{path}/"}
+        })
+
+    # BatchCreatePartition acepta hasta 100 particiones por llamada
+    for start in range(0, len(partitions), 100):
+        response = glue_client.batch_create_partition(DatabaseName=database_name, TableName=table_name,
+                                                      PartitionInputList=partitions[start:start + 100])
+        for error in response.get('Errors', []):
+            if error['ErrorDetail'].get('ErrorCode') != 'AlreadyExistsException':
+                logger.error(f"Error registrando la partición {error['PartitionValues']} de {table_name}: {error['ErrorDetail']}")
+    logger.info(f"Tabla {table_name}: {len(missing)} partición(es) nueva(s) registrada(s).")
 
 
 # Función para crear las carpetas en el bucket S3
@@ -155,15 +362,39 @@ def main():
         logger.error(f"Invalid value for STAGE environment variable: {stage}")
         exit()
 
+    # Formato de los archivos que escriben las ingestas ('csv' o 'parquet')
+    output_format = os.getenv('OUTPUT_FORMAT', 'csv')
+
+    if output_format not in ['csv', 'parquet']:
+        logger.error(f"Invalid value for OUTPUT_FORMAT environment variable: {output_format}")
+        exit()
+
+    # Compresión de los archivos ('none', 'gzip' o 'zstd'), la misma que usan las ingestas
+    compression = os.getenv('COMPRESSION', 'none')
+
+    if compression not in ['none', 'gzip', 'zstd']:
+        logger.error(f"Invalid value for COMPRESSION environment variable: {compression}")
+        exit()
+
     bucket_name = f'ciencia-datos-bucket-rockie-{stage}'
     database_name = f'rockie_database_{stage}'
 
 
+    # "python setup.py partitions" registra las particiones nuevas después de cada ingesta
+    if len(sys.argv) > 1 and sys.argv[1] == 'partitions':
+        unchanged = unchanged_tables(bucket_name)
+        for table in tables:
+            if table in unchanged:
+                logger.info(f"Tabla {table}: sin cambios en la última ingesta, no se actualiza el catálogo.")
+                continue
+            register_partitions(table, bucket_name, database_name)
+        return
+
     # Ejecutar la función para crear las carpetas
     #create_s3_folders(bucket_name)
-    # Crear todas las tablas para los diferentes stages
-    for table in tables:
-        create_table(stage, table, bucket_name, database_name)
+    # Crear o actualizar solo las tablas que no coinciden con los esquemas declarados
+    if not provision_tables(stage, bucket_name, database_name, output_format, compression):
+        exit(1)
 
 
 if __name__ == '__main__':